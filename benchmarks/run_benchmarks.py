@@ -0,0 +1,246 @@
+"""
+COEMA - Benchmarks de extracción y facturación
+Mide tiempo y memoria pico de los caminos calientes y guarda el resultado en
+JSON para comparar entre commits. Corre sin red: usa los PDFs de
+docs/cuadros-tarifarios y padrones sintéticos.
+
+Uso:
+    python benchmarks/run_benchmarks.py                    # todo, guarda en benchmarks/results/
+    python benchmarks/run_benchmarks.py --solo extraccion --tamanos 10000
+    python benchmarks/run_benchmarks.py --comparar benchmarks/results/<otro>.json
+"""
+
+import argparse
+import datetime
+import gc
+import itertools
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DOCS_DIR = os.path.join(BASE_DIR, "docs", "cuadros-tarifarios")
+RESULTS_DIR = os.path.join(BASE_DIR, "benchmarks", "results")
+sys.path.insert(0, os.path.join(BASE_DIR, "src"))
+
+import pdf_extractor  # noqa: E402
+from facturacion import calcular_factura, obtener_escalon  # noqa: E402
+from facturacion_rutas import COLUMNAS_PADRON, facturar_por_rutas  # noqa: E402
+
+TAMANOS_PADRON = [10_000, 100_000, 1_000_000]
+GRUPOS = ["extraccion", "escalones", "padron"]
+
+# Llamadas por medición en los benchmarks por llamada (obtener_escalon,
+# calcular_factura): el tiempo reportado es por llamada.
+LLAMADAS_POR_MEDICION = 2000
+
+
+def medir(fn: Callable[[], object], repeticiones: int, llamadas: int = 1) -> Dict:
+    """
+    Tiempo (segundos por llamada) y memoria pico de fn.
+
+    La memoria se mide en una corrida aparte bajo tracemalloc, para que su
+    costo no infle los tiempos. Solo cuenta lo que asigna este proceso.
+    """
+    fn()  # calentamiento (índices, imports perezosos)
+    tiempos = []
+    for _ in range(repeticiones):
+        gc.collect()
+        t0 = time.perf_counter()
+        for _ in range(llamadas):
+            fn()
+        tiempos.append((time.perf_counter() - t0) / llamadas)
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        fn()
+        _, pico = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "repeticiones": repeticiones,
+        "llamadas": llamadas,
+        "seg_min": min(tiempos),
+        "seg_mediana": statistics.median(tiempos),
+        "seg_max": max(tiempos),
+        "memoria_pico_bytes": pico,
+    }
+
+
+def _pdfs() -> List[str]:
+    return sorted(
+        os.path.join(DOCS_DIR, f) for f in os.listdir(DOCS_DIR) if f.lower().endswith(".pdf")
+    )
+
+
+def _texto_pdf(path: str) -> str:
+    """Texto que extract_tariffs recibe para ese PDF (mismas páginas)."""
+    import io
+    import pdfplumber
+
+    data = open(path, "rb").read()
+    with pdfplumber.open(io.BytesIO(data)) as pdf:
+        paginas = pdf_extractor.select_pages(data, len(pdf.pages))
+        return "\n".join(pdf.pages[i].extract_text() or "" for i in paginas)
+
+
+def bench_extraccion(repeticiones: int) -> Dict[str, Dict]:
+    resultados = {}
+    cache_original = pdf_extractor._cache
+    with tempfile.TemporaryDirectory() as tmp:
+        # Cache descartable: no tocar la del usuario y empezar siempre en frío
+        pdf_extractor._cache = pdf_extractor.TariffCache(directory=tmp)
+        try:
+            for path in _pdfs():
+                nombre = os.path.basename(path)
+                resultados[f"extract_tariffs_from_pdf[{nombre}]"] = medir(
+                    lambda: pdf_extractor.extract_tariffs_from_pdf(path, use_cache=False),
+                    repeticiones)
+                pdf_extractor.extract_tariffs_from_pdf(path)
+                resultados[f"extract_tariffs_from_pdf_cache[{nombre}]"] = medir(
+                    lambda: pdf_extractor.extract_tariffs_from_pdf(path), repeticiones * 10)
+                texto = _texto_pdf(path)
+                resultados[f"extract_tariffs[{nombre}]"] = medir(
+                    lambda: pdf_extractor.extract_tariffs(texto), repeticiones * 10)
+        finally:
+            pdf_extractor._cache = cache_original
+    return resultados
+
+
+def _tarifas_referencia() -> dict:
+    """Cuadro tarifario del primer PDF con T1R y T1RE (sin cache en disco)."""
+    for path in _pdfs():
+        data = pdf_extractor.extract_tariffs_from_pdf(path, use_cache=False)
+        if {"T1R", "T1RE"} <= set(data["tarifas"]):
+            return data["tarifas"]
+    raise RuntimeError(f"Ningún PDF de {DOCS_DIR} tiene T1R y T1RE")
+
+
+def bench_escalones(tarifas: dict, repeticiones: int) -> Dict[str, Dict]:
+    rng = np.random.default_rng(0)
+    consumos = itertools.cycle(rng.integers(0, 2000, LLAMADAS_POR_MEDICION).tolist())
+    return {
+        "obtener_escalon": medir(
+            lambda: obtener_escalon("T1R", next(consumos), tarifas),
+            repeticiones, LLAMADAS_POR_MEDICION),
+        "calcular_factura": medir(
+            lambda: calcular_factura("T1R", next(consumos), 0.21, tarifas),
+            repeticiones, LLAMADAS_POR_MEDICION),
+    }
+
+
+def padron_sintetico(n: int, semilla: int = 0, rutas: int = 40) -> pd.DataFrame:
+    """Padrón con COLUMNAS_PADRON: 90% T1R, consumos log-normales, n servicios."""
+    rng = np.random.default_rng(semilla)
+    padron = pd.DataFrame({
+        "ruta": rng.integers(1, rutas + 1, n).astype("int16"),
+        "tarifa": pd.Categorical(np.where(rng.random(n) < 0.9, "T1R", "T1RE")),
+        "consumo_kwh": np.clip(rng.lognormal(5.6, 0.6, n), 0, 9000).astype("int32"),
+        "iva": np.where(rng.random(n) < 0.85, 0.21, 0.27),
+        "zona_alumbrado": np.ones(n, dtype="int8"),
+    }, index=pd.Index([f"{i:08d}" for i in range(n)], name="socio"))
+    return padron[COLUMNAS_PADRON]
+
+
+def bench_padron(tarifas: dict, tamanos: List[int], repeticiones: int,
+                 max_workers: Optional[int]) -> Dict[str, Dict]:
+    resultados = {}
+    for n in tamanos:
+        padron = padron_sintetico(n)
+        r = medir(lambda: facturar_por_rutas(padron, tarifas, max_workers=max_workers),
+                  repeticiones)
+        r["servicios"] = n
+        r["servicios_por_seg"] = n / r["seg_mediana"]
+        resultados[f"facturar_por_rutas[{n}]"] = r
+    return resultados
+
+
+def _commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BASE_DIR,
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def comparar(actual: Dict, anterior: Dict):
+    """Imprime la relación de medianas (actual / anterior) por benchmark."""
+    print(f"\n{'benchmark':60} {'anterior':>12} {'actual':>12} {'ratio':>7}")
+    for nombre, r in actual["resultados"].items():
+        previo = anterior["resultados"].get(nombre)
+        if previo is None:
+            continue
+        ratio = r["seg_mediana"] / previo["seg_mediana"]
+        marca = "  <-- más lento" if ratio > 1.10 else ""
+        print(f"{nombre:60} {previo['seg_mediana']:12.6f} {r['seg_mediana']:12.6f} "
+              f"{ratio:7.2f}{marca}")
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--solo", choices=GRUPOS, action="append",
+                        help="correr solo este grupo (repetible)")
+    parser.add_argument("--tamanos", type=int, nargs="+", default=TAMANOS_PADRON,
+                        help="tamaños de padrón sintético")
+    parser.add_argument("--repeticiones", type=int, default=5)
+    parser.add_argument("--workers", type=int, default=None,
+                        help="max_workers de facturar_por_rutas (por defecto, como la app)")
+    parser.add_argument("--salida", help="archivo JSON (por defecto results/<commit>.json)")
+    parser.add_argument("--comparar", help="JSON de otra corrida para comparar")
+    args = parser.parse_args(argv)
+    grupos = args.solo or GRUPOS
+
+    resultados: Dict[str, Dict] = {}
+    if "extraccion" in grupos:
+        resultados.update(bench_extraccion(args.repeticiones))
+    if "escalones" in grupos or "padron" in grupos:
+        tarifas = _tarifas_referencia()
+        if "escalones" in grupos:
+            resultados.update(bench_escalones(tarifas, args.repeticiones))
+        if "padron" in grupos:
+            resultados.update(bench_padron(tarifas, args.tamanos, args.repeticiones,
+                                           args.workers))
+
+    commit = _commit()
+    informe = {
+        "commit": commit,
+        "fecha": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "plataforma": platform.platform(),
+        "cpus": os.cpu_count(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "resultados": resultados,
+    }
+
+    salida = args.salida or os.path.join(RESULTS_DIR, f"{commit or 'sin-commit'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(salida)), exist_ok=True)
+    with open(salida, "w", encoding="utf-8") as f:
+        json.dump(informe, f, indent=2, ensure_ascii=False)
+
+    for nombre, r in resultados.items():
+        print(f"{nombre:60} {r['seg_mediana'] * 1000:12.3f} ms "
+              f"{r['memoria_pico_bytes'] / 2**20:9.1f} MiB")
+    print(f"\nResultados en {salida}")
+
+    if args.comparar:
+        with open(args.comparar, encoding="utf-8") as f:
+            comparar(informe, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -5,10 +5,15 @@ Extrae datos tarifarios de PDFs de OCEBA, valida, y calcula facturación.
 """
 
 import streamlit as st
+import numpy as np
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
+import copy
+import datetime
+import json
 import os
+import sqlite3
 import sys
 import time
 from typing import Dict, List
@@ -18,10 +23,36 @@ from typing import Dict, List
 # ---------------------------------------------------------------------------
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 from pdf_extractor import (
+    ExtractionMemoryError,
+    TariffCache,
     extract_tariffs_from_pdf,
+    extract_tariffs_from_pdfs,
     extract_tariffs_from_bytes,
     extract_tariffs_from_url,
 )
+from facturacion import (
+    CTT_POR_KWH,
+    a_pesos,
+    recompilar_indices,
+    calcular_factura,
+    cuadros_por_segmento,
+    curva_factura,
+    detalle_factura,
+    escalones_lote,
+    fmt,
+    fmt_centavos,
+    fmt_centavos_lote,
+)
+from cache_sesiones import CORRIDAS, EXTRACCIONES, vaciar_caches
+from cobranza import COBRANZA_DIR, exportar_cobranza
+from facturacion_rutas import (
+    CHECKPOINTS_DIR, COLUMNA_SEGMENTO, COLUMNAS_PADRON, agregados_facturacion, facturar_por_rutas,
+    huella_tarifas, indice_dependencias, refacturar_escalones, totales_facturacion,
+)
+from facturas_pdf import FACTURAS_DIR, renderizar_facturas
+from historial_tarifas import historial_tarifas
+from metricas import REGISTRO, Traza, servir_metricas, span, traza
+from padron import cargar_sgimovil, padron_desde_clientes
 
 # ---------------------------------------------------------------------------
 # PATHS
@@ -29,6 +60,12 @@ from pdf_extractor import (
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 DOCS_DIR = os.path.join(BASE_DIR, "docs", "cuadros-tarifarios")
 
+# Endpoint /metrics (Prometheus) y /metrics.json, si se define el puerto
+METRICAS_PUERTO = os.environ.get("COEMA_METRICAS_PUERTO")
+
+# Ejecuciones del script cuyo desglose se guarda para el panel Rendimiento
+MAX_TRAZAS = 5
+
 PDF_EXAMPLES = {
     "Anexo 6 (N1 - Precio completo)": os.path.join(DOCS_DIR, "IF-2026-01658521-GDEBA-GMOCEBA (1).pdf"),
     "Anexo 14 (N2 - Subsidio hasta 350 kWh)": os.path.join(DOCS_DIR, "IF-2026-01666577-GDEBA-GMOCEBA.pdf"),
@@ -42,26 +79,8 @@ OCEBA_TARIFAS_URL = "https://oceba.gba.gov.ar/nueva_web/s.php?i=17"
 # CONSTANTS
 # ---------------------------------------------------------------------------
 
-# Impuestos y leyes (sobre subtotal energía)
-IMPUESTOS = {
-    "iva": {"nombre": "I.V.A.", "porcentaje": None},  # varía por cliente
-    "ley_7290": {"nombre": "Ley Provincial 7290", "porcentaje": 0.04},
-    "art_75": {"nombre": "Ley 11769 Art 75 (6%- Ex.9226)", "porcentaje": 0.06},
-    "art_72bis": {"nombre": "Ley 11769 art.72 Bis (0,001%)", "porcentaje": 0.00001},
-    "fondo": {"nombre": "Ley 11769 Fondo Compensador", "porcentaje": 0.055},
-}
-
-# CTT de resolución OCEBA separada (Res 2019-189)
-CTT_POR_KWH = {"T1R": 9.8780, "T1RE": 4.2020}
-
-# Alumbrado público
-ALUMBRADO_PUBLICO = {1: 14000.00}
-
-# Otros conceptos (punto de venta aparte)
-OTROS_CONCEPTOS_PORCENTAJE_RES_ASAM = 0.1346  # ~13.46% subtotal energía
-BOMBEROS = 960.00
-
-# Tarifa ANTERIOR (hardcoded de la demo vieja, sirve para comparar)
+# Tarifa ANTERIOR (hardcoded de la demo vieja): se compara contra esta solo
+# si el historial de cuadros todavía no tiene una versión previa del anexo.
 TARIFAS_ANTERIORES = {
     "T1R": {
         "nombre": "Tarifa 1 Residencial",
@@ -93,6 +112,7 @@ CLIENTES = {
         "condicion_iva": "Monotributista",
         "iva": 0.27,
         "segmentacion": "N1",
+        "ruta": 3,
         "zona_alumbrado": 1,
         "medidor": "197*****",
         "servicio": "1014*****",
@@ -114,6 +134,7 @@ CLIENTES = {
         "condicion_iva": "Consumidor Final",
         "iva": 0.21,
         "segmentacion": "N1",
+        "ruta": 1,
         "zona_alumbrado": 1,
         "medidor": "315*****",
         "servicio": "1564*****",
@@ -135,6 +156,7 @@ CLIENTES = {
         "condicion_iva": "Monotributista",
         "iva": 0.27,
         "segmentacion": "N1",
+        "ruta": 3,
         "zona_alumbrado": 1,
         "medidor": "224*****",
         "servicio": "2033*****",
@@ -156,6 +178,7 @@ CLIENTES = {
         "condicion_iva": "Consumidor Final",
         "iva": 0.21,
         "segmentacion": "N1",
+        "ruta": 1,
         "zona_alumbrado": 1,
         "medidor": "412*****",
         "servicio": "5892*****",
@@ -177,6 +200,7 @@ CLIENTES = {
         "condicion_iva": "Monotributista",
         "iva": 0.27,
         "segmentacion": "N1",
+        "ruta": 7,
         "zona_alumbrado": 1,
         "medidor": "508*****",
         "servicio": "3010*****",
@@ -198,6 +222,7 @@ CLIENTES = {
         "condicion_iva": "Monotributista",
         "iva": 0.27,
         "segmentacion": "N1",
+        "ruta": 2,
         "zona_alumbrado": 1,
         "medidor": "189*****",
         "servicio": "7721*****",
@@ -240,13 +265,13 @@ PROCEDIMIENTO = [
     (23, "Generación de Cupones", False),
     (24, "Generación QR de Cupones", False),
     (25, "Impresión masiva en papel", False),
-    (26, "Impresión masiva en PDF", False),
+    (26, "Impresión masiva en PDF", True),
     (27, "Publicación PDF en Oficina Virtual", False),
-    (28, "Envío PDF por mail", False),
-    (29, "Envío archivos RIPSA", False),
-    (30, "Envío archivos BANELCO", False),
-    (31, "Envío archivos LINK", False),
-    (32, "Envío archivos DÉBITOS VISA", False),
+    (28, "Envío PDF por mail", True),
+    (29, "Envío archivos RIPSA (preliminar: layout sin confirmar)", False),
+    (30, "Envío archivos BANELCO (preliminar: layout sin confirmar)", False),
+    (31, "Envío archivos LINK (preliminar: layout sin confirmar)", False),
+    (32, "Envío archivos DÉBITOS VISA (preliminar: layout sin confirmar)", False),
     (33, "Envío archivos Mercado Pago", False),
     (34, "Envío archivos Botón Macro", False),
     (35, "Envío facturas Municipalidad", False),
@@ -260,87 +285,6 @@ PROCEDIMIENTO = [
 ]
 
 
-# ============================================
-# MOTOR DE FACTURACIÓN
-# ============================================
-
-def obtener_escalon(tarifa: str, kwh: int, tarifas: dict) -> dict:
-    """Obtiene el escalón correspondiente según tarifa y consumo."""
-    escalones = tarifas[tarifa]["escalones"]
-    for e in escalones:
-        if e["desde"] <= kwh < e["hasta"]:
-            return e
-    return escalones[-1]
-
-
-def calcular_factura(tarifa: str, kwh: int, iva_rate: float, tarifas: dict,
-                     zona_alumbrado: int = 1) -> dict:
-    """Calcula todos los componentes de una factura eléctrica."""
-    escalon = obtener_escalon(tarifa, kwh, tarifas)
-
-    # Energía
-    cargo_fijo = escalon["cargo_fijo"]
-    cargo_variable = kwh * escalon["cargo_variable"]
-    ctt = kwh * CTT_POR_KWH.get(tarifa, 0)
-    subtotal_energia = cargo_fijo + cargo_variable + ctt
-
-    # Impuestos (sobre subtotal energía)
-    iva = subtotal_energia * iva_rate
-    ley_7290 = subtotal_energia * 0.04
-    art_75 = subtotal_energia * 0.06
-    art_72bis = subtotal_energia * 0.00001
-    fondo = subtotal_energia * 0.055
-    subtotal_leyes = iva + ley_7290 + art_75 + art_72bis + fondo
-
-    # Alumbrado
-    alumbrado = ALUMBRADO_PUBLICO.get(zona_alumbrado, 14000.00)
-
-    # Total Liquidación Servicios Públicos
-    total = subtotal_energia + subtotal_leyes + alumbrado
-
-    # Otros conceptos (punto de venta aparte)
-    res_asamblea = subtotal_energia * OTROS_CONCEPTOS_PORCENTAJE_RES_ASAM
-    total_otros = res_asamblea + BOMBEROS
-
-    iva_label = "Monotributo IVA 27%" if iva_rate == 0.27 else f"I.V.A. {iva_rate*100:.0f}%"
-
-    return {
-        "escalon": escalon,
-        "desglose": [
-            {"concepto": f"Cargo Fijo {tarifa} ({escalon['nombre']})", "importe": cargo_fijo, "tipo": "energia"},
-            {"concepto": f"Cargo Variable {tarifa} ({kwh} kWh x ${escalon['cargo_variable']:.4f})", "importe": cargo_variable, "tipo": "energia"},
-            {"concepto": f"CTT Art 5° Resol 2019-189 ({kwh} x {CTT_POR_KWH.get(tarifa, 0):.4f})", "importe": ctt, "tipo": "energia"},
-            {"concepto": "Subtotal Energía", "importe": subtotal_energia, "tipo": "subtotal"},
-            {"concepto": iva_label, "importe": iva, "tipo": "ley"},
-            {"concepto": "Ley Provincial 7290", "importe": ley_7290, "tipo": "ley"},
-            {"concepto": "Ley 11769 Art 75 (6%- Ex.9226)", "importe": art_75, "tipo": "ley"},
-            {"concepto": "Ley 11769 art.72 Bis (0,001%)", "importe": art_72bis, "tipo": "ley"},
-            {"concepto": "Ley 11769 Fondo Compensador", "importe": fondo, "tipo": "ley"},
-            {"concepto": "Subtotal Leyes", "importe": subtotal_leyes, "tipo": "subtotal"},
-            {"concepto": "Alumbrado Público ord 2945/23", "importe": alumbrado, "tipo": "otro"},
-        ],
-        "otros_conceptos": [
-            {"concepto": "Res. Asam 21/10/15", "importe": res_asamblea},
-            {"concepto": "Bomberos", "importe": BOMBEROS},
-            {"concepto": "TOTAL", "importe": total_otros},
-        ],
-        "resumen": {
-            "subtotal_energia": subtotal_energia,
-            "iva": iva,
-            "subtotal_leyes": subtotal_leyes,
-            "alumbrado": alumbrado,
-            "total": total,
-            "otros_conceptos": total_otros,
-            "total_general": total + total_otros,
-        },
-    }
-
-
-def fmt(valor: float) -> str:
-    """Formatea como moneda argentina."""
-    return f"${valor:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
-
-
 # ============================================
 # SESSION STATE
 # ============================================
@@ -349,17 +293,57 @@ def init_state():
     defaults = {
         'paso': 1,
         'datos_oceba': None,
+        'cuadros_segmento': None,
+        'tarifas_propias': False,
         'datos_validados': False,
         'resultados_facturacion': None,
+        'resultados_propios': False,
+        'recalcular_facturacion': False,
+        'cuadros_facturacion': None,
+        'dependencias_facturacion': None,
+        'totales_facturacion': None,
+        'agregados_facturacion': None,
+        'estadisticas_rutas': None,
+        'pdfs_facturas': None,
+        'archivos_cobranza': None,
+        'trazas': [],
     }
     for k, v in defaults.items():
         if k not in st.session_state:
             st.session_state[k] = v
+    if 'padron' not in st.session_state:
+        st.session_state.padron = padron_desde_clientes(CLIENTES)
 
 def ir_a_paso(n):
     st.session_state.paso = n
 
 
+def guardar_traza(t: Traza):
+    """
+    Agrega la traza de esta ejecución al principio de las guardadas. Una
+    ejecución que solo dibujó el paso reemplaza a la anterior si esa también
+    solo dibujó el mismo paso, así las que extrajeron o facturaron no se
+    pierden entre las interacciones que siguen.
+    """
+    trazas = st.session_state.trazas
+    solo_render = len(t.spans) <= 1
+    if (solo_render and trazas and len(trazas[0].spans) <= 1
+            and trazas[0].nombre == t.nombre):
+        trazas = trazas[1:]
+    st.session_state.trazas = [t, *trazas][:MAX_TRAZAS]
+
+
+def iniciar_metricas() -> str:
+    """Levanta el endpoint de métricas (una vez por proceso); devuelve su estado."""
+    if not METRICAS_PUERTO:
+        return ""
+    try:
+        servir_metricas(int(METRICAS_PUERTO))
+    except (OSError, ValueError) as e:
+        return f"Endpoint de métricas no disponible (puerto {METRICAS_PUERTO}): {e}"
+    return f"Prometheus: http://<host>:{METRICAS_PUERTO}/metrics (JSON en /metrics.json)"
+
+
 # ============================================
 # COMPONENTES UI
 # ============================================
@@ -417,8 +401,9 @@ def render_sidebar():
                     st.markdown(f":white_circle: {num}. {desc}")
 
         st.divider()
-        st.caption("Pasos automatizados: 3, 7, 8, 11, 14, 16, 20")
-        st.caption("Próximos: 23-28 (generación y distribución), 29-34 (medios de pago)")
+        st.caption("Pasos automatizados: 3, 7, 8, 11, 14, 16, 20, 26, 28")
+        st.caption("Preliminares: 29-32 (archivos de cobranza, layouts sin confirmar con cada canal)")
+        st.caption("Próximos: 23-25, 27 (generación y distribución), 33-34 (medios de pago)")
 
         st.divider()
         if st.session_state.datos_oceba:
@@ -427,6 +412,60 @@ def render_sidebar():
             for cod, tar in d['tarifas'].items():
                 st.caption(f"{cod}: {len(tar['escalones'])} escalones")
 
+        with st.expander("Cache compartida"):
+            for cache in (EXTRACCIONES, CORRIDAS):
+                e = cache.estadisticas()
+                st.caption(f"{cache.nombre.capitalize()}: {e['entradas']}/{e['max_entradas']} "
+                           f"entradas, {e['aciertos']} aciertos, {e['fallos']} cálculos")
+            if st.button("Vaciar cache compartida", key="btn_vaciar_cache"):
+                vaciar_caches()
+                st.rerun()
+
+        with st.expander("Rendimiento"):
+            _render_rendimiento()
+
+
+def _tabla_traza(t: Traza) -> pd.DataFrame:
+    """Desglose de una traza: una fila por span, sangrada según el anidamiento."""
+    total = t.segundos() or 1.0
+    filas = []
+    for s in t.desglose():
+        etiquetas = ", ".join(f"{k}={v}" for k, v in s.etiquetas.items())
+        filas.append({
+            "Etapa": "\u2003" * s.nivel + s.nombre + (f" ({etiquetas})" if etiquetas else ""),
+            "ms": round(s.segundos * 1000, 1),
+            "%": round(s.segundos / total * 100, 1),
+        })
+    return pd.DataFrame(filas, columns=["Etapa", "ms", "%"])
+
+
+def _render_rendimiento():
+    """Desglose de las últimas ejecuciones y exportación de las métricas del proceso."""
+    trazas = {t.creada: t for t in st.session_state.trazas}
+    if trazas:
+        def etiqueta(c):
+            t = trazas[c] if c is not None else st.session_state.trazas[0]
+            texto = f"{datetime.datetime.fromtimestamp(t.creada):%H:%M:%S} · {t.nombre} · {t.segundos() * 1000:.0f} ms"
+            return f"Última ({texto})" if c is None else texto
+
+        # None sigue siempre a la última ejecución; una elegida queda fija
+        creada = st.selectbox("Ejecución", [None, *trazas], key="sel_traza", format_func=etiqueta)
+        t = trazas[creada] if creada is not None else st.session_state.trazas[0]
+        st.dataframe(_tabla_traza(t), hide_index=True, use_container_width=True)
+        st.caption("Las rutas facturadas en el pool de procesos muestran solo su duración total.")
+    else:
+        st.caption("Sin ejecuciones medidas todavía.")
+
+    c1, c2 = st.columns(2)
+    c1.download_button("Prometheus", REGISTRO.prometheus(), file_name="coema_metricas.prom",
+                       mime="text/plain", key="dl_metricas_prom", use_container_width=True)
+    c2.download_button("JSON", json.dumps(REGISTRO.json(), indent=2, ensure_ascii=False),
+                       file_name="coema_metricas.json", mime="application/json",
+                       key="dl_metricas_json", use_container_width=True)
+    st.caption("Histogramas con buckets acumulados (le), en los dos formatos.")
+    if ESTADO_METRICAS:
+        st.caption(ESTADO_METRICAS)
+
 
 def render_navegacion(puede_avanzar: bool = True):
     """Botones de navegación Anterior/Siguiente."""
@@ -478,7 +517,7 @@ def render_paso_1():
                 try:
                     with st.spinner("Descargando PDF desde OCEBA..."):
                         time.sleep(0.5)
-                        data = extract_tariffs_from_url(pdf_url)
+                        data = _compartir_extraccion(extract_tariffs_from_url(pdf_url))
                     _mostrar_resultado_extraccion(data, f"Descargado desde: {pdf_url}")
                 except Exception as e:
                     st.error(f"No se pudo descargar el PDF: {e}")
@@ -492,10 +531,17 @@ def render_paso_1():
             help="PDFs de cuadros tarifarios descargados de oceba.gba.gov.ar",
         )
         if uploaded:
-            with st.spinner("Extrayendo datos del PDF..."):
-                time.sleep(0.5)
-                data = extract_tariffs_from_bytes(uploaded.read())
-            _mostrar_resultado_extraccion(data, f"Archivo: {uploaded.name}")
+            try:
+                with st.spinner("Extrayendo datos del PDF..."):
+                    time.sleep(0.5)
+                    pdf_bytes = uploaded.getvalue()
+                    data = EXTRACCIONES.obtener_o_calcular(
+                        (TariffCache.key(pdf_bytes), None),
+                        lambda: extract_tariffs_from_bytes(pdf_bytes),
+                    )
+                _mostrar_resultado_extraccion(data, f"Archivo: {uploaded.name}")
+            except ExtractionMemoryError as e:
+                st.error(f"El PDF supera el límite de memoria de extracción: {e}")
 
     # --- TAB 3: USAR PDF DE EJEMPLO ---
     with tab_example:
@@ -508,17 +554,70 @@ def render_paso_1():
         if st.button("Extraer datos del PDF", type="primary", key="btn_example"):
             pdf_path = PDF_EXAMPLES[selected]
             if os.path.exists(pdf_path):
-                with st.spinner("Extrayendo datos del PDF..."):
-                    time.sleep(0.5)
-                    data = extract_tariffs_from_pdf(pdf_path)
-                _mostrar_resultado_extraccion(data, f"Archivo: {os.path.basename(pdf_path)}")
+                try:
+                    with st.spinner("Extrayendo datos del PDF..."):
+                        time.sleep(0.5)
+                        with open(pdf_path, "rb") as f:
+                            clave = (TariffCache.key(f.read()), os.path.basename(pdf_path))
+                        data = EXTRACCIONES.obtener_o_calcular(
+                            clave, lambda: extract_tariffs_from_pdf(pdf_path))
+                    _mostrar_resultado_extraccion(data, f"Archivo: {os.path.basename(pdf_path)}")
+                except ExtractionMemoryError as e:
+                    st.error(f"El PDF supera el límite de memoria de extracción: {e}")
             else:
                 st.error(f"No se encontró el archivo: {pdf_path}")
 
+        st.markdown("Para facturar cada socio con el cuadro de su segmentación:")
+        if st.button("Extraer los tres Anexos (N1/N2/N3)", key="btn_anexos"):
+            with st.spinner("Extrayendo Anexos 6, 14 y 104..."):
+                cuadros = _extraer_anexos(list(PDF_EXAMPLES.values()))
+            if cuadros:
+                # El de N1 (precio completo) es el que se valida en Paso 2
+                principal = cuadros.get('N1') or next(iter(cuadros.values()))
+                _mostrar_resultado_extraccion(principal, "Cuadro base para la validación")
+                st.session_state.cuadros_segmento = cuadros
+                st.dataframe(pd.DataFrame([{
+                    "Nivel": nivel, "Anexo": d['anexo'], "Tarifas": ", ".join(d['tarifas']),
+                    "Bonificaciones": len(d.get('bonificaciones_t1r_tramos', [])),
+                } for nivel, d in sorted(cuadros.items())]), hide_index=True, use_container_width=True)
+
     puede_avanzar = st.session_state.datos_oceba is not None
     render_navegacion(puede_avanzar)
 
 
+def _extraer_anexos(paths: List[str]) -> Dict[str, dict]:
+    """
+    Extrae varios PDFs de una vez: los que ya están en la cache compartida
+    se toman de ahí y el resto se extrae en paralelo. Devuelve nivel -> datos.
+    """
+    claves = {}
+    for path in paths:
+        if not os.path.exists(path):
+            st.error(f"No se encontró el archivo: {path}")
+            continue
+        with open(path, "rb") as f:
+            claves[path] = (TariffCache.key(f.read()), os.path.basename(path))
+    datos = {path: EXTRACCIONES.obtener(clave) for path, clave in claves.items()}
+    faltan = [path for path, d in datos.items() if d is None]
+    for path, data in zip(faltan, extract_tariffs_from_pdfs(faltan)):
+        if isinstance(data, Exception):
+            st.error(f"No se pudo extraer {os.path.basename(path)}: {data}")
+            datos.pop(path)
+        else:
+            datos[path] = EXTRACCIONES.guardar(claves[path], data)
+    return {d['nivel']: d for d in datos.values() if d.get('tarifas')}
+
+
+def _compartir_extraccion(data: dict) -> dict:
+    """
+    Resultado de una descarga por URL: la descarga ya se revalida con la
+    cache de extracción, acá solo se comparte el objeto si otra sesión
+    tiene uno con el mismo contenido.
+    """
+    contenido = json.dumps(data, sort_keys=True, default=str).encode()
+    return EXTRACCIONES.guardar(("url", TariffCache.key(contenido)), data)
+
+
 def _mostrar_resultado_extraccion(data: dict, fuente: str = ""):
     """Muestra resultados de extracción y guarda en session state."""
     if not data.get('tarifas'):
@@ -527,6 +626,8 @@ def _mostrar_resultado_extraccion(data: dict, fuente: str = ""):
         return
 
     st.session_state.datos_oceba = data
+    st.session_state.cuadros_segmento = None
+    st.session_state.tarifas_propias = False
     st.session_state.datos_validados = False
     st.session_state.resultados_facturacion = None
 
@@ -536,6 +637,8 @@ def _mostrar_resultado_extraccion(data: dict, fuente: str = ""):
     )
     if fuente:
         st.caption(fuente)
+    if data.get('memoria_pico') is not None:
+        st.caption(f"Memoria pico de la extracción: {data['memoria_pico'] / 2**20:.1f} MiB")
 
     for cod, tarifa in data['tarifas'].items():
         st.subheader(f"{cod} - {tarifa['nombre']} ({len(tarifa['escalones'])} escalones)")
@@ -567,6 +670,10 @@ def render_paso_2():
     st.markdown(f"Comparando **Anexo {data['anexo']} ({data['nivel']})** "
                 "con los valores de la resolución anterior. "
                 "Puede editar los valores de Cargo Fijo y Cargo Variable si detecta algún error.")
+    vigencia = st.date_input("Vigente desde", value=datetime.date.today().replace(day=1),
+                             key="vigencia_cuadro",
+                             help="Al confirmar, el cuadro se guarda en el historial con esta fecha")
+    historial = historial_tarifas()
 
     # --- Comparación y edición por tarifa ---
     edited_tarifas = {}
@@ -574,7 +681,13 @@ def render_paso_2():
         if cod not in data['tarifas']:
             continue
         nuevos = data['tarifas'][cod]['escalones']
-        anteriores = TARIFAS_ANTERIORES.get(cod, {}).get('escalones', [])
+        anterior = historial.anterior(cod, data['anexo'], vigencia)
+        if anterior is not None:
+            titulo_comparacion = f"Ver comparación con el cuadro vigente desde {anterior['vigencia']}"
+        else:
+            anterior = TARIFAS_ANTERIORES.get(cod, {})
+            titulo_comparacion = "Ver comparación con resolución anterior"
+        anteriores = anterior.get('escalones', [])
         ant_map = {e['num']: e for e in anteriores}
 
         st.subheader(f"{cod} - {data['tarifas'][cod]['nombre']}")
@@ -583,7 +696,7 @@ def render_paso_2():
             st.info(f"Cantidad de escalones cambió: {len(anteriores)} :arrow_right: {len(nuevos)}")
 
         # Comparación con anterior (read-only, en expander)
-        with st.expander("Ver comparación con resolución anterior", expanded=False):
+        with st.expander(titulo_comparacion, expanded=False):
             comp_rows = []
             for e in nuevos:
                 ant = ant_map.get(e['num'])
@@ -611,6 +724,16 @@ def render_paso_2():
                     })
             st.dataframe(pd.DataFrame(comp_rows), hide_index=True, use_container_width=True)
 
+        # Evolución de los cargos en el historial (cargado con cargar_historial.py)
+        serie = historial.serie(data['anexo'], cod)
+        if serie['vigencia'].nunique() > 1:
+            with st.expander(f"Ver serie histórica ({serie['vigencia'].nunique()} cuadros)", expanded=False):
+                fig = px.line(serie, x="vigencia", y="cargo_variable", color="nombre", markers=True,
+                              labels={"vigencia": "Vigencia", "cargo_variable": "Cargo Variable ($/kWh)",
+                                      "nombre": "Escalón"})
+                fig.update_layout(height=300)
+                st.plotly_chart(fig, use_container_width=True)
+
         # Tabla editable con valores extraídos
         edit_rows = []
         for e in nuevos:
@@ -653,18 +776,65 @@ def render_paso_2():
     if st.button(":white_check_mark: Confirmar y aplicar cuadro tarifario", type="primary",
                  use_container_width=True):
         # Aplicar valores editados al session state
+        cambios = []
         for cod, edited_df in edited_tarifas.items():
             escalones = data['tarifas'][cod]['escalones']
             for i, row in edited_df.iterrows():
-                escalones[i]['cargo_fijo'] = row['Cargo Fijo ($/mes)']
-                escalones[i]['cargo_variable'] = row['Cargo Variable ($/kWh)']
+                cargo_fijo, cargo_variable = row['Cargo Fijo ($/mes)'], row['Cargo Variable ($/kWh)']
+                if (cargo_fijo, cargo_variable) != (escalones[i]['cargo_fijo'], escalones[i]['cargo_variable']):
+                    cambios.append((cod, i, cargo_fijo, cargo_variable))
+        if cambios and not st.session_state.tarifas_propias:
+            # El cuadro es el de la cache compartida: se edita una copia de la sesión
+            data = copy.deepcopy(data)
+            st.session_state.datos_oceba = data
+            st.session_state.tarifas_propias = True
+        for cod, i, cargo_fijo, cargo_variable in cambios:
+            escalon = data['tarifas'][cod]['escalones'][i]
+            escalon['cargo_fijo'] = cargo_fijo
+            escalon['cargo_variable'] = cargo_variable
+        editados = [(cod, i) for cod, i, _, _ in cambios]
+        recompilar_indices(data['tarifas'])
+        try:
+            historial.guardar(data, vigencia, origen=data.get('archivo') or data.get('url'))
+        except sqlite3.Error as e:
+            st.warning(f"No se pudo guardar el cuadro en el historial: {e}")
         st.session_state.datos_validados = True
-        st.session_state.resultados_facturacion = None
+        _refacturar_editados(editados, data['tarifas'])
         st.success("Cuadro tarifario validado y aplicado.")
 
     render_navegacion(st.session_state.datos_validados)
 
 
+def _refacturar_editados(editados: List[tuple], tarifas: dict):
+    """
+    Si ya había una facturación, recalcula solo los servicios de los
+    escalones editados y corrige los totales en lugar de descartarla.
+    """
+    resultados = st.session_state.resultados_facturacion
+    if resultados is None or not editados:
+        return
+    if not st.session_state.resultados_propios:
+        # La corrida es la de la cache compartida: se corrige una copia de la sesión
+        resultados = resultados.copy()
+        st.session_state.resultados_facturacion = resultados
+        st.session_state.totales_facturacion = dict(st.session_state.totales_facturacion)
+        st.session_state.resultados_propios = True
+    try:
+        n = refacturar_escalones(
+            resultados, st.session_state.padron.servicios, tarifas, editados,
+            indice=st.session_state.dependencias_facturacion,
+            totales=st.session_state.totales_facturacion,
+        )
+    except ValueError:
+        st.session_state.resultados_facturacion = None
+        return
+    if n:
+        st.session_state.agregados_facturacion = agregados_facturacion(resultados, tarifas)
+        st.session_state.pdfs_facturas = None
+        st.session_state.archivos_cobranza = None
+        st.info(f"{n} facturas recalculadas ({len(editados)} escalones editados).")
+
+
 # ============================================
 # PASO 3: PADRÓN DE SOCIOS
 # ============================================
@@ -680,36 +850,54 @@ def render_paso_3():
     st.markdown("Socios cargados para el período de facturación. "
                 "En producción, estos datos vienen del sistema de lecturas (SgiMovil).")
 
+    with st.expander("Cargar exportación de lecturas SgiMovil"):
+        st.caption("CSV con encabezado o archivo de ancho fijo (.txt), una fila por servicio y período.")
+        archivo = st.file_uploader("Exportación SgiMovil", type=["csv", "txt"], key="upload_sgimovil")
+        c1, c2 = st.columns(2)
+        if archivo and c1.button("Cargar padrón", type="primary", use_container_width=True):
+            formato = "fwf" if archivo.name.lower().endswith(".txt") else "csv"
+            try:
+                with st.spinner("Leyendo exportación..."):
+                    st.session_state.padron = cargar_sgimovil(archivo, formato=formato)
+                st.session_state.resultados_facturacion = None
+            except (ValueError, KeyError) as e:
+                st.error(f"No se pudo leer la exportación: {e}")
+        if c2.button("Usar padrón demo", use_container_width=True):
+            st.session_state.padron = padron_desde_clientes(CLIENTES)
+            st.session_state.resultados_facturacion = None
+
+    padron = st.session_state.padron
+    servicios = padron.servicios
     tarifas = st.session_state.datos_oceba['tarifas']
 
-    rows = []
-    for cid, c in CLIENTES.items():
-        escalon = obtener_escalon(c['tarifa'], c['consumo_kwh'], tarifas) if c['tarifa'] in tarifas else None
-        rows.append({
-            "Socio": cid,
-            "Nombre": c['nombre'],
-            "Tarifa": c['tarifa'],
-            "Segm.": c['segmentacion'],
-            "Cond. IVA": c['condicion_iva'],
-            "Consumo kWh": c['consumo_kwh'],
-            "Escalón": escalon['nombre'] if escalon else "N/A",
-            "Medidor": c['medidor'],
-        })
-
-    st.dataframe(pd.DataFrame(rows), hide_index=True, use_container_width=True)
+    st.dataframe(pd.DataFrame({
+        "Socio": servicios.index,
+        "Nombre": servicios['nombre'].to_numpy(),
+        "Tarifa": servicios['tarifa'].to_numpy(),
+        "Segm.": servicios['segmentacion'].to_numpy(),
+        "Ruta": servicios['ruta'].to_numpy(),
+        "Cond. IVA": servicios['condicion_iva'].to_numpy(),
+        "Consumo kWh": servicios['consumo_kwh'].to_numpy(),
+        "Escalón": escalones_lote(servicios['tarifa'], servicios['consumo_kwh'], tarifas),
+        "Medidor": servicios['medidor'].to_numpy(),
+    }), hide_index=True, use_container_width=True)
 
     # Resumen
     c1, c2, c3, c4 = st.columns(4)
-    total_socios = len(CLIENTES)
-    t1r_count = sum(1 for c in CLIENTES.values() if c['tarifa'] == 'T1R')
-    t1re_count = sum(1 for c in CLIENTES.values() if c['tarifa'] == 'T1RE')
-    avg_kwh = sum(c['consumo_kwh'] for c in CLIENTES.values()) / total_socios
+    total_socios = len(servicios)
+    t1r_count = int((servicios['tarifa'] == 'T1R').sum())
+    t1re_count = int((servicios['tarifa'] == 'T1RE').sum())
+    avg_kwh = servicios['consumo_kwh'].mean() if total_socios else 0
 
     c1.metric("Total Socios", total_socios)
     c2.metric("T1R", t1r_count)
     c3.metric("T1RE", t1re_count)
     c4.metric("Consumo Promedio", f"{avg_kwh:.0f} kWh")
 
+    st.caption(f"Período {padron.periodo} · {servicios['ruta'].nunique()} rutas de lectura.")
+    if padron.sin_lectura:
+        st.warning(f"{len(padron.sin_lectura)} servicios sin lectura en el período {padron.periodo} "
+                   "(no se facturan).")
     st.caption("En producción: ~10.000 servicios en 29-30 rutas de lectura.")
 
     render_navegacion(True)
@@ -732,39 +920,83 @@ def render_paso_4():
     # Calcular si aún no se hizo
     if st.session_state.resultados_facturacion is None:
         if st.button("Generar Facturación", type="primary", use_container_width=True):
-            resultados = {}
-            progress = st.progress(0, text="Calculando facturas...")
-            clientes_list = list(CLIENTES.items())
-            for i, (cid, c) in enumerate(clientes_list):
-                if c['tarifa'] in tarifas:
-                    f = calcular_factura(
-                        tarifa=c['tarifa'],
-                        kwh=c['consumo_kwh'],
-                        iva_rate=c['iva'],
-                        tarifas=tarifas,
-                        zona_alumbrado=c['zona_alumbrado'],
-                    )
-                    resultados[cid] = f
-                progress.progress((i + 1) / len(clientes_list),
-                                  text=f"Calculando {c['nombre']}...")
-                time.sleep(0.3)  # efecto demo
-            progress.empty()
-            st.session_state.resultados_facturacion = resultados
+            padron_socios = st.session_state.padron
+            servicios = padron_socios.servicios
+            columnas = COLUMNAS_PADRON
+            cuadros = None
+            if st.session_state.cuadros_segmento and COLUMNA_SEGMENTO in servicios:
+                # El cuadro validado en Paso 2 reemplaza al extraído de su nivel
+                data = st.session_state.datos_oceba
+                try:
+                    cuadros = cuadros_por_segmento(
+                        tarifas, {**st.session_state.cuadros_segmento, data['nivel']: data})
+                except ValueError as e:
+                    st.error(str(e))
+                    return
+                columnas = COLUMNAS_PADRON + [COLUMNA_SEGMENTO]
+            padron = servicios.loc[servicios['tarifa'].isin(list(tarifas)), columnas]
+            n_rutas = padron['ruta'].nunique()
+
+            def facturar():
+                progress = st.progress(0, text=f"Facturando {len(padron)} servicios en {n_rutas} rutas...")
+                terminadas = []
+
+                def al_terminar_ruta(stats):
+                    terminadas.append(stats['ruta'])
+                    progress.progress(len(terminadas) / n_rutas,
+                                      text=f"Ruta {stats['ruta']} lista ({stats['servicios']} servicios)")
+                    time.sleep(0.3)  # efecto demo
+
+                resultados, estadisticas = facturar_por_rutas(
+                    padron, tarifas,
+                    directorio_checkpoints=CHECKPOINTS_DIR,
+                    al_terminar_ruta=al_terminar_ruta,
+                    cuadros=cuadros,
+                    reusar_checkpoints=not st.session_state.recalcular_facturacion,
+                )
+                progress.empty()
+                return {
+                    'cuadros': cuadros,
+                    'resultados': resultados,
+                    'estadisticas': estadisticas,
+                    'dependencias': indice_dependencias(resultados),
+                    'totales': totales_facturacion(resultados),
+                    'agregados': agregados_facturacion(resultados, tarifas),
+                }
+
+            # Otra sesión con el mismo cuadro y el mismo padrón comparte la corrida
+            clave = (huella_tarifas(tarifas if cuadros is None else [tarifas, cuadros]),
+                     padron_socios.version)
+            if st.session_state.recalcular_facturacion:
+                # "Recalcular" no reusa la corrida compartida ni los checkpoints
+                CORRIDAS.descartar(clave)
+            corrida = CORRIDAS.obtener_o_calcular(clave, facturar)
+            st.session_state.recalcular_facturacion = False
+            st.session_state.estadisticas_rutas = corrida['estadisticas']
+            st.session_state.pdfs_facturas = None
+            st.session_state.archivos_cobranza = None
+            st.session_state.resultados_facturacion = corrida['resultados']
+            st.session_state.cuadros_facturacion = corrida['cuadros']
+            st.session_state.resultados_propios = False
+            st.session_state.dependencias_facturacion = corrida['dependencias']
+            st.session_state.totales_facturacion = corrida['totales']
+            st.session_state.agregados_facturacion = corrida['agregados']
             st.rerun()
         return
 
     resultados = st.session_state.resultados_facturacion
 
     # Métricas resumen
-    total_facturado = sum(r['resumen']['total'] for r in resultados.values())
-    total_otros = sum(r['resumen']['otros_conceptos'] for r in resultados.values())
-    total_general = sum(r['resumen']['total_general'] for r in resultados.values())
+    totales = st.session_state.totales_facturacion
+    total_facturado = totales['total']
+    total_otros = totales['otros_conceptos']
+    total_general = totales['total_general']
 
     c1, c2, c3, c4 = st.columns(4)
     c1.metric("Socios Facturados", len(resultados))
-    c2.metric("Total Liq. Serv. Púb.", fmt(total_facturado))
-    c3.metric("Total Otros Conceptos", fmt(total_otros))
-    c4.metric("Total General", fmt(total_general))
+    c2.metric("Total Liq. Serv. Púb.", fmt_centavos(total_facturado))
+    c3.metric("Total Otros Conceptos", fmt_centavos(total_otros))
+    c4.metric("Total General", fmt_centavos(total_general))
 
     # Tabs para distintas vistas
     tab_resumen, tab_detalle, tab_simulador, tab_comparador = st.tabs([
@@ -780,68 +1012,148 @@ def render_paso_4():
     with tab_comparador:
         _render_comparador(tarifas)
 
+    estadisticas = st.session_state.estadisticas_rutas
+    if estadisticas is not None and len(estadisticas):
+        with st.expander("Rendimiento por ruta"):
+            st.dataframe(
+                estadisticas.rename(columns={
+                    "ruta": "Ruta", "servicios": "Servicios", "segundos": "Segundos",
+                    "servicios_por_seg": "Servicios/seg", "origen": "Origen",
+                }),
+                hide_index=True, use_container_width=True,
+            )
+
+    _render_pdfs(resultados, tarifas)
+    _render_cobranza(resultados)
+
     # Navegación
     st.divider()
     c1, _, c3 = st.columns([1, 2, 1])
     c1.button(":arrow_left: Anterior", on_click=ir_a_paso, args=(3,), use_container_width=True)
     if c3.button(":arrows_counterclockwise: Recalcular", use_container_width=True):
         st.session_state.resultados_facturacion = None
+        st.session_state.recalcular_facturacion = True
         st.rerun()
 
 
-def _render_resumen(resultados: dict, tarifas: dict):
+GRILLA_COLUMNAS_IMPORTES = {
+    "Subtotal Energía": "subtotal_energia",
+    "Leyes + IVA": "subtotal_leyes",
+    "Alumbrado": "alumbrado",
+    "Total": "total",
+    "Otros": "otros_conceptos",
+    "Total General": "total_general",
+}
+GRILLA_ORDEN = {
+    "Socio": None, "Ruta": "ruta", "Tarifa": "tarifa", "Escalón": "escalon",
+    "kWh": "kwh", "Total": "total", "Total General": "total_general",
+}
+GRILLA_FILAS_POR_PAGINA = [25, 50, 100, 250]
+
+
+def _posiciones_grilla(resultados: pd.DataFrame, tarifas: dict, rutas: list, tarifas_sel: list,
+                       escalones_sel: list, orden: str, descendente: bool) -> np.ndarray:
+    """Posiciones de resultados que pasan los filtros, en el orden pedido (sin copiar filas)."""
+    mascara = np.ones(len(resultados), dtype=bool)
+    if rutas:
+        mascara &= resultados["ruta"].isin(rutas).to_numpy()
+    if tarifas_sel:
+        mascara &= resultados["tarifa"].isin(tarifas_sel).to_numpy()
+    if escalones_sel:
+        tarifa = resultados["tarifa"].to_numpy()
+        escalon = resultados["escalon"].to_numpy()
+        por_escalon = np.zeros(len(resultados), dtype=bool)
+        for cod, datos in tarifas.items():
+            for i, e in enumerate(datos["escalones"]):
+                if e["nombre"] in escalones_sel:
+                    por_escalon |= (tarifa == cod) & (escalon == i)
+        mascara &= por_escalon
+    posiciones = np.flatnonzero(mascara)
+
+    columna = GRILLA_ORDEN[orden]
+    if columna is None:
+        clave = pd.to_numeric(resultados.index, errors="coerce")
+        if np.isnan(clave).any():
+            clave = pd.factorize(resultados.index, sort=True)[0]
+    elif columna == "escalon":
+        tarifa = pd.factorize(resultados["tarifa"], sort=True)[0]
+        clave = tarifa * (1 + int(resultados["escalon"].max())) + resultados["escalon"].to_numpy()
+    elif columna in ("ruta", "tarifa"):
+        clave = pd.factorize(resultados[columna], sort=True)[0]
+    else:
+        clave = resultados[columna].to_numpy()
+    clave = np.asarray(clave, dtype=np.int64)[posiciones]
+    return posiciones[np.argsort(-clave if descendente else clave, kind="stable")]
+
+
+def _render_grilla(resultados: pd.DataFrame, tarifas: dict):
+    """Tabla de resultados paginada: filtra y ordena posiciones, y arma solo la página visible."""
+    nombres_escalones = [e["nombre"] for t in tarifas.values() for e in t["escalones"]]
+    f1, f2, f3 = st.columns(3)
+    rutas = f1.multiselect("Ruta", sorted(pd.unique(resultados["ruta"])), key="grilla_rutas")
+    tarifas_sel = f2.multiselect("Tarifa", list(tarifas), key="grilla_tarifas")
+    escalones_sel = f3.multiselect("Escalón", nombres_escalones, key="grilla_escalones")
+    o1, o2, o3 = st.columns([2, 1, 1])
+    orden = o1.selectbox("Ordenar por", list(GRILLA_ORDEN), key="grilla_orden")
+    descendente = o2.toggle("Descendente", key="grilla_descendente")
+    por_pagina = o3.selectbox("Filas por página", GRILLA_FILAS_POR_PAGINA, key="grilla_por_pagina")
+
+    posiciones = _posiciones_grilla(resultados, tarifas, rutas, tarifas_sel, escalones_sel,
+                                    orden, descendente)
+    paginas = max(1, -(-len(posiciones) // por_pagina))
+    if st.session_state.get("grilla_pagina", 1) > paginas:
+        st.session_state.grilla_pagina = 1
+    p1, p2 = st.columns([1, 3])
+    pagina = p1.number_input("Página", min_value=1, max_value=paginas, step=1, key="grilla_pagina")
+    p2.caption(f"{len(posiciones):,} de {len(resultados):,} servicios · página {pagina} de {paginas}"
+               .replace(",", "."))
+
+    visibles = resultados.iloc[posiciones[(pagina - 1) * por_pagina:pagina * por_pagina]]
+    pagina_df = pd.DataFrame({
+        "Socio": visibles.index,
+        "Nombre": st.session_state.padron.servicios['nombre'].reindex(visibles.index).to_numpy(),
+        "Ruta": visibles['ruta'].to_numpy(),
+        "Tarifa": visibles['tarifa'].to_numpy(),
+        "kWh": visibles['kwh'].to_numpy(),
+        "Escalón": escalones_lote(visibles['tarifa'], visibles['kwh'], tarifas),
+        **{titulo: fmt_centavos_lote(visibles[col].to_numpy())
+           for titulo, col in GRILLA_COLUMNAS_IMPORTES.items()},
+    })
+    st.dataframe(pagina_df, hide_index=True, use_container_width=True)
+
+
+def _render_resumen(resultados: pd.DataFrame, tarifas: dict):
     """Resumen de facturación batch."""
     st.subheader("Resumen de Facturación")
 
-    rows = []
-    for cid, r in resultados.items():
-        c = CLIENTES[cid]
-        rows.append({
-            "Socio": cid,
-            "Nombre": c['nombre'],
-            "Tarifa": c['tarifa'],
-            "kWh": c['consumo_kwh'],
-            "Escalón": r['escalon']['nombre'],
-            "Subtotal Energía": r['resumen']['subtotal_energia'],
-            "Leyes + IVA": r['resumen']['subtotal_leyes'],
-            "Alumbrado": r['resumen']['alumbrado'],
-            "Total": r['resumen']['total'],
-            "Otros": r['resumen']['otros_conceptos'],
-            "Total General": r['resumen']['total_general'],
-        })
-
-    df = pd.DataFrame(rows)
-
-    currency_cols = ["Subtotal Energía", "Leyes + IVA", "Alumbrado", "Total", "Otros", "Total General"]
-    df_display = df.copy()
-    for col in currency_cols:
-        df_display[col] = df_display[col].apply(fmt)
+    _render_grilla(resultados, tarifas)
+    _render_graficos(st.session_state.agregados_facturacion)
 
-    st.dataframe(df_display, hide_index=True, use_container_width=True)
 
-    # Gráficos
+def _render_graficos(agregados: Dict[str, pd.DataFrame]):
+    """Gráficos de la corrida a partir de agregados_facturacion (tamaño fijo)."""
+    colores_tarifa = {"T1R": "#3498db", "T1RE": "#e74c3c"}
     c1, c2 = st.columns(2)
 
     with c1:
-        st.subheader("Total por Socio")
-        fig = px.bar(
-            df, x="Nombre", y="Total", color="Tarifa",
-            text_auto='.2s',
-            color_discrete_map={"T1R": "#3498db", "T1RE": "#e74c3c"},
-        )
-        fig.update_layout(yaxis_tickprefix="$", yaxis_tickformat=",.0f", height=350,
-                          showlegend=True)
+        st.subheader("Distribución del Total por Factura")
+        h = agregados["histograma"]
+        fig = go.Figure(data=[go.Bar(
+            x=(h["desde"] + h["hasta"]) / 2, y=h["servicios"], width=h["hasta"] - h["desde"],
+            marker_color="#3498db",
+            customdata=np.column_stack([h["desde"], h["hasta"]]),
+            hovertemplate="$%{customdata[0]:,.0f} - $%{customdata[1]:,.0f}<br>%{y} servicios<extra></extra>",
+        )])
+        fig.update_layout(xaxis_tickprefix="$", xaxis_tickformat=",.0f", yaxis_title="Servicios",
+                          height=350, bargap=0)
         st.plotly_chart(fig, use_container_width=True)
 
     with c2:
         st.subheader("Composición Promedio")
-        avg_energia = df["Subtotal Energía"].mean()
-        avg_leyes = df["Leyes + IVA"].mean()
-        avg_alumbrado = df["Alumbrado"].mean()
-
+        composicion = agregados["composicion"]
         fig = go.Figure(data=[go.Pie(
-            labels=["Energía", "Leyes (inc. IVA)", "Alumbrado"],
-            values=[avg_energia, avg_leyes, avg_alumbrado],
+            labels=composicion["concepto"],
+            values=a_pesos(composicion["centavos"].to_numpy()),
             hole=0.4,
             marker_colors=["#27ae60", "#3498db", "#9b59b6"],
             textinfo="label+percent",
@@ -849,19 +1161,42 @@ def _render_resumen(resultados: dict, tarifas: dict):
         fig.update_layout(height=350, showlegend=True)
         st.plotly_chart(fig, use_container_width=True)
 
+    c3, c4 = st.columns(2)
 
-def _render_detalle(resultados: dict, tarifas: dict):
+    with c3:
+        st.subheader("Total por Ruta")
+        por_ruta = agregados["por_ruta"].assign(
+            Ruta=lambda d: d["ruta"].astype(str), Total=lambda d: a_pesos(d["total"].to_numpy()))
+        fig = px.bar(por_ruta, x="Ruta", y="Total", hover_data={"servicios": True})
+        fig.update_layout(yaxis_tickprefix="$", yaxis_tickformat=",.0f", height=350)
+        st.plotly_chart(fig, use_container_width=True)
+
+    with c4:
+        st.subheader("Total por Escalón")
+        por_escalon = agregados["por_escalon"].assign(
+            Tarifa=lambda d: d["tarifa"].astype(str), Total=lambda d: a_pesos(d["total"].to_numpy()))
+        fig = px.bar(por_escalon, x="nombre", y="Total", color="Tarifa",
+                     hover_data={"servicios": True, "kwh": True},
+                     labels={"nombre": "Escalón"}, color_discrete_map=colores_tarifa)
+        fig.update_layout(yaxis_tickprefix="$", yaxis_tickformat=",.0f", height=350)
+        st.plotly_chart(fig, use_container_width=True)
+
+
+def _render_detalle(resultados: pd.DataFrame, tarifas: dict):
     """Detalle de factura individual."""
     st.subheader("Detalle de Factura")
 
+    padron = st.session_state.padron
+    servicios = padron.servicios
     cid = st.selectbox(
         "Seleccione socio",
-        options=list(resultados.keys()),
-        format_func=lambda x: f"Socio {x} - {CLIENTES[x]['nombre']} ({CLIENTES[x]['tarifa']})"
+        options=list(resultados.index),
+        format_func=lambda x: f"Socio {x} - {servicios.at[x, 'nombre']} ({servicios.at[x, 'tarifa']})"
     )
 
-    c = CLIENTES[cid]
-    f = resultados[cid]
+    c = servicios.loc[cid]
+    historial = padron.historial(cid)
+    f = detalle_factura(resultados.loc[cid], tarifas, st.session_state.cuadros_facturacion)
 
     st.info(f"""
     **Titular:** {c['nombre']} | **Tarifa:** {c['tarifa']} | **{c['condicion_iva']}** (IVA {c['iva']*100:.0f}%)
@@ -898,19 +1233,73 @@ def _render_detalle(resultados: dict, tarifas: dict):
 
     with col_hist:
         st.markdown("**Historial de Consumo**")
-        if c['historial']:
-            df_h = pd.DataFrame(c['historial'])
-            fig = px.bar(df_h, x="periodo", y="kwh", text="kwh",
+        if len(historial):
+            fig = px.bar(historial, x="periodo", y="kwh", text="kwh",
                          color_discrete_sequence=["#3498db"])
             fig.update_layout(height=250, showlegend=False,
                               xaxis_title="", yaxis_title="kWh")
             fig.update_traces(textposition="outside")
             st.plotly_chart(fig, use_container_width=True)
 
-            consumos = [h['kwh'] for h in c['historial']]
             mc1, mc2 = st.columns(2)
-            mc1.metric("Promedio", f"{sum(consumos)/len(consumos):.0f} kWh")
-            mc2.metric("Máximo", f"{max(consumos)} kWh")
+            mc1.metric("Promedio", f"{historial['kwh'].mean():.0f} kWh")
+            mc2.metric("Máximo", f"{historial['kwh'].max()} kWh")
+
+
+def _render_pdfs(resultados: pd.DataFrame, tarifas: dict):
+    """Impresión masiva: un PDF por ruta con todas sus facturas."""
+    padron = st.session_state.padron
+    with st.expander("Impresión masiva en PDF"):
+        if st.button("Generar PDFs por ruta", key="btn_pdfs", use_container_width=True):
+            with st.spinner(f"Generando {len(resultados)} facturas..."):
+                st.session_state.pdfs_facturas = renderizar_facturas(
+                    resultados, padron.servicios, tarifas, padron.periodo,
+                    directorio=FACTURAS_DIR, cuadros=st.session_state.cuadros_facturacion,
+                )
+
+        pdfs = st.session_state.pdfs_facturas
+        if pdfs is None or not len(pdfs):
+            st.caption(f"Los PDFs se guardan en {FACTURAS_DIR}")
+            return
+        st.caption(f"{int(pdfs['facturas'].sum())} facturas en {len(pdfs)} archivos "
+                   f"({pdfs['segundos'].sum():.1f} s)")
+        ruta = st.selectbox("Ruta", options=list(pdfs['ruta']), key="pdf_ruta")
+        archivo = pdfs.loc[pdfs['ruta'] == ruta, 'archivo'].iloc[0]
+        with open(archivo, "rb") as f:
+            st.download_button("Descargar PDF de la ruta", f.read(),
+                               file_name=os.path.basename(archivo), mime="application/pdf",
+                               use_container_width=True)
+
+
+def _render_cobranza(resultados: pd.DataFrame):
+    """Archivos de cobranza para los canales de pago (sin débitos: faltan las adhesiones)."""
+    padron = st.session_state.padron
+    with st.expander("Archivos de cobranza (RIPSA, BANELCO, LINK)"):
+        vencimiento = st.date_input("Primer vencimiento", key="cobranza_vencimiento")
+        preliminares = st.checkbox(
+            "Generar con layouts preliminares", key="cobranza_preliminares",
+            help="Los layouts todavía no se confirmaron contra la especificación de cada canal: "
+                 "los archivos salen marcados _preliminar y no deben enviarse al banco.")
+        if st.button("Generar archivos", key="btn_cobranza", use_container_width=True):
+            try:
+                st.session_state.archivos_cobranza = exportar_cobranza(
+                    resultados, padron.servicios, padron.periodo, vencimiento,
+                    directorio=COBRANZA_DIR, preliminares=preliminares,
+                )
+            except ValueError as e:
+                st.error(str(e))
+
+        archivos = st.session_state.archivos_cobranza
+        if archivos is None or not len(archivos):
+            st.caption(f"Los archivos se guardan en {COBRANZA_DIR}")
+            return
+        for fila in archivos.itertuples():
+            c1, c2 = st.columns([2, 1])
+            c1.markdown(f"**{fila.canal}**: {fila.registros} facturas, {fmt(fila.importe)}")
+            with open(fila.archivo, "rb") as f:
+                c2.download_button("Descargar", f.read(), file_name=os.path.basename(fila.archivo),
+                                   mime="text/plain", key=f"dl_cobranza_{fila.canal}",
+                                   use_container_width=True)
 
 
 def _render_simulador(tarifas: dict):
@@ -933,7 +1322,9 @@ def _render_simulador(tarifas: dict):
             format_func=lambda x: f"Monotributista ({x*100:.0f}%)" if x == 0.27 else f"Consumidor Final ({x*100:.0f}%)",
             key="sim_iva",
         )
-        rango = st.slider("Rango de consumo (kWh)", 0, 1000, (50, 500), 25, key="sim_rango")
+        rango = st.slider("Rango de consumo (kWh)", 0, 3000, (50, 500), 25, key="sim_rango")
+        paso = st.select_slider("Resolución (kWh)", options=[1, 5, 10, 25, 50, 100],
+                                value=25, key="sim_paso")
 
         st.markdown("**Escalones**")
         for e in tarifas[tarifa_sim]['escalones']:
@@ -941,30 +1332,26 @@ def _render_simulador(tarifas: dict):
             st.caption(f"**{e['nombre']}** ({e['desde']}-{hasta}): "
                        f"CF={fmt(e['cargo_fijo'])}, CV={fmt(e['cargo_variable'])}/kWh")
 
-    with c2:
-        consumos = list(range(rango[0], rango[1] + 1, 25))
-        totales = []
-        for c in consumos:
-            f = calcular_factura(tarifa_sim, c, iva_sim, tarifas)
-            totales.append(f['resumen']['total'])
+    curva = curva_factura(tarifa_sim, iva_sim, tarifas)
 
-        df_sim = pd.DataFrame({"Consumo (kWh)": consumos, "Total Factura": totales})
+    with c2:
+        consumos = np.arange(rango[0], rango[1] + 1, paso)
+        df_sim = pd.DataFrame({"Consumo (kWh)": consumos, "Total Factura": curva.total(consumos)})
 
         fig = px.line(df_sim, x="Consumo (kWh)", y="Total Factura",
                       title=f"Proyección de Factura - {tarifas[tarifa_sim]['nombre']}",
-                      markers=True)
+                      markers=len(consumos) <= 100)
         fig.update_layout(yaxis_tickprefix="$", yaxis_tickformat=",.0f", height=400)
         st.plotly_chart(fig, use_container_width=True)
 
         st.markdown("**Referencia rápida**")
         refs = [100, 200, 300, 400, 500]
         ref_data = []
-        for c in refs:
-            f = calcular_factura(tarifa_sim, c, iva_sim, tarifas)
+        for c, total in zip(refs, curva.total(refs)):
             ref_data.append({
                 "Consumo": f"{c} kWh",
-                "Total": fmt(f['resumen']['total']),
-                "$/kWh prom.": fmt(f['resumen']['total'] / c) if c > 0 else "-",
+                "Total": fmt(total),
+                "$/kWh prom.": fmt(total / c) if c > 0 else "-",
             })
         st.dataframe(pd.DataFrame(ref_data), hide_index=True, use_container_width=True)
 
@@ -1024,15 +1411,17 @@ def _render_comparador(tarifas: dict):
         st.plotly_chart(fig, use_container_width=True)
 
         # Comparación por rango
-        consumos_rango = list(range(50, 701, 50))
-        data_rango = []
-        for c in consumos_rango:
-            for t in available:
-                iva = 0.27 if t == "T1R" else 0.21
-                f = calcular_factura(t, c, iva, tarifas)
-                data_rango.append({"Consumo": c, "Tarifa": t, "Total": f['resumen']['total']})
-
-        fig2 = px.line(pd.DataFrame(data_rango), x="Consumo", y="Total",
+        consumos_rango = np.arange(50, 701, 50)
+        data_rango = pd.concat([
+            pd.DataFrame({
+                "Consumo": consumos_rango,
+                "Tarifa": t,
+                "Total": curva_factura(t, 0.27 if t == "T1R" else 0.21, tarifas).total(consumos_rango),
+            })
+            for t in available
+        ])
+
+        fig2 = px.line(data_rango, x="Consumo", y="Total",
                        color="Tarifa", markers=True,
                        color_discrete_map={"T1R": "#3498db", "T1RE": "#e74c3c"})
         fig2.update_layout(yaxis_tickprefix="$", yaxis_tickformat=",.0f",
@@ -1051,6 +1440,7 @@ st.set_page_config(
 )
 
 init_state()
+ESTADO_METRICAS = iniciar_metricas()
 
 # Header
 st.title("⚡ COEMA - Motor de Facturación Eléctrica")
@@ -1060,18 +1450,20 @@ st.caption("Cooperativa de Provisión de Energía Eléctrica y Otros Servicios d
 render_stepper(st.session_state.paso)
 st.divider()
 
-# Contenido según paso actual
-if st.session_state.paso == 1:
-    render_paso_1()
-elif st.session_state.paso == 2:
-    render_paso_2()
-elif st.session_state.paso == 3:
-    render_paso_3()
-elif st.session_state.paso == 4:
-    render_paso_4()
+# Contenido según paso actual, cronometrado (st.rerun corta el script: la
+# traza se guarda igual)
+RENDER_PASOS = {1: render_paso_1, 2: render_paso_2, 3: render_paso_3, 4: render_paso_4}
+paso_actual = st.session_state.paso
+traza_actual = Traza(f"Paso {paso_actual}")
+try:
+    with traza(traza_actual), span("render_paso", paso=paso_actual):
+        RENDER_PASOS[paso_actual]()
+finally:
+    guardar_traza(traza_actual)
 
 # Sidebar
-render_sidebar()
+with span("render_sidebar"):
+    render_sidebar()
 
 # Footer
 st.divider()
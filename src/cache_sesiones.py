@@ -0,0 +1,123 @@
+"""
+COEMA - Cache compartida entre sesiones
+Una sola copia por proceso de los cuadros tarifarios extraídos y de las
+corridas de facturación, para que varios operadores con la app abierta no
+extraigan el mismo PDF ni facturen el mismo período cada uno por su lado.
+
+Los valores guardados son de solo lectura para las sesiones: una sesión que
+necesita editarlos (Paso 2, refacturar_escalones) trabaja sobre su propia
+copia, que saca recién en ese momento (copy-on-write). Mientras no edite,
+comparte el objeto de la cache.
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, Optional
+
+# Entradas por cache; las menos usadas se descartan primero
+MAX_EXTRACCIONES = 8
+MAX_CORRIDAS = 4
+
+
+class CacheCompartida:
+    """
+    Dict LRU protegido por lock, con un lock por clave para que dos
+    sesiones que piden lo mismo a la vez lo calculen una sola vez.
+    """
+
+    def __init__(self, nombre: str, max_entradas: int):
+        self.nombre = nombre
+        self.max_entradas = max_entradas
+        self._entradas: "OrderedDict[Hashable, object]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._calculando: Dict[Hashable, threading.Lock] = {}
+        self.aciertos = 0
+        self.fallos = 0
+
+    def __len__(self) -> int:
+        return len(self._entradas)
+
+    def __contains__(self, clave: Hashable) -> bool:
+        return clave in self._entradas
+
+    def obtener(self, clave: Hashable) -> Optional[object]:
+        with self._lock:
+            if clave not in self._entradas:
+                return None
+            self._entradas.move_to_end(clave)
+            return self._entradas[clave]
+
+    def guardar(self, clave: Hashable, valor: object) -> object:
+        """Guarda valor; si otra sesión ya guardó esa clave, devuelve el que estaba."""
+        with self._lock:
+            return self._guardar(clave, valor)
+
+    def _guardar(self, clave: Hashable, valor: object) -> object:
+        # Con self._lock tomado
+        if clave in self._entradas:
+            self._entradas.move_to_end(clave)
+            return self._entradas[clave]
+        self._entradas[clave] = valor
+        while len(self._entradas) > self.max_entradas:
+            self._entradas.popitem(last=False)
+        return valor
+
+    def obtener_o_calcular(self, clave: Hashable, calcular: Callable[[], object]) -> object:
+        """
+        El valor de clave, calculándolo con calcular() si no está. Las demás
+        sesiones que pidan la misma clave mientras tanto esperan ese cálculo
+        en lugar de repetirlo. Si calcular falla no se guarda nada.
+        """
+        with self._lock:
+            if clave in self._entradas:
+                self._entradas.move_to_end(clave)
+                self.aciertos += 1
+                return self._entradas[clave]
+            lock_clave = self._calculando.setdefault(clave, threading.Lock())
+        with lock_clave:
+            valor = self.obtener(clave)
+            if valor is not None:
+                with self._lock:
+                    self.aciertos += 1
+                return valor
+            try:
+                valor = calcular()
+            except BaseException:
+                with self._lock:
+                    self._calculando.pop(clave, None)
+                raise
+            # Guardar y dejar de marcarla como en cálculo en un solo paso:
+            # quien llegue después encuentra el valor o espera este lock
+            with self._lock:
+                self.fallos += 1
+                self._calculando.pop(clave, None)
+                return self._guardar(clave, valor)
+
+    def descartar(self, clave: Hashable) -> bool:
+        """Saca una entrada. Las sesiones que ya la tienen la siguen usando."""
+        with self._lock:
+            return self._entradas.pop(clave, None) is not None
+
+    def vaciar(self) -> int:
+        """Saca todas las entradas; devuelve cuántas había."""
+        with self._lock:
+            n = len(self._entradas)
+            self._entradas.clear()
+            return n
+
+    def estadisticas(self) -> Dict[str, int]:
+        with self._lock:
+            return {"entradas": len(self._entradas), "max_entradas": self.max_entradas,
+                    "aciertos": self.aciertos, "fallos": self.fallos}
+
+
+# Cuadros tarifarios extraídos, por (SHA-256 del PDF, origen)
+EXTRACCIONES = CacheCompartida("extracciones", MAX_EXTRACCIONES)
+
+# Corridas de facturación, por (huella_tarifas, Padron.version)
+CORRIDAS = CacheCompartida("corridas", MAX_CORRIDAS)
+
+
+def vaciar_caches() -> Dict[str, int]:
+    """Descarte explícito de todo lo compartido (p. ej. al publicar un cuadro nuevo)."""
+    return {cache.nombre: cache.vaciar() for cache in (EXTRACCIONES, CORRIDAS)}
@@ -0,0 +1,111 @@
+"""
+COEMA - Carga masiva del historial de cuadros tarifarios
+Extrae en paralelo todos los PDFs de OCEBA de un directorio o de un zip
+(extract_tariffs_bulk: pool de procesos, timeout por archivo, un PDF que
+falla no corta la corrida), guarda cada cuadro en el historial con la fecha
+del documento como vigencia y escribe la serie de cargos por escalón, con la
+variación interanual, en Parquet o CSV.
+
+Uso:
+    python src/cargar_historial.py cuadros_2019_2025.zip --salida serie.csv
+    python src/cargar_historial.py docs/cuadros-tarifarios --salida serie.parquet --workers 4
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import time
+from typing import List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from historial_tarifas import TARIFAS_DB, HistorialTarifas, comparar_interanual
+from pdf_extractor import BULK_TIMEOUT, extract_tariffs_bulk
+
+
+def escribir_serie(serie, salida: str):
+    """Parquet si la extensión es .parquet (requiere pyarrow), si no CSV."""
+    os.makedirs(os.path.dirname(os.path.abspath(salida)), exist_ok=True)
+    if salida.lower().endswith(".parquet"):
+        try:
+            serie.to_parquet(salida, index=False)
+        except ImportError as e:
+            raise SystemExit(f"Para escribir Parquet hace falta pyarrow: {e}")
+    else:
+        serie.to_csv(salida, index=False)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Carga masiva de cuadros tarifarios al historial.")
+    parser.add_argument("origen", help="directorio (se recorre entero) o zip con los PDFs de OCEBA")
+    parser.add_argument("--salida", required=True, help="serie de tarifas (.parquet o .csv)")
+    parser.add_argument("--db", default=TARIFAS_DB, help="base del historial de cuadros")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="procesos para extraer (1 = sin pool)")
+    parser.add_argument("--timeout", type=float, default=BULK_TIMEOUT,
+                        help="segundos por PDF antes de abandonarlo")
+    parser.add_argument("--sin-cache", action="store_true",
+                        help="no usar la cache de extracción de PDFs")
+    args = parser.parse_args(argv)
+
+    tiempos = {}
+    t0 = time.perf_counter()
+    try:
+        resultados = extract_tariffs_bulk(args.origen, use_cache=not args.sin_cache,
+                                          max_workers=args.workers, timeout=args.timeout)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 2
+    tiempos["extraccion"] = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    errores = []
+    guardados = 0
+    try:
+        historial = HistorialTarifas(args.db)
+    except sqlite3.Error as e:
+        print(f"Error: no se pudo abrir el historial {args.db}: {e}", file=sys.stderr)
+        return 2
+    try:
+        for r in resultados:
+            if r.error:
+                errores.append({"archivo": r.archivo, "error": r.error})
+            elif not r.data.get("tarifas"):
+                errores.append({"archivo": r.archivo, "error": "no es un cuadro tarifario reconocido"})
+            elif not r.data.get("fecha"):
+                errores.append({"archivo": r.archivo, "error": "el PDF no tiene fecha"})
+            elif not r.data.get("anexo"):
+                errores.append({"archivo": r.archivo, "error": "no se reconoce el Anexo del cuadro"})
+            else:
+                try:
+                    historial.guardar(r.data, r.data["fecha"], origen=r.archivo)
+                except sqlite3.Error as e:
+                    errores.append({"archivo": r.archivo, "error": f"no se pudo guardar en el historial: {e}"})
+                    continue
+                guardados += 1
+        serie = comparar_interanual(historial.serie())
+    finally:
+        historial.close()
+    tiempos["historial"] = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    escribir_serie(serie, args.salida)
+    tiempos["escritura"] = time.perf_counter() - t0
+
+    resumen = {
+        "pdfs": len(resultados),
+        "guardados": guardados,
+        "errores": errores,
+        "vigencias": int(serie["vigencia"].nunique()),
+        "filas_serie": len(serie),
+        "segundos": {k: round(v, 3) for k, v in tiempos.items()},
+        "salida": args.salida,
+        "db": args.db,
+    }
+    print(json.dumps(resumen, indent=2, ensure_ascii=False))
+    return 0 if guardados or not resultados else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
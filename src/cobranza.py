@@ -0,0 +1,424 @@
+"""
+COEMA - Archivos de cobranza
+Exportadores de ancho fijo para los canales de pago (RIPSA, BANELCO, LINK,
+Débitos VISA) escritos directamente desde los resultados columnares de la
+facturación: cada bloque de filas se formatea con NumPy en un buffer de
+bytes por canal, sin armar un dict por factura, y todos los canales se
+escriben en una sola pasada sobre los datos (memoria acotada por el tamaño
+de bloque, no por el del período).
+
+Los layouts siguen la estructura de cada canal (encabezado, detalle y pie
+con cantidad e importe total); el código de empresa de cada uno se configura
+con COEMA_CODIGO_<CANAL>. Ningún layout está confirmado todavía contra la
+especificación vigente del canal (layout_confirmado): exportar_cobranza se
+niega a escribirlos salvo con preliminares=True, y entonces el nombre del
+archivo lo marca como preliminar.
+"""
+
+import datetime
+import os
+import tempfile
+import time
+import unicodedata
+from typing import Dict, Iterable, Iterator, List, Mapping, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from facturacion import a_pesos
+
+COBRANZA_DIR = os.environ.get(
+    "COEMA_COBRANZA_DIR",
+    os.path.join(tempfile.gettempdir(), "coema_cobranza"),
+)
+
+TAMANO_BLOQUE = 50_000
+FIN_LINEA = b"\r\n"
+
+_CERO = ord("0")
+
+
+class LayoutSinConfirmar(ValueError):
+    """Se pidió un canal cuyo layout no está confirmado, sin habilitar los preliminares."""
+
+
+class Campo(NamedTuple):
+    """
+    Campo de un registro de ancho fijo.
+
+    tipo: 'N' entero con ceros a la izquierda, 'Z' texto numérico (socio)
+        con ceros a la izquierda, 'A' texto en mayúsculas sin acentos
+        completado con espacios, 'C' constante (valor), 'E' código de
+        empresa del canal.
+    """
+    nombre: str
+    ancho: int
+    tipo: str
+    valor: str = ""
+
+
+def _digitos(valores, ancho: int) -> np.ndarray:
+    """Enteros >= 0 como matriz (n, ancho) de dígitos ASCII."""
+    v = np.atleast_1d(np.asarray(valores, dtype=np.int64))
+    utiles = min(ancho, 18)
+    if len(v) and (v.min() < 0 or v.max() >= 10 ** utiles):
+        raise ValueError(f"Valor fuera de rango para un campo de {ancho} dígitos")
+    potencias = 10 ** np.arange(utiles - 1, -1, -1, dtype=np.int64)
+    salida = np.full((len(v), ancho), _CERO, dtype=np.uint8)
+    salida[:, ancho - utiles:] = v[:, None] // potencias % 10 + _CERO
+    return salida
+
+
+def _tabla_ascii() -> np.ndarray:
+    """Código Unicode -> byte ASCII en mayúsculas y sin acentos ('?' si no hay equivalente)."""
+    tabla = np.full(0x251, ord("?"), dtype=np.uint8)
+    for cp in range(0x250):
+        base = unicodedata.normalize("NFKD", chr(cp).upper()).encode("ascii", "ignore")
+        if base and 32 <= base[0] < 127:
+            tabla[cp] = base[0]
+    tabla[0] = ord(" ")  # relleno de los strings de ancho fijo de NumPy
+    return tabla
+
+
+_ASCII = _tabla_ascii()
+
+
+def _texto(valores, campo: Campo) -> np.ndarray:
+    """
+    Textos como matriz (n, ancho) de bytes ASCII. Se trabaja sobre los
+    códigos UTF-32 del array de NumPy, sin operaciones por string.
+    """
+    u = np.atleast_1d(np.asarray(valores, dtype=str))
+    largo = u.dtype.itemsize // 4
+    if campo.tipo == "Z" and largo > campo.ancho:
+        raise ValueError(f"'{campo.nombre}' no entra en {campo.ancho} posiciones")
+    codigos = u.astype(f"U{campo.ancho}").view(np.uint32).reshape(len(u), campo.ancho)
+    if campo.tipo == "Z":
+        # Alinear a la derecha y completar con ceros
+        corrimiento = campo.ancho - (codigos != 0).sum(axis=1)
+        indices = np.arange(campo.ancho)[None, :] - corrimiento[:, None]
+        codigos = np.where(indices >= 0,
+                           np.take_along_axis(codigos, np.maximum(indices, 0), axis=1),
+                           _CERO)
+    return _ASCII[np.minimum(codigos, len(_ASCII) - 1)]
+
+
+def _constante(valor: str, ancho: int) -> np.ndarray:
+    return np.frombuffer(valor.ljust(ancho)[:ancho].encode("ascii"), dtype=np.uint8)[None, :]
+
+
+class BloqueCobranza:
+    """
+    Un bloque de facturas a cobrar. Las columnas son arrays (o escalares,
+    que valen para todas las filas); el formato de cada campo se calcula una
+    vez por bloque y lo comparten todos los canales.
+    """
+
+    def __init__(self, columnas: Mapping[str, object], n: int):
+        self.columnas = columnas
+        self.n = n
+        self._formato: Dict[Campo, np.ndarray] = {}
+
+    def __len__(self) -> int:
+        return self.n
+
+    def columna(self, campo: Campo) -> np.ndarray:
+        """Matriz (n, ancho) de bytes del campo, o (1, ancho) si es igual en todas las filas."""
+        formato = self._formato.get(campo)
+        if formato is None:
+            if campo.tipo == "C":
+                formato = _constante(campo.valor, campo.ancho)
+            else:
+                valores = self.columnas[campo.nombre]
+                if campo.tipo == "N":
+                    formato = _digitos(valores, campo.ancho)
+                else:
+                    formato = _texto(valores, campo)
+            self._formato[campo] = formato
+        return formato
+
+
+class Exportador:
+    """
+    Layout de cobranza de un canal.
+
+    Las subclases definen canal, encabezado, detalle y pie (listas de
+    Campo) y se registran con @registrar_exportador. Los canales de débito
+    automático (requiere_adhesion) solo exportan a los socios adheridos.
+    layout_confirmado pasa a True recién cuando los anchos de los campos se
+    verificaron contra la especificación que entrega el canal.
+    """
+    canal = ""
+    extension = ".txt"
+    requiere_adhesion = False
+    layout_confirmado = False
+    encabezado: Sequence[Campo] = ()
+    detalle: Sequence[Campo] = ()
+    pie: Sequence[Campo] = ()
+
+    def __init__(self, codigo_empresa: Optional[str] = None):
+        codigo = codigo_empresa or os.environ.get(f"COEMA_CODIGO_{self.canal}", "0")
+
+        def resolver(campos: Sequence[Campo]) -> List[Campo]:
+            return [Campo(c.nombre, c.ancho, "C", codigo.zfill(c.ancho)) if c.tipo == "E" else c
+                    for c in campos]
+
+        self.campos_encabezado = resolver(self.encabezado)
+        self.campos_detalle = resolver(self.detalle)
+        self.campos_pie = resolver(self.pie)
+        self.ancho = sum(c.ancho for c in self.campos_detalle)
+        for nombre, campos in (("encabezado", self.campos_encabezado), ("pie", self.campos_pie)):
+            if campos and sum(c.ancho for c in campos) != self.ancho:
+                raise ValueError(f"{self.canal}: el {nombre} no mide {self.ancho} posiciones")
+
+    def archivo(self, periodo: str) -> str:
+        preliminar = "" if self.layout_confirmado else "_preliminar"
+        return f"cobranza_{self.canal.lower()}_{periodo}{preliminar}{self.extension}"
+
+    def registros(self, campos: Sequence[Campo], bloque: BloqueCobranza,
+                  filas: Optional[np.ndarray] = None, secuencia: int = 1) -> bytes:
+        """
+        Registros de ancho fijo (con fin de línea) de las filas del bloque
+        (todas, o las de la máscara filas). Los campos 'secuencia' numeran
+        desde secuencia.
+        """
+        n = len(bloque) if filas is None else int(filas.sum())
+        if not n or not campos:
+            return b""
+        buffer = np.empty((n, self.ancho + len(FIN_LINEA)), dtype=np.uint8)
+        pos = 0
+        for campo in campos:
+            if campo.nombre == "secuencia":
+                columna = _digitos(np.arange(secuencia, secuencia + n), campo.ancho)
+            else:
+                columna = bloque.columna(campo)
+                if filas is not None and len(columna) > 1:
+                    columna = columna[filas]
+            buffer[:, pos:pos + campo.ancho] = columna
+            pos += campo.ancho
+        buffer[:, pos:] = np.frombuffer(FIN_LINEA, dtype=np.uint8)
+        return buffer.tobytes()
+
+
+EXPORTADORES: Dict[str, type] = {}
+
+
+def registrar_exportador(cls: type) -> type:
+    """Decorador: agrega el canal a EXPORTADORES."""
+    EXPORTADORES[cls.canal] = cls
+    return cls
+
+
+# ============================================================================
+# CANALES
+# ============================================================================
+
+@registrar_exportador
+class ExportadorRIPSA(Exportador):
+    canal = "RIPSA"
+    encabezado = [Campo("tipo", 1, "C", "H"), Campo("empresa", 4, "E"),
+                  Campo("fecha", 8, "N"), Campo("relleno", 67, "C")]
+    detalle = [Campo("tipo", 1, "C", "D"), Campo("empresa", 4, "E"), Campo("socio", 15, "Z"),
+               Campo("periodo", 6, "N"), Campo("vencimiento", 8, "N"), Campo("importe", 11, "N"),
+               Campo("nombre", 28, "A"), Campo("secuencia", 7, "N")]
+    pie = [Campo("tipo", 1, "C", "T"), Campo("empresa", 4, "E"), Campo("registros", 8, "N"),
+           Campo("importe", 15, "N"), Campo("relleno", 52, "C")]
+
+
+@registrar_exportador
+class ExportadorBANELCO(Exportador):
+    canal = "BANELCO"
+    encabezado = [Campo("tipo", 4, "C", "0400"), Campo("empresa", 4, "E"),
+                  Campo("fecha", 8, "N"), Campo("relleno", 84, "C")]
+    detalle = [Campo("tipo", 1, "C", "5"), Campo("socio", 19, "Z"), Campo("periodo", 6, "N"),
+               Campo("socio", 14, "Z"), Campo("moneda", 1, "C", "0"), Campo("vencimiento", 8, "N"),
+               Campo("importe", 11, "N"), Campo("relleno", 40, "C")]
+    pie = [Campo("tipo", 4, "C", "9400"), Campo("empresa", 4, "E"), Campo("fecha", 8, "N"),
+           Campo("registros", 7, "N"), Campo("importe", 16, "N"), Campo("relleno", 61, "C")]
+
+
+@registrar_exportador
+class ExportadorLINK(Exportador):
+    canal = "LINK"
+    encabezado = [Campo("tipo", 13, "C", "HRFACTURACION"), Campo("empresa", 3, "E"),
+                  Campo("fecha", 8, "N"), Campo("relleno", 76, "C")]
+    detalle = [Campo("socio", 19, "Z"), Campo("concepto", 3, "C", "001"),
+               Campo("periodo", 6, "N"), Campo("vencimiento", 8, "N"),
+               Campo("importe", 12, "N"), Campo("nombre", 30, "A"), Campo("relleno", 22, "C")]
+    pie = [Campo("tipo", 13, "C", "TRFACTURACION"), Campo("registros", 8, "N"),
+           Campo("importe", 18, "N"), Campo("relleno", 61, "C")]
+
+
+@registrar_exportador
+class ExportadorVISA(Exportador):
+    """Débitos automáticos Prisma (Cartera 1): solo socios adheridos."""
+    canal = "VISA"
+    requiere_adhesion = True
+    encabezado = [Campo("tipo", 9, "C", "0DEBLIQC "), Campo("empresa", 10, "E"),
+                  Campo("marca", 10, "C", "900000"), Campo("fecha", 8, "N"),
+                  Campo("relleno", 63, "C")]
+    detalle = [Campo("tipo", 1, "C", "1"), Campo("socio", 15, "Z"),
+               Campo("vencimiento", 8, "N"), Campo("transaccion", 4, "C", "0005"),
+               Campo("secuencia", 15, "N"), Campo("importe", 15, "N"),
+               Campo("periodo", 6, "N"), Campo("socio", 14, "Z"), Campo("relleno", 22, "C")]
+    pie = [Campo("tipo", 9, "C", "9DEBLIQC "), Campo("empresa", 10, "E"),
+           Campo("marca", 10, "C", "900000"), Campo("fecha", 8, "N"),
+           Campo("registros", 7, "N"), Campo("importe", 15, "N"), Campo("relleno", 41, "C")]
+
+
+# ============================================================================
+# GENERACIÓN
+# ============================================================================
+
+def _aaaammdd(fecha: datetime.date) -> int:
+    return fecha.year * 10000 + fecha.month * 100 + fecha.day
+
+
+def bloques_resultados(resultados: pd.DataFrame, servicios: pd.DataFrame,
+                       tamano_bloque: int = TAMANO_BLOQUE) -> Iterator[pd.DataFrame]:
+    """Resultados de facturar_por_rutas (total_general, en centavos) + nombre del socio, por bloques."""
+    nombres = servicios["nombre"]
+    posiciones = servicios.index.get_indexer(resultados.index)
+    for desde in range(0, len(resultados), tamano_bloque):
+        bloque = resultados.iloc[desde:desde + tamano_bloque][["total_general"]]
+        pos = posiciones[desde:desde + tamano_bloque]
+        nombre = nombres.iloc[np.maximum(pos, 0)].to_numpy(dtype=object) if len(nombres) else ""
+        yield bloque.assign(nombre=np.where(pos >= 0, nombre, ""))
+
+
+def generar_cobranza(
+    bloques: Iterable[pd.DataFrame],
+    exportadores: Sequence[Exportador],
+    periodo: str,
+    vencimiento: datetime.date,
+    fecha: Optional[datetime.date] = None,
+    adheridos: Optional[Mapping[str, Iterable[str]]] = None,
+    totales: Optional[Dict[str, Dict[str, int]]] = None,
+) -> Iterator[Tuple[str, bytes]]:
+    """
+    Recorre los bloques una sola vez y genera (canal, bytes) para todos los
+    exportadores: primero los encabezados, después los registros de cada
+    bloque y al final los pies.
+
+    Args:
+        bloques: DataFrames indexados por socio con total_general (centavos) y nombre
+            (ver bloques_resultados); pueden venir de un lector por lotes
+        periodo: 'AAAA-MM'
+        vencimiento: primer vencimiento de las facturas
+        fecha: fecha de generación (hoy por defecto)
+        adheridos: canal -> socios adheridos (canales de débito automático)
+        totales: si se pasa, se completa con canal -> {registros, importe}
+
+    Las facturas con total_general <= 0 no se cobran por estos canales.
+    """
+    fecha = fecha or datetime.date.today()
+    totales = totales if totales is not None else {}
+    adheridos = {canal: pd.Index([str(s) for s in socios], dtype=object)
+                 for canal, socios in (adheridos or {}).items()}
+    constantes = {
+        "fecha": _aaaammdd(fecha),
+        "periodo": int(periodo.replace("-", "")),
+        "vencimiento": _aaaammdd(vencimiento),
+    }
+    for exp in exportadores:
+        if exp.requiere_adhesion and exp.canal not in adheridos:
+            raise ValueError(f"{exp.canal} es débito automático: falta la lista de adheridos")
+        totales[exp.canal] = {"registros": 0, "importe": 0}
+        cabecera = BloqueCobranza(constantes, 1)
+        yield exp.canal, exp.registros(exp.campos_encabezado, cabecera)
+
+    for df in bloques:
+        importe = df["total_general"].to_numpy(dtype=np.int64)
+        a_cobrar = importe > 0
+        socios = pd.Index(df.index.astype(str), dtype=object)
+        bloque = BloqueCobranza({
+            **constantes,
+            "socio": socios.to_numpy(),
+            "nombre": df["nombre"].to_numpy(),
+            # Las filas que no se cobran no se escriben; se dejan en 0 para el formato
+            "importe": np.where(a_cobrar, importe, 0),
+        }, len(df))
+        for exp in exportadores:
+            filas = a_cobrar
+            if exp.requiere_adhesion:
+                filas = a_cobrar & socios.isin(adheridos[exp.canal])
+            total = totales[exp.canal]
+            datos = exp.registros(exp.campos_detalle, bloque, filas, total["registros"] + 1)
+            total["registros"] += int(filas.sum())
+            total["importe"] += int(importe[filas].sum())
+            if datos:
+                yield exp.canal, datos
+
+    for exp in exportadores:
+        pie = BloqueCobranza({**constantes, **totales[exp.canal]}, 1)
+        yield exp.canal, exp.registros(exp.campos_pie, pie)
+
+
+def exportar_cobranza(
+    resultados: pd.DataFrame,
+    servicios: pd.DataFrame,
+    periodo: str,
+    vencimiento: datetime.date,
+    canales: Optional[Sequence[str]] = None,
+    directorio: str = COBRANZA_DIR,
+    adheridos: Optional[Mapping[str, Iterable[str]]] = None,
+    fecha: Optional[datetime.date] = None,
+    tamano_bloque: int = TAMANO_BLOQUE,
+    preliminares: bool = False,
+) -> pd.DataFrame:
+    """
+    Escribe un archivo de cobranza por canal.
+
+    Args:
+        resultados: salida de facturar_por_rutas (indexada por socio)
+        servicios: Padron.servicios (nombre del socio)
+        canales: claves de EXPORTADORES; por defecto todos, salvo los de
+            débito automático sin lista de adheridos
+        adheridos: canal -> socios adheridos al débito
+        preliminares: permite los canales con layout sin confirmar (el
+            archivo sale con '_preliminar' en el nombre); sin esto, pedir
+            uno de esos canales es LayoutSinConfirmar
+
+    Returns:
+        DataFrame con una fila por canal: canal, archivo, registros,
+        importe (en pesos) y segundos.
+    """
+    adheridos = adheridos or {}
+    if canales is None:
+        canales = [c for c, cls in EXPORTADORES.items()
+                   if not cls.requiere_adhesion or c in adheridos]
+    desconocidos = [c for c in canales if c not in EXPORTADORES]
+    if desconocidos:
+        raise ValueError(f"Canales desconocidos: {', '.join(desconocidos)}")
+    sin_confirmar = [c for c in canales if not EXPORTADORES[c].layout_confirmado]
+    if sin_confirmar and not preliminares:
+        raise LayoutSinConfirmar(f"Layout sin confirmar contra la especificación del canal: "
+                                 f"{', '.join(sin_confirmar)}. Solo se pueden generar como archivos preliminares")
+    exportadores = [EXPORTADORES[c]() for c in canales]
+
+    os.makedirs(directorio, exist_ok=True)
+    paths = {exp.canal: os.path.join(directorio, exp.archivo(periodo)) for exp in exportadores}
+    totales: Dict[str, Dict[str, int]] = {}
+    t0 = time.perf_counter()
+    tmps = {canal: f"{path}.tmp{os.getpid()}" for canal, path in paths.items()}
+    archivos = {canal: open(tmp, "wb") for canal, tmp in tmps.items()}
+    try:
+        for canal, datos in generar_cobranza(
+                bloques_resultados(resultados, servicios, tamano_bloque), exportadores,
+                periodo, vencimiento, fecha=fecha, adheridos=adheridos, totales=totales):
+            archivos[canal].write(datos)
+    except BaseException:
+        for canal, f in archivos.items():
+            f.close()
+            os.remove(tmps[canal])
+        raise
+    for canal, f in archivos.items():
+        f.close()
+        os.replace(tmps[canal], paths[canal])
+    segundos = time.perf_counter() - t0
+
+    return pd.DataFrame(
+        [{"canal": canal, "archivo": paths[canal], "registros": t["registros"],
+          "importe": a_pesos(t["importe"]), "segundos": segundos} for canal, t in totales.items()],
+        columns=["canal", "archivo", "registros", "importe", "segundos"],
+    )
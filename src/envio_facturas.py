@@ -0,0 +1,354 @@
+"""
+COEMA - Envío de facturas por e-mail
+Cola asyncio que envía cada factura (PDF adjunto) por SMTP a partir de los
+resultados de la facturación: un pool chico de conexiones SMTP persistentes,
+límite de mensajes por segundo, reintentos con backoff y un estado por
+factura en SQLite, así una corrida interrumpida se reanuda sin reenviar lo
+que ya salió. Una factura se rechaza solo si el servidor rechaza con 5xx su
+destinatario o su contenido; si falla la conexión o la autenticación, la
+corrida se corta (EnvioAbortado) sin tocar las facturas pendientes.
+"""
+
+import asyncio
+import functools
+import os
+import random
+import smtplib
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.message import EmailMessage
+from typing import Callable, Dict, Iterable, List, Mapping, NamedTuple, Optional, Tuple
+
+import pandas as pd
+
+from facturacion import CuadroSegmento, fmt_centavos
+from facturas_pdf import PlantillaFactura, datos_facturas, factura_pdf
+
+ENVIOS_DB = os.environ.get(
+    "COEMA_ENVIOS_DB",
+    os.path.join(tempfile.gettempdir(), "coema_envios.sqlite3"),
+)
+
+CONEXIONES_SMTP = 4          # conexiones SMTP abiertas a la vez
+MENSAJES_POR_SEG = 10.0      # tope de envío (lo que acepte el proveedor)
+MAX_INTENTOS = 5
+BACKOFF_SEGUNDOS = 1.0       # espera base entre reintentos (se duplica)
+TIMEOUT_SMTP = 30
+
+# Estados de cada factura en la base de envíos
+PENDIENTE, ENVIADO, ERROR, RECHAZADO = "pendiente", "enviado", "error", "rechazado"
+
+
+class EnvioAbortado(RuntimeError):
+    """El servidor rechazó la conexión, el login o el remitente: no es culpa de ninguna factura."""
+
+
+class ConfigSMTP(NamedTuple):
+    host: str = os.environ.get("COEMA_SMTP_HOST", "localhost")
+    port: int = int(os.environ.get("COEMA_SMTP_PORT", "25"))
+    usuario: Optional[str] = os.environ.get("COEMA_SMTP_USUARIO")
+    clave: Optional[str] = os.environ.get("COEMA_SMTP_CLAVE")
+    starttls: bool = os.environ.get("COEMA_SMTP_STARTTLS", "0") == "1"
+    remitente: str = os.environ.get("COEMA_SMTP_REMITENTE", "facturacion@localhost")
+
+
+class EstadoEnvios:
+    """
+    Estado durable de envío por (periodo, socio) en SQLite (modo WAL).
+
+    Cada envío exitoso se confirma en la base antes de tomar el siguiente;
+    las facturas en estado 'enviado' o 'rechazado' (error permanente del
+    servidor) no se vuelven a enviar. Las que quedaron en 'error' se
+    reintentan en la próxima corrida.
+    """
+
+    def __init__(self, path: str = ENVIOS_DB):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # Se marca desde los hilos de envío: una sola conexión, serializada
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS envios (
+                periodo TEXT NOT NULL,
+                socio TEXT NOT NULL,
+                email TEXT NOT NULL,
+                estado TEXT NOT NULL,
+                intentos INTEGER NOT NULL DEFAULT 0,
+                ultimo_error TEXT,
+                enviado_en REAL,
+                PRIMARY KEY (periodo, socio)
+            )
+        """)
+        self.conn.commit()
+
+    def registrar(self, periodo: str, destinatarios: Iterable[Tuple[str, str]]):
+        """
+        Agrega las facturas del período. Si cambió el e-mail de una no
+        enviada lo actualiza, y una rechazada vuelve a quedar pendiente.
+        """
+        with self._lock, self.conn:
+            self.conn.executemany(
+                """INSERT INTO envios (periodo, socio, email, estado) VALUES (?, ?, ?, ?)
+                   ON CONFLICT (periodo, socio) DO UPDATE SET
+                       estado = CASE WHEN envios.estado = ? AND envios.email != excluded.email
+                                     THEN ? ELSE envios.estado END,
+                       email = excluded.email
+                   WHERE envios.estado != ?""",
+                [(periodo, socio, email, PENDIENTE, RECHAZADO, PENDIENTE, ENVIADO)
+                 for socio, email in destinatarios],
+            )
+
+    def pendientes(self, periodo: str) -> List[Tuple[str, str]]:
+        cur = self.conn.execute(
+            "SELECT socio, email FROM envios WHERE periodo = ? AND estado IN (?, ?) ORDER BY socio",
+            (periodo, PENDIENTE, ERROR),
+        )
+        return cur.fetchall()
+
+    def marcar(self, periodo: str, socio: str, estado: str, intentos: int,
+               error: Optional[str] = None):
+        with self._lock, self.conn:
+            self.conn.execute(
+                """UPDATE envios SET estado = ?, intentos = intentos + ?, ultimo_error = ?,
+                   enviado_en = CASE WHEN ? = ? THEN ? ELSE enviado_en END
+                   WHERE periodo = ? AND socio = ?""",
+                (estado, intentos, error, estado, ENVIADO, time.time(), periodo, socio),
+            )
+
+    def resumen(self, periodo: str) -> Dict[str, int]:
+        cur = self.conn.execute(
+            "SELECT estado, COUNT(*) FROM envios WHERE periodo = ? GROUP BY estado", (periodo,))
+        return dict(cur.fetchall())
+
+    def close(self):
+        self.conn.close()
+
+
+class LimitadorTasa:
+    """Reparte los envíos a intervalos regulares (como máximo por_segundo)."""
+
+    def __init__(self, por_segundo: float):
+        self.intervalo = 1.0 / por_segundo if por_segundo > 0 else 0.0
+        self._proximo = 0.0
+        self._lock = asyncio.Lock()
+
+    async def esperar(self):
+        loop = asyncio.get_running_loop()
+        async with self._lock:
+            ahora = loop.time()
+            espera = self._proximo - ahora
+            self._proximo = max(ahora, self._proximo) + self.intervalo
+        if espera > 0:
+            await asyncio.sleep(espera)
+
+
+def _conectar(config: ConfigSMTP) -> smtplib.SMTP:
+    smtp = smtplib.SMTP(config.host, config.port, timeout=TIMEOUT_SMTP)
+    if config.starttls:
+        smtp.starttls()
+    if config.usuario:
+        smtp.login(config.usuario, config.clave or "")
+    return smtp
+
+
+def _cerrar(smtp: Optional[smtplib.SMTP]):
+    if smtp is None:
+        return
+    try:
+        smtp.quit()
+    except (smtplib.SMTPException, OSError):
+        smtp.close()
+
+
+def armar_mensaje(socio: str, email: str, fila: Mapping, pdf: bytes, periodo: str,
+                  remitente: str) -> EmailMessage:
+    msg = EmailMessage()
+    msg["From"] = remitente
+    msg["To"] = email
+    msg["Subject"] = f"COEMA - Factura de energía {periodo} - Socio {socio}"
+    msg.set_content(
+        f"Estimado/a {fila['nombre']}:\n\n"
+        f"Adjuntamos su factura de energía eléctrica del período {periodo} "
+        f"(socio {socio}, consumo {int(fila['kwh'])} kWh).\n"
+        f"Total a pagar: {fmt_centavos(fila['total_general'])}\n\n"
+        f"COEMA - Gral. Madariaga\n"
+    )
+    msg.add_attachment(pdf, maintype="application", subtype="pdf",
+                       filename=f"factura_{periodo}_{socio}.pdf")
+    return msg
+
+
+def _es_permanente(error: Exception) -> bool:
+    """
+    5xx al destinatario (RCPT) o al contenido (DATA) de este mensaje:
+    reintentarlo no va a cambiar el resultado.
+    """
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPDataError):
+        return error.smtp_code >= 500
+    return False
+
+
+def _es_falla_servidor(error: Exception) -> bool:
+    """Fallas que se repetirían con cualquier factura: login, STARTTLS, 5xx al conectar o al remitente."""
+    if isinstance(error, smtplib.SMTPNotSupportedError):
+        return True
+    if isinstance(error, (smtplib.SMTPAuthenticationError, smtplib.SMTPConnectError,
+                          smtplib.SMTPSenderRefused)):
+        return error.smtp_code >= 500
+    return False
+
+
+async def enviar_facturas(
+    resultados: pd.DataFrame,
+    servicios: pd.DataFrame,
+    emails: Mapping[str, str],
+    tarifas: dict,
+    periodo: str,
+    config: Optional[ConfigSMTP] = None,
+    db: str = ENVIOS_DB,
+    conexiones: int = CONEXIONES_SMTP,
+    mensajes_por_seg: float = MENSAJES_POR_SEG,
+    max_intentos: int = MAX_INTENTOS,
+    backoff: float = BACKOFF_SEGUNDOS,
+    al_enviar: Optional[Callable[[str, str], None]] = None,
+    cuadros: Optional[Mapping[str, CuadroSegmento]] = None,
+) -> Dict:
+    """
+    Envía por e-mail la factura en PDF de cada socio facturado.
+
+    Args:
+        resultados: salida de facturar_por_rutas (indexada por socio)
+        servicios: Padron.servicios
+        emails: socio -> dirección (Series o dict); los socios sin e-mail se
+            cuentan en 'sin_email' y no se registran
+        tarifas: cuadro tarifario con el que se facturó
+        periodo: período facturado (clave del estado de envío)
+        conexiones: conexiones SMTP en paralelo (una por trabajador)
+        mensajes_por_seg: tope global de envío
+        al_enviar: callback (socio, estado) después de cada factura
+        cuadros: cuadros por segmento, si se facturó con facturar_segmentos
+
+    Returns:
+        dict con enviados, rechazados, errores (de esta corrida), ya_enviados
+        (de corridas anteriores), sin_email, segundos y mensajes_por_seg.
+
+    Raises:
+        EnvioAbortado: el servidor rechazó la conexión, el login o el
+            remitente. Lo ya enviado queda registrado y el resto pendiente.
+    """
+    config = config or ConfigSMTP()
+    emails = dict(emails)
+    facturas = datos_facturas(resultados, servicios)
+    con_email = [s for s in facturas.index if emails.get(s)]
+
+    estado = EstadoEnvios(db)
+    # Hilos propios para el trabajo bloqueante (PDF, SMTP): al salir se
+    # espera a que terminen antes de cerrar la base, también si la corrida
+    # se cancela con un envío en vuelo, para que quede registrado.
+    ejecutor = ThreadPoolExecutor(max_workers=2 * max(1, conexiones),
+                                  thread_name_prefix="envio")
+    loop = asyncio.get_running_loop()
+
+    def en_hilo(fn, *args):
+        return loop.run_in_executor(ejecutor, functools.partial(fn, *args))
+
+    try:
+        estado.registrar(periodo, [(s, emails[s]) for s in con_email])
+        pendientes = [(s, e) for s, e in estado.pendientes(periodo) if s in facturas.index]
+        ya_enviados = estado.resumen(periodo).get(ENVIADO, 0)
+
+        cola: asyncio.Queue = asyncio.Queue()
+        for item in pendientes:
+            cola.put_nowait(item)
+        limitador = LimitadorTasa(mensajes_por_seg)
+        plantilla = PlantillaFactura()
+        conteo = {ENVIADO: 0, RECHAZADO: 0, ERROR: 0}
+
+        def enviar(smtp: smtplib.SMTP, socio: str, mensaje: EmailMessage, intento: int):
+            # Se registra en el mismo hilo que envía: si la tarea se cancela
+            # mientras el hilo sigue, el envío igual queda registrado.
+            smtp.send_message(mensaje)
+            estado.marcar(periodo, socio, ENVIADO, intento)
+
+        def preparar(socio: str, email: str) -> EmailMessage:
+            fila = facturas.loc[socio].to_dict()
+            pdf = factura_pdf(socio, fila, tarifas, periodo, plantilla, cuadros)
+            return armar_mensaje(socio, email, fila, pdf, periodo, config.remitente)
+
+        def terminar(socio: str, resultado: str, intentos: int, error: Optional[str]):
+            if resultado != ENVIADO:
+                estado.marcar(periodo, socio, resultado, intentos, error)
+            conteo[resultado] += 1
+            if al_enviar:
+                al_enviar(socio, resultado)
+
+        async def trabajador():
+            smtp = None
+            try:
+                while True:
+                    try:
+                        socio, email = cola.get_nowait()
+                    except asyncio.QueueEmpty:
+                        return
+                    try:
+                        mensaje = await en_hilo(preparar, socio, email)
+                    except Exception as e:
+                        # Una factura que no se puede armar no corta el envío de las demás
+                        terminar(socio, ERROR, 0, f"{type(e).__name__}: {e}")
+                        continue
+                    resultado, error = ERROR, None
+                    for intento in range(1, max_intentos + 1):
+                        await limitador.esperar()
+                        try:
+                            if smtp is None:
+                                smtp = await en_hilo(_conectar, config)
+                            await en_hilo(enviar, smtp, socio, mensaje, intento)
+                            resultado, error = ENVIADO, None
+                            break
+                        except (smtplib.SMTPException, OSError) as e:
+                            error = f"{type(e).__name__}: {e}"
+                            if _es_falla_servidor(e):
+                                # La factura vuelve a la cola de la próxima corrida tal como estaba
+                                raise EnvioAbortado(error) from e
+                            if _es_permanente(e):
+                                resultado = RECHAZADO
+                                break
+                            # Transitorio: conexión nueva y espera creciente
+                            await en_hilo(_cerrar, smtp)
+                            smtp = None
+                            if intento < max_intentos:
+                                await asyncio.sleep(backoff * 2 ** (intento - 1) * random.uniform(0.8, 1.2))
+                    terminar(socio, resultado, intento, error)
+            finally:
+                await en_hilo(_cerrar, smtp)
+
+        t0 = time.perf_counter()
+        tareas = [asyncio.ensure_future(trabajador())
+                  for _ in range(max(1, min(conexiones, len(pendientes))))]
+        try:
+            await asyncio.gather(*tareas)
+        finally:
+            # Si un trabajador aborta, los demás no siguen enviando
+            for tarea in tareas:
+                tarea.cancel()
+            await asyncio.gather(*tareas, return_exceptions=True)
+        segundos = time.perf_counter() - t0
+    finally:
+        ejecutor.shutdown(wait=True)
+        estado.close()
+
+    return {
+        "enviados": conteo[ENVIADO],
+        "rechazados": conteo[RECHAZADO],
+        "errores": conteo[ERROR],
+        "ya_enviados": ya_enviados,
+        "sin_email": len(facturas) - len(con_email),
+        "segundos": segundos,
+        "mensajes_por_seg": conteo[ENVIADO] / segundos if segundos > 0 else 0.0,
+    }
@@ -0,0 +1,617 @@
+"""
+COEMA - Motor de Facturación
+Cálculo de facturas T1R/T1RE: por servicio (calcular_factura), en lote
+columnar para todo el padrón (facturar_lote), por segmento N1/N2/N3 con el
+cuadro de cada Anexo (facturar_segmentos) y como curva total(kWh) para
+simulaciones (curva_factura).
+
+Los importes se calculan en centavos enteros (int64) con una regla de
+redondeo explícita por concepto (ver importes_centavos), así los subtotales
+son la suma exacta de sus renglones y los totales de un padrón no acumulan
+error de punto flotante. facturar_lote devuelve centavos; calcular_factura y
+detalle_factura devuelven pesos (centavos / 100) para mostrar.
+"""
+
+import math
+import threading
+from bisect import bisect_right
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Mapping, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from metricas import span
+
+# ---------------------------------------------------------------------------
+# CONSTANTS
+# ---------------------------------------------------------------------------
+
+# Impuestos y leyes (sobre subtotal energía)
+IMPUESTOS = {
+    "iva": {"nombre": "I.V.A.", "porcentaje": None},  # varía por cliente
+    "ley_7290": {"nombre": "Ley Provincial 7290", "porcentaje": 0.04},
+    "art_75": {"nombre": "Ley 11769 Art 75 (6%- Ex.9226)", "porcentaje": 0.06},
+    "art_72bis": {"nombre": "Ley 11769 art.72 Bis (0,001%)", "porcentaje": 0.00001},
+    "fondo": {"nombre": "Ley 11769 Fondo Compensador", "porcentaje": 0.055},
+}
+
+# CTT de resolución OCEBA separada (Res 2019-189)
+CTT_POR_KWH = {"T1R": 9.8780, "T1RE": 4.2020}
+
+# Alumbrado público
+ALUMBRADO_PUBLICO = {1: 14000.00}
+
+# Otros conceptos (punto de venta aparte)
+OTROS_CONCEPTOS_PORCENTAJE_RES_ASAM = 0.1346  # ~13.46% subtotal energía
+BOMBEROS = 960.00
+
+# Escalas de la aritmética entera: importes en centavos, precios por kWh con
+# 4 decimales (como en el cuadro de OCEBA) y alícuotas en diezmillonésimos
+# (0,001% = 100).
+CENTAVOS = 100
+ESCALA_PRECIO = 10_000
+ESCALA_ALICUOTA = 10_000_000
+
+# Columnas de importes (int64, centavos) que devuelve facturar_lote
+COLUMNAS_IMPORTES = [
+    "cargo_fijo", "cargo_variable", "ctt", "bonificacion", "subtotal_energia",
+    "iva", "ley_7290", "art_75", "art_72bis", "fondo", "subtotal_leyes",
+    "alumbrado", "total", "res_asamblea", "otros_conceptos", "total_general",
+]
+
+# Tipo de cada columna que devuelve facturar_lote. Los checkpoints por ruta
+# se versionan con esto: un cambio acá deja de reusar los del formato anterior.
+TIPOS_RESULTADO = {
+    "tarifa": "category", "kwh": "int32", "iva_rate": "float64", "escalon": "int8",
+    **dict.fromkeys(COLUMNAS_IMPORTES, "int64"),
+}
+
+
+# ============================================
+# FORMATO
+# ============================================
+
+def fmt(valor: float) -> str:
+    """Formatea como moneda argentina."""
+    return f"${valor:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
+
+
+def fmt_centavos(centavos: int) -> str:
+    """Como fmt, a partir de centavos enteros (exacto para cualquier total)."""
+    centavos = int(centavos)
+    signo = "-" if centavos < 0 else ""
+    pesos, resto = divmod(abs(centavos), CENTAVOS)
+    return f"{signo}${pesos:,}".replace(",", ".") + f",{resto:02d}"
+
+
+_DIGITOS_PESOS = 17  # int64 / 100 entra en 17 dígitos
+_LUGARES = np.arange(_DIGITOS_PESOS)
+_POTENCIAS = 10 ** _LUGARES.astype(np.int64)
+_ANCHO_ENTERO = _DIGITOS_PESOS + (_DIGITOS_PESOS - 1) // 3
+
+
+def fmt_centavos_lote(centavos) -> np.ndarray:
+    """
+    fmt_centavos vectorizado: array de centavos -> array de textos.
+
+    Arma todas las cifras en una matriz de bytes (signo, "$", dígitos con
+    separador de miles, ",", centavos) alineada a la derecha y recorta el
+    relleno de la izquierda, sin formatear celda por celda.
+    """
+    centavos = np.asarray(centavos, dtype=np.int64).ravel()
+    filas = np.arange(len(centavos))
+    pesos, resto = np.divmod(np.abs(centavos), CENTAVOS)
+    largo = np.maximum((pesos[:, None] >= _POTENCIAS).sum(axis=1), 1)
+
+    ancho = 2 + _ANCHO_ENTERO + 3
+    buf = np.full((len(centavos), ancho), ord(" "), dtype=np.uint8)
+    columnas = 2 + _ANCHO_ENTERO - 1 - (_LUGARES + _LUGARES // 3)
+    visibles = _LUGARES < largo[:, None]
+    buf[:, columnas] = np.where(visibles, (pesos[:, None] // _POTENCIAS) % 10 + ord("0"), ord(" "))
+    miles = _LUGARES[3::3]
+    buf[:, columnas[miles] + 1] = np.where(miles < largo[:, None], ord("."), ord(" "))
+    primera = columnas[largo - 1]
+    buf[filas, primera - 1] = ord("$")
+    negativos = centavos < 0
+    buf[filas[negativos], primera[negativos] - 2] = ord("-")
+    buf[:, -3] = ord(",")
+    buf[:, -2] = resto // 10 + ord("0")
+    buf[:, -1] = resto % 10 + ord("0")
+    return np.char.lstrip(buf.view(f"S{ancho}").ravel().astype(str))
+
+
+def a_pesos(centavos):
+    """Centavos (int o array) a pesos en punto flotante, para mostrar o graficar."""
+    return np.asarray(centavos) / CENTAVOS if np.ndim(centavos) else int(centavos) / CENTAVOS
+
+
+# ============================================
+# ARITMÉTICA EN CENTAVOS
+# ============================================
+
+def _a_entero(valor, escala: int):
+    """Valor decimal (float o array) a entero en la escala dada, redondeando al más cercano."""
+    if isinstance(valor, (int, float)):
+        return math.floor(valor * escala + 0.5)
+    return np.floor(np.asarray(valor, dtype=np.float64) * escala + 0.5).astype(np.int64)
+
+
+def _dividir_redondeo(numerador, divisor: int):
+    """
+    numerador / divisor redondeado a entero, mitades hacia arriba (half-up).
+    Vale igual para int de Python que para arrays int64.
+    """
+    return (numerador + divisor // 2) // divisor
+
+
+ALICUOTAS_LEYES = {k: _a_entero(i["porcentaje"], ESCALA_ALICUOTA)
+                   for k, i in IMPUESTOS.items() if i["porcentaje"] is not None}
+_ALICUOTA_7290, _ALICUOTA_ART_75, _ALICUOTA_ART_72BIS, _ALICUOTA_FONDO = (
+    ALICUOTAS_LEYES[k] for k in ("ley_7290", "art_75", "art_72bis", "fondo"))
+ALICUOTA_RES_ASAMBLEA = _a_entero(OTROS_CONCEPTOS_PORCENTAJE_RES_ASAM, ESCALA_ALICUOTA)
+ALUMBRADO_CENTAVOS = {zona: _a_entero(v, CENTAVOS) for zona, v in ALUMBRADO_PUBLICO.items()}
+ALUMBRADO_DEFECTO_CENTAVOS = 1_400_000
+BOMBEROS_CENTAVOS = _a_entero(BOMBEROS, CENTAVOS)
+CTT_POR_KWH_ESCALADO = {t: _a_entero(v, ESCALA_PRECIO) for t, v in CTT_POR_KWH.items()}
+
+
+def importes_centavos(kwh, cargo_fijo, precio_kwh, ctt_kwh, iva, alumbrado,
+                      bonificacion=0) -> Dict[str, object]:
+    """
+    Todos los importes de una factura en centavos. Sirve igual para un
+    servicio (enteros) que para un padrón (arrays int64).
+
+    Args:
+        kwh: consumo
+        cargo_fijo: cargo fijo del escalón, en centavos
+        precio_kwh, ctt_kwh: $/kWh en ESCALA_PRECIO (4 decimales)
+        iva: alícuota de IVA en ESCALA_ALICUOTA
+        alumbrado: alumbrado público, en centavos
+        bonificacion: bonificación de Tarifa Social (N3), en centavos
+
+    Reglas de redondeo (a centavo, mitades hacia arriba, renglón por renglón):
+        cargo_variable, ctt: kwh x precio
+        bonificacion: se descuenta antes de impuestos, como mucho hasta
+            cargo_fijo + cargo_variable
+        iva y cada ley: subtotal_energia x alícuota
+        res_asamblea: subtotal_energia x OTROS_CONCEPTOS_PORCENTAJE_RES_ASAM
+        subtotales y totales: suma exacta de los renglones ya redondeados
+    """
+    escala_precio = ESCALA_PRECIO // CENTAVOS
+    cargo_variable = _dividir_redondeo(kwh * precio_kwh, escala_precio)
+    ctt = _dividir_redondeo(kwh * ctt_kwh, escala_precio)
+    bonificacion = np.minimum(bonificacion, cargo_fijo + cargo_variable)
+    if not np.ndim(bonificacion):
+        bonificacion = int(bonificacion)
+    subtotal_energia = cargo_fijo + cargo_variable + ctt - bonificacion
+
+    iva = _dividir_redondeo(subtotal_energia * iva, ESCALA_ALICUOTA)
+    ley_7290 = _dividir_redondeo(subtotal_energia * _ALICUOTA_7290, ESCALA_ALICUOTA)
+    art_75 = _dividir_redondeo(subtotal_energia * _ALICUOTA_ART_75, ESCALA_ALICUOTA)
+    art_72bis = _dividir_redondeo(subtotal_energia * _ALICUOTA_ART_72BIS, ESCALA_ALICUOTA)
+    fondo = _dividir_redondeo(subtotal_energia * _ALICUOTA_FONDO, ESCALA_ALICUOTA)
+    subtotal_leyes = iva + ley_7290 + art_75 + art_72bis + fondo
+    total = subtotal_energia + subtotal_leyes + alumbrado
+    res_asamblea = _dividir_redondeo(subtotal_energia * ALICUOTA_RES_ASAMBLEA, ESCALA_ALICUOTA)
+    otros_conceptos = res_asamblea + BOMBEROS_CENTAVOS
+    return {
+        "cargo_fijo": cargo_fijo,
+        "cargo_variable": cargo_variable,
+        "ctt": ctt,
+        "bonificacion": bonificacion,
+        "subtotal_energia": subtotal_energia,
+        "iva": iva,
+        "ley_7290": ley_7290,
+        "art_75": art_75,
+        "art_72bis": art_72bis,
+        "fondo": fondo,
+        "subtotal_leyes": subtotal_leyes,
+        "alumbrado": alumbrado,
+        "total": total,
+        "res_asamblea": res_asamblea,
+        "otros_conceptos": otros_conceptos,
+        "total_general": total + otros_conceptos,
+    }
+
+
+# ============================================
+# ÍNDICE DE ESCALONES
+# ============================================
+
+class IndiceEscalones:
+    """
+    Índice de cortes ordenados de los escalones de una tarifa.
+
+    Los 'desde'/'hasta' de todos los escalones se ordenan en una lista de
+    cortes; cada tramo entre dos cortes consecutivos guarda la posición del
+    primer escalón (en el orden original) que lo contiene, o la del último si
+    ninguno lo hace. Así la búsqueda es un bisect/searchsorted y devuelve lo
+    mismo que recorrer la lista comparando desde <= kwh < hasta.
+    """
+
+    def __init__(self, escalones: List[dict]):
+        if not escalones:
+            raise ValueError("La tarifa no tiene escalones")
+        self.escalones = escalones
+        ultimo = len(escalones) - 1
+        cortes = sorted({e["desde"] for e in escalones} | {e["hasta"] for e in escalones})
+        # tramo 0: kwh < cortes[0]; tramo j: cortes[j-1] <= kwh < cortes[j]; tramo final: >= último corte
+        tramos = [ultimo]
+        for inicio, fin in zip(cortes, cortes[1:]):
+            pos = next((i for i, e in enumerate(escalones)
+                        if e["desde"] <= inicio and fin <= e["hasta"]), ultimo)
+            tramos.append(pos)
+        tramos.append(ultimo)
+
+        self.cortes = cortes
+        self.tramos = tramos
+        self._cortes_np = np.asarray(cortes, dtype=np.float64)
+        self._tramos_np = np.asarray(tramos, dtype=np.int64)
+        self.cargos_fijos = np.array([e["cargo_fijo"] for e in escalones], dtype=np.float64)
+        self.cargos_variables = np.array([e["cargo_variable"] for e in escalones], dtype=np.float64)
+        # Los mismos cargos en la aritmética entera de facturación
+        self.cargos_fijos_centavos = _a_entero(self.cargos_fijos, CENTAVOS)
+        self.precios_kwh = _a_entero(self.cargos_variables, ESCALA_PRECIO)
+        self.cargos_fijos_centavos_py = self.cargos_fijos_centavos.tolist()
+        self.precios_kwh_py = self.precios_kwh.tolist()
+        # Curvas de factura compiladas sobre este índice: (iva_rate, zona) -> CurvaFactura
+        self.curvas: Dict[Tuple[float, int], "CurvaFactura"] = {}
+
+    def posicion(self, kwh: float) -> int:
+        """Posición del escalón que corresponde a un consumo."""
+        return self.tramos[bisect_right(self.cortes, kwh)]
+
+    def posiciones(self, kwh: np.ndarray) -> np.ndarray:
+        """Posición del escalón de cada consumo de un array."""
+        return self._tramos_np[np.searchsorted(self._cortes_np, kwh, side="right")]
+
+    def buscar(self, kwh: float) -> dict:
+        """Escalón (dict) que corresponde a un consumo."""
+        return self.escalones[self.posicion(kwh)]
+
+
+def compilar_indices(tarifas: dict) -> Dict[str, IndiceEscalones]:
+    """Compila un IndiceEscalones por cada código de tarifa."""
+    return {cod: IndiceEscalones(t["escalones"]) for cod, t in tarifas.items()}
+
+
+# Caché de índices por versión de cuadro tarifario. La clave es la identidad
+# del dict 'tarifas' (se guarda también la referencia, así el id no se puede
+# reutilizar mientras la entrada exista). Paso 2 edita los cargos en el mismo
+# dict, por eso llama a recompilar_indices al confirmar.
+_MAX_INDICES = 32
+_indices_cache: "OrderedDict[int, Tuple[dict, Dict[str, IndiceEscalones]]]" = OrderedDict()
+_indices_lock = threading.Lock()
+
+
+def indices_tarifas(tarifas: dict) -> Dict[str, IndiceEscalones]:
+    """Índices compilados de un cuadro tarifario (se compilan una sola vez)."""
+    with _indices_lock:
+        entrada = _indices_cache.get(id(tarifas))
+        if entrada is not None and entrada[0] is tarifas:
+            _indices_cache.move_to_end(id(tarifas))
+            return entrada[1]
+    indices = compilar_indices(tarifas)
+    with _indices_lock:
+        _indices_cache[id(tarifas)] = (tarifas, indices)
+        while len(_indices_cache) > _MAX_INDICES:
+            _indices_cache.popitem(last=False)
+    return indices
+
+
+def recompilar_indices(tarifas: dict) -> Dict[str, IndiceEscalones]:
+    """Descarta el índice de un cuadro tarifario editado y lo vuelve a compilar."""
+    with _indices_lock:
+        _indices_cache.pop(id(tarifas), None)
+    return indices_tarifas(tarifas)
+
+
+# ============================================
+# FACTURA INDIVIDUAL
+# ============================================
+
+def obtener_escalon(tarifa: str, kwh: int, tarifas: dict) -> dict:
+    """Obtiene el escalón correspondiente según tarifa y consumo."""
+    return indices_tarifas(tarifas)[tarifa].buscar(kwh)
+
+
+def calcular_factura(tarifa: str, kwh: int, iva_rate: float, tarifas: dict,
+                     zona_alumbrado: int = 1) -> dict:
+    """Calcula todos los componentes de una factura eléctrica (importes en pesos)."""
+    indice = indices_tarifas(tarifas)[tarifa]
+    pos = indice.posicion(kwh)
+    importes = importes_centavos(
+        int(kwh),
+        indice.cargos_fijos_centavos_py[pos],
+        indice.precios_kwh_py[pos],
+        CTT_POR_KWH_ESCALADO.get(tarifa, 0),
+        _a_entero(iva_rate, ESCALA_ALICUOTA),
+        ALUMBRADO_CENTAVOS.get(zona_alumbrado, ALUMBRADO_DEFECTO_CENTAVOS),
+    )
+    return _armar_factura(tarifa, kwh, iva_rate, indice.escalones[pos],
+                          {k: v / CENTAVOS for k, v in importes.items()})
+
+
+def _armar_factura(tarifa: str, kwh: int, iva_rate: float, escalon: dict,
+                   importes: Mapping[str, float]) -> dict:
+    """Arma el dict de factura (desglose con textos + resumen) a partir de los importes."""
+    iva_label = "Monotributo IVA 27%" if iva_rate == 0.27 else f"I.V.A. {iva_rate*100:.0f}%"
+
+    energia = [
+        {"concepto": f"Cargo Fijo {tarifa} ({escalon['nombre']})", "importe": importes["cargo_fijo"], "tipo": "energia"},
+        {"concepto": f"Cargo Variable {tarifa} ({kwh} kWh x ${escalon['cargo_variable']:.4f})", "importe": importes["cargo_variable"], "tipo": "energia"},
+        {"concepto": f"CTT Art 5° Resol 2019-189 ({kwh} x {CTT_POR_KWH.get(tarifa, 0):.4f})", "importe": importes["ctt"], "tipo": "energia"},
+    ]
+    if importes.get("bonificacion"):
+        energia.append({"concepto": "Bonificación Tarifa Social", "importe": -importes["bonificacion"], "tipo": "energia"})
+
+    return {
+        "escalon": escalon,
+        "desglose": [
+            *energia,
+            {"concepto": "Subtotal Energía", "importe": importes["subtotal_energia"], "tipo": "subtotal"},
+            {"concepto": iva_label, "importe": importes["iva"], "tipo": "ley"},
+            {"concepto": "Ley Provincial 7290", "importe": importes["ley_7290"], "tipo": "ley"},
+            {"concepto": "Ley 11769 Art 75 (6%- Ex.9226)", "importe": importes["art_75"], "tipo": "ley"},
+            {"concepto": "Ley 11769 art.72 Bis (0,001%)", "importe": importes["art_72bis"], "tipo": "ley"},
+            {"concepto": "Ley 11769 Fondo Compensador", "importe": importes["fondo"], "tipo": "ley"},
+            {"concepto": "Subtotal Leyes", "importe": importes["subtotal_leyes"], "tipo": "subtotal"},
+            {"concepto": "Alumbrado Público ord 2945/23", "importe": importes["alumbrado"], "tipo": "otro"},
+        ],
+        "otros_conceptos": [
+            {"concepto": "Res. Asam 21/10/15", "importe": importes["res_asamblea"]},
+            {"concepto": "Bomberos", "importe": BOMBEROS},
+            {"concepto": "TOTAL", "importe": importes["otros_conceptos"]},
+        ],
+        "resumen": {
+            "subtotal_energia": importes["subtotal_energia"],
+            "iva": importes["iva"],
+            "subtotal_leyes": importes["subtotal_leyes"],
+            "alumbrado": importes["alumbrado"],
+            "total": importes["total"],
+            "otros_conceptos": importes["otros_conceptos"],
+            "total_general": importes["total_general"],
+        },
+    }
+
+
+# ============================================
+# CURVA DE FACTURA
+# ============================================
+
+class CurvaFactura:
+    """
+    Factura de una tarifa, condición de IVA y zona como función del consumo.
+
+    Compila una vez lo que no depende del consumo (CTT, alícuota de IVA y
+    alumbrado en la aritmética entera); evaluar un rango de consumos es un
+    searchsorted más importes_centavos sobre arrays, con el mismo redondeo
+    por renglón que calcular_factura, así que los valores coinciden al
+    centavo. Los consumos se toman como kWh enteros, igual que en la factura.
+    """
+
+    def __init__(self, indice: IndiceEscalones, tarifa: str, iva_rate: float,
+                 zona_alumbrado: int = 1):
+        self.indice = indice
+        self.tarifa = tarifa
+        self.iva_rate = iva_rate
+        self._ctt_kwh = CTT_POR_KWH_ESCALADO.get(tarifa, 0)
+        self._iva = _a_entero(iva_rate, ESCALA_ALICUOTA)
+        self._alumbrado = ALUMBRADO_CENTAVOS.get(zona_alumbrado, ALUMBRADO_DEFECTO_CENTAVOS)
+
+    def importes(self, kwh) -> Dict[str, np.ndarray]:
+        """Importes en centavos (int64) de cada consumo, como los de facturar_lote."""
+        kwh = np.asarray(kwh, dtype=np.int64)
+        pos = self.indice.posiciones(kwh)
+        return importes_centavos(kwh, self.indice.cargos_fijos_centavos[pos],
+                                 self.indice.precios_kwh[pos], self._ctt_kwh,
+                                 self._iva, self._alumbrado)
+
+    def subtotal_energia(self, kwh) -> np.ndarray:
+        return self.importes(kwh)["subtotal_energia"] / CENTAVOS
+
+    def total(self, kwh) -> np.ndarray:
+        """Total Liquidación Servicios Públicos ('resumen'['total'] de calcular_factura)."""
+        return self.importes(kwh)["total"] / CENTAVOS
+
+    def total_general(self, kwh) -> np.ndarray:
+        """Total más otros conceptos (Res. Asamblea y Bomberos)."""
+        return self.importes(kwh)["total_general"] / CENTAVOS
+
+
+def curva_factura(tarifa: str, iva_rate: float, tarifas: dict,
+                  zona_alumbrado: int = 1) -> CurvaFactura:
+    """Curva compilada de una tarifa (se guarda junto al índice, que Paso 2 recompila)."""
+    indice = indices_tarifas(tarifas)[tarifa]
+    clave = (iva_rate, zona_alumbrado)
+    curva = indice.curvas.get(clave)
+    if curva is None:
+        curva = indice.curvas[clave] = CurvaFactura(indice, tarifa, iva_rate, zona_alumbrado)
+    return curva
+
+
+# ============================================
+# FACTURACIÓN EN LOTE (columnar)
+# ============================================
+
+def facturar_lote(tarifa: Iterable[str], kwh: Iterable[int], iva_rate: Iterable[float],
+                  tarifas: dict, zona_alumbrado: Optional[Iterable[int]] = None,
+                  index: Optional[Iterable] = None,
+                  bonificaciones: Optional[Mapping[str, Sequence[Sequence[float]]]] = None) -> pd.DataFrame:
+    """
+    Calcula en una sola pasada las facturas de todo un padrón.
+
+    Recibe columnas (listas, arrays o Series) de igual largo y devuelve un
+    DataFrame con una fila por servicio: tarifa, kwh, iva_rate, escalon
+    (posición dentro de tarifas[tarifa]['escalones']) y las COLUMNAS_IMPORTES
+    en centavos (int64). Los importes coinciden exactamente con los de
+    calcular_factura; el desglose con textos se arma a pedido con
+    detalle_factura.
+
+    bonificaciones: por código de tarifa, tramos [hasta kWh, $/mes] ordenados
+    (bonificaciones_t1r_tramos de Anexo 104); cada servicio recibe la del
+    primer tramo con kwh <= hasta.
+
+    Las columnas que no son importes van en tipos chicos (tarifa categórica
+    con las tarifas del cuadro como categorías, kwh int32, escalon int8)
+    para que el resultado de un padrón grande ocupe poco en la sesión.
+    """
+    tarifa = np.asarray(tarifa, dtype=object)
+    kwh = np.asarray(kwh, dtype=np.int64)
+    iva_rate = np.asarray(iva_rate, dtype=np.float64)
+    n = len(kwh)
+    if zona_alumbrado is None:
+        zona_alumbrado = np.ones(n, dtype=np.int64)
+    zona_alumbrado = np.asarray(zona_alumbrado)
+
+    # Escalón, cargos y CTT por grupo de tarifa
+    indices = indices_tarifas(tarifas)
+    escalon = np.zeros(n, dtype=np.int64)
+    cargo_fijo = np.zeros(n, dtype=np.int64)
+    precio_kwh = np.zeros(n, dtype=np.int64)
+    ctt_kwh = np.zeros(n, dtype=np.int64)
+    bonificacion = np.zeros(n, dtype=np.int64)
+    for cod in pd.unique(tarifa):
+        with span("facturacion_tarifa", tarifa=cod):
+            mask = tarifa == cod
+            indice = indices[cod]
+            pos = indice.posiciones(kwh[mask])
+            escalon[mask] = pos
+            cargo_fijo[mask] = indice.cargos_fijos_centavos[pos]
+            precio_kwh[mask] = indice.precios_kwh[pos]
+            ctt_kwh[mask] = CTT_POR_KWH_ESCALADO.get(cod, 0)
+            if bonificaciones and bonificaciones.get(cod):
+                hasta, valor = np.asarray(bonificaciones[cod], dtype=np.float64).T
+                tramo = np.minimum(np.searchsorted(hasta, kwh[mask], side="left"), len(hasta) - 1)
+                bonificacion[mask] = _a_entero(valor, CENTAVOS)[tramo]
+
+    with span("facturacion_importes"):
+        alumbrado = (pd.Series(zona_alumbrado).map(ALUMBRADO_CENTAVOS)
+                     .fillna(ALUMBRADO_DEFECTO_CENTAVOS).to_numpy(dtype=np.int64))
+        importes = importes_centavos(kwh, cargo_fijo, precio_kwh, ctt_kwh,
+                                     _a_entero(iva_rate, ESCALA_ALICUOTA), alumbrado, bonificacion)
+
+    return pd.DataFrame({
+        "tarifa": pd.Categorical(tarifa, categories=list(tarifas)),
+        "kwh": kwh.astype(TIPOS_RESULTADO["kwh"]),
+        "iva_rate": iva_rate.astype(TIPOS_RESULTADO["iva_rate"], copy=False),
+        "escalon": escalon.astype(TIPOS_RESULTADO["escalon"]),
+        **{col: importes[col].astype(TIPOS_RESULTADO[col], copy=False) for col in COLUMNAS_IMPORTES},
+    }, index=None if index is None else list(index))
+
+
+# ============================================
+# FACTURACIÓN POR SEGMENTO (N1/N2/N3)
+# ============================================
+
+class CuadroSegmento(NamedTuple):
+    """Cuadro con el que se factura un segmento: tarifas y bonificaciones por tarifa."""
+    tarifas: dict
+    bonificaciones: Dict[str, List[List[float]]]
+
+
+def cuadros_por_segmento(tarifas: dict, segmentos: Mapping[str, dict]) -> Dict[str, CuadroSegmento]:
+    """
+    Arma el cuadro de cada segmento a partir de los Anexos extraídos.
+
+    Args:
+        tarifas: cuadro validado en Paso 2; cubre las tarifas que el Anexo
+            de un segmento no trae (Anexo 104 no tiene T1RE)
+        segmentos: nivel ('N1', 'N2', 'N3') -> resultado de extract_tariffs
+
+    Los escalones de cada segmento tienen que tener los mismos rangos que
+    los de tarifas: así la posición del escalón significa lo mismo en toda
+    la corrida (nombres, agregados por escalón).
+    """
+    cuadros = {}
+    for nivel, data in segmentos.items():
+        propias = {**tarifas, **data["tarifas"]}
+        for cod, tarifa in data["tarifas"].items():
+            base = tarifas.get(cod)
+            if base is not None and ([(e["desde"], e["hasta"]) for e in tarifa["escalones"]]
+                                     != [(e["desde"], e["hasta"]) for e in base["escalones"]]):
+                raise ValueError(f"Los escalones de {cod} en {nivel} no coinciden con los del cuadro validado")
+        tramos = data.get("bonificaciones_t1r_tramos")
+        if tramos is None and data.get("bonificaciones_t1r"):
+            # Sin rangos, la bonificación de cada escalón R1..Rn hasta su 'hasta'
+            escalones = propias["T1R"]["escalones"]
+            tramos = [[escalones[int(r) - 1]["hasta"], v] for r, v in data["bonificaciones_t1r"].items()
+                      if 0 < int(r) <= len(escalones)]
+        cuadros[nivel] = CuadroSegmento(propias, {"T1R": sorted(tramos)} if tramos else {})
+    return cuadros
+
+
+def facturar_segmentos(tarifa: Iterable[str], kwh: Iterable[int], iva_rate: Iterable[float],
+                       segmentacion: Iterable[str], cuadros: Mapping[str, CuadroSegmento],
+                       tarifas: dict, zona_alumbrado: Optional[Iterable[int]] = None,
+                       index: Optional[Iterable] = None) -> pd.DataFrame:
+    """
+    facturar_lote por segmento: una pasada vectorizada por grupo, con el
+    cuadro y las bonificaciones del segmento. Los servicios de un segmento
+    sin cuadro se facturan con tarifas. Devuelve las filas en el orden de
+    entrada, con la columna 'segmento' además de las de facturar_lote.
+    """
+    tarifa = np.asarray(tarifa, dtype=object)
+    kwh = np.asarray(kwh)
+    iva_rate = np.asarray(iva_rate)
+    segmentacion = np.asarray(segmentacion, dtype=object)
+    zona_alumbrado = None if zona_alumbrado is None else np.asarray(zona_alumbrado)
+    index = pd.RangeIndex(len(kwh)) if index is None else pd.Index(index)
+
+    grupos = pd.Series(segmentacion).groupby(segmentacion, dropna=False, sort=True).indices
+    partes, posiciones = [], []
+    for nivel, filas in grupos.items():
+        cuadro = cuadros.get(nivel)
+        with span("facturacion_segmento", segmento=nivel):
+            parte = facturar_lote(
+                tarifa[filas], kwh[filas], iva_rate[filas],
+                cuadro.tarifas if cuadro else tarifas,
+                None if zona_alumbrado is None else zona_alumbrado[filas],
+                index=index[filas],
+                bonificaciones=cuadro.bonificaciones if cuadro else None,
+            )
+        parte["tarifa"] = parte["tarifa"].astype(object)
+        parte.insert(0, "segmento", nivel)
+        partes.append(parte)
+        posiciones.append(filas)
+    if not partes:
+        resultado = facturar_lote(tarifa, kwh, iva_rate, tarifas, zona_alumbrado, index=index)
+        resultado.insert(0, "segmento", pd.Series(dtype=object))
+    else:
+        resultado = pd.concat(partes).iloc[np.argsort(np.concatenate(posiciones), kind="stable")]
+    codigos = list(dict.fromkeys([*tarifas, *(c for q in cuadros.values() for c in q.tarifas)]))
+    resultado["tarifa"] = pd.Categorical(resultado["tarifa"], categories=codigos)
+    resultado["segmento"] = resultado["segmento"].astype("category")
+    return resultado
+
+
+def escalones_lote(tarifa: Iterable[str], kwh: Iterable[int], tarifas: dict,
+                   sin_tarifa: str = "N/A") -> np.ndarray:
+    """Nombre del escalón de cada servicio (sin_tarifa si la tarifa no está en el cuadro)."""
+    tarifa = np.asarray(tarifa, dtype=object)
+    kwh = np.asarray(kwh)
+    nombres = np.full(len(kwh), sin_tarifa, dtype=object)
+    indices = indices_tarifas(tarifas)
+    for cod in pd.unique(tarifa):
+        if cod not in indices:
+            continue
+        mask = tarifa == cod
+        indice = indices[cod]
+        nombres[mask] = np.array([e["nombre"] for e in indice.escalones], dtype=object)[indice.posiciones(kwh[mask])]
+    return nombres
+
+
+def detalle_factura(fila: Mapping, tarifas: dict,
+                    cuadros: Optional[Mapping[str, CuadroSegmento]] = None) -> dict:
+    """
+    Arma la factura completa (mismo formato que calcular_factura) de una fila
+    de facturar_lote, o de facturar_segmentos pasando los cuadros usados.
+    """
+    tarifa = fila["tarifa"]
+    cuadro = cuadros.get(fila["segmento"]) if cuadros and "segmento" in fila else None
+    if cuadro is not None:
+        tarifas = cuadro.tarifas
+    escalon = tarifas[tarifa]["escalones"][int(fila["escalon"])]
+    importes: Dict[str, float] = {col: int(fila.get(col, 0)) / CENTAVOS for col in COLUMNAS_IMPORTES}
+    return _armar_factura(tarifa, int(fila["kwh"]), float(fila["iva_rate"]), escalon, importes)
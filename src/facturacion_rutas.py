@@ -0,0 +1,372 @@
+"""
+COEMA - Corrida de facturación por rutas
+Divide el padrón por ruta de lectura, factura las rutas en paralelo en un
+pool de procesos y guarda un checkpoint por ruta terminada, para que una
+corrida interrumpida se reanude sin recalcular lo que ya estaba hecho
+(los checkpoints de cuadros y padrones viejos se podan al terminar).
+Con cuadros por segmento, cada ruta se factura con facturar_segmentos.
+Cuando solo se corrigen cargos de algunos escalones, refacturar_escalones
+recalcula únicamente los servicios facturados en esos escalones.
+agregados_facturacion resume la corrida (histograma de totales, totales por
+ruta, tarifa y escalón, composición) para que los gráficos no dependan del
+tamaño del padrón.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
+from typing import Callable, Dict, Iterable, Mapping, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from facturacion import CENTAVOS, TIPOS_RESULTADO, CuadroSegmento, facturar_lote, facturar_segmentos
+from metricas import incrementar, registrar_duracion, span
+
+# Columnas mínimas del padrón (índice = número de socio)
+COLUMNAS_PADRON = ["ruta", "tarifa", "consumo_kwh", "iva", "zona_alumbrado"]
+
+# Columna del padrón con el segmento (N1/N2/N3), para facturar por segmento
+COLUMNA_SEGMENTO = "segmentacion"
+
+# Totales de la corrida que se muestran y se corrigen al refacturar
+COLUMNAS_TOTALES = ["total", "otros_conceptos", "total_general"]
+
+# Clases del histograma de totales por factura
+HISTOGRAMA_CLASES = 40
+
+# Columnas de resultados que no dependen de los cargos del escalón
+_COLUMNAS_FIJAS = ["ruta", "tarifa", "kwh", "iva_rate", "escalon"]
+
+# Por debajo de este tamaño de padrón el costo de levantar el pool supera
+# la ganancia: las rutas se facturan en el mismo proceso.
+MIN_SERVICIOS_POOL = 2000
+
+CHECKPOINTS_DIR = os.environ.get(
+    "COEMA_CHECKPOINTS_DIR",
+    os.path.join(tempfile.gettempdir(), "coema_checkpoints"),
+)
+
+# Cuadros tarifarios (subdirectorios de checkpoints) que se conservan: los
+# usados más recientemente. Los demás se borran al terminar cada corrida.
+MAX_CHECKPOINTS_CUADROS = 4
+
+# Un .tmp más viejo que esto es de una escritura que no terminó
+_TMP_HUERFANO_SEG = 3600
+
+# Tarifas y cuadros por segmento del worker (se cargan una vez por proceso en _init_worker)
+_tarifas_worker: Optional[dict] = None
+_cuadros_worker: Optional[Mapping[str, CuadroSegmento]] = None
+
+
+def huella_tarifas(tarifas: dict) -> str:
+    """Hash estable del contenido de un cuadro tarifario."""
+    data = json.dumps(tarifas, sort_keys=True, default=float).encode()
+    return hashlib.sha256(data).hexdigest()[:16]
+
+
+def huella_padron(padron: pd.DataFrame) -> str:
+    """Hash estable de las filas de un padrón (o de una ruta)."""
+    columnas = COLUMNAS_PADRON + [COLUMNA_SEGMENTO] if COLUMNA_SEGMENTO in padron else COLUMNAS_PADRON
+    h = pd.util.hash_pandas_object(padron[columnas], index=True)
+    return hashlib.sha256(h.to_numpy().tobytes()).hexdigest()[:16]
+
+
+def _facturar_ruta(padron_ruta: pd.DataFrame, tarifas: dict,
+                   cuadros: Optional[Mapping[str, CuadroSegmento]] = None) -> pd.DataFrame:
+    columnas = dict(
+        tarifa=padron_ruta["tarifa"].to_numpy(),
+        kwh=padron_ruta["consumo_kwh"].to_numpy(),
+        iva_rate=padron_ruta["iva"].to_numpy(),
+        tarifas=tarifas,
+        zona_alumbrado=padron_ruta["zona_alumbrado"].to_numpy(),
+        index=padron_ruta.index,
+    )
+    if cuadros is None:
+        resultado = facturar_lote(**columnas)
+    else:
+        resultado = facturar_segmentos(segmentacion=padron_ruta[COLUMNA_SEGMENTO].to_numpy(),
+                                       cuadros=cuadros, **columnas)
+    resultado.insert(0, "ruta", padron_ruta["ruta"].to_numpy())
+    return resultado
+
+
+def _init_worker(tarifas: dict, cuadros: Optional[Mapping[str, CuadroSegmento]] = None):
+    global _tarifas_worker, _cuadros_worker
+    _tarifas_worker = tarifas
+    _cuadros_worker = cuadros
+
+
+def _tarea_ruta(ruta, padron_ruta: pd.DataFrame) -> Tuple[object, pd.DataFrame, float]:
+    """Tarea del pool: factura una ruta y devuelve (ruta, resultado, segundos)."""
+    t0 = time.perf_counter()
+    resultado = _facturar_ruta(padron_ruta, _tarifas_worker, _cuadros_worker)
+    return ruta, resultado, time.perf_counter() - t0
+
+
+# Formato de los resultados guardados en los checkpoints: columnas y tipos
+# de facturar_lote (una columna nueva o un importe que cambia de tipo
+# cambian este valor, y podar_checkpoints borra los del formato anterior)
+_FORMATO_CHECKPOINT = hashlib.sha256(json.dumps(list(TIPOS_RESULTADO.items())).encode()).hexdigest()[:8]
+
+
+def _ruta_checkpoint(directorio: str, ruta, huella: str) -> str:
+    return os.path.join(directorio, f"ruta_{ruta}_{huella}_{_FORMATO_CHECKPOINT}.pkl")
+
+
+def podar_checkpoints(directorio: str, vigente: str, vigentes: Iterable[str],
+                      conservar: int = MAX_CHECKPOINTS_CUADROS) -> int:
+    """
+    Mantiene acotado el directorio de checkpoints después de una corrida.
+
+    En el subdirectorio del cuadro vigente borra los checkpoints que no son
+    de esta corrida (rutas con otro padrón, versiones viejas del formato) y
+    los .tmp abandonados; de los demás cuadros conserva los conservar - 1
+    usados más recientemente. Devuelve cuántos archivos y directorios borró.
+    """
+    vigentes = {os.path.basename(p) for p in vigentes}
+    borrados = 0
+    ruta_vigente = os.path.join(directorio, vigente)
+    os.utime(ruta_vigente)  # la fecha del directorio marca el último uso
+    ahora = time.time()
+    for entrada in os.scandir(ruta_vigente):
+        if entrada.name in vigentes or not entrada.is_file():
+            continue
+        if ".tmp" in entrada.name and ahora - entrada.stat().st_mtime < _TMP_HUERFANO_SEG:
+            continue  # puede ser de una corrida en curso
+        try:
+            os.remove(entrada.path)
+            borrados += 1
+        except OSError:
+            pass
+    otros = sorted((e for e in os.scandir(directorio) if e.is_dir() and e.name != vigente),
+                   key=lambda e: e.stat().st_mtime, reverse=True)
+    for entrada in otros[max(conservar - 1, 0):]:
+        shutil.rmtree(entrada.path, ignore_errors=True)
+        borrados += 1
+    return borrados
+
+
+def _guardar_checkpoint(path: str, resultado: pd.DataFrame):
+    """Escritura atómica: un checkpoint a medio escribir nunca se lee."""
+    # Otra corrida pudo haber podado el directorio mientras tanto
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.tmp{os.getpid()}"
+    resultado.to_pickle(tmp)
+    os.replace(tmp, path)
+
+
+def facturar_por_rutas(
+    padron: pd.DataFrame,
+    tarifas: dict,
+    directorio_checkpoints: Optional[str] = None,
+    max_workers: Optional[int] = None,
+    al_terminar_ruta: Optional[Callable[[Dict], None]] = None,
+    cuadros: Optional[Mapping[str, CuadroSegmento]] = None,
+    reusar_checkpoints: bool = True,
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Factura todo el padrón ruta por ruta.
+
+    Args:
+        padron: DataFrame indexado por socio con COLUMNAS_PADRON. Los socios
+            con tarifa fuera del cuadro deben filtrarse antes.
+        tarifas: cuadro tarifario validado (dict 'tarifas' de extract_tariffs)
+        directorio_checkpoints: si se indica, cada ruta terminada se guarda ahí
+            y las rutas con checkpoint vigente (mismas tarifas y mismas filas)
+            no se recalculan. Al terminar se podan los checkpoints viejos
+            (podar_checkpoints). None desactiva los checkpoints.
+        max_workers: procesos del pool. 1 factura en el mismo proceso; None
+            usa un proceso por CPU (el pool solo se levanta si el padrón
+            tiene al menos MIN_SERVICIOS_POOL servicios).
+        al_terminar_ruta: callback con las estadísticas de cada ruta, en el
+            orden en que van terminando.
+        cuadros: cuadros_por_segmento; si se indican, el padrón necesita la
+            columna COLUMNA_SEGMENTO y cada segmento se factura con su cuadro.
+        reusar_checkpoints: False recalcula todas las rutas aunque tengan
+            checkpoint vigente (y lo reemplaza).
+
+    Returns:
+        (resultados, estadisticas): resultados de facturar_lote (o de
+        facturar_segmentos) más la columna 'ruta', en el orden del padrón; estadisticas con una fila por ruta
+        (servicios, segundos, servicios_por_seg, origen).
+    """
+    if directorio_checkpoints:
+        huella = huella_tarifas(tarifas if cuadros is None else [tarifas, cuadros])
+        directorio_checkpoints = os.path.join(directorio_checkpoints, huella)
+        os.makedirs(directorio_checkpoints, exist_ok=True)
+
+    resultados: Dict[object, pd.DataFrame] = {}
+    estadisticas = []
+
+    def registrar(ruta, resultado, segundos, origen):
+        resultados[ruta] = resultado
+        stats = {
+            "ruta": ruta,
+            "servicios": len(resultado),
+            "segundos": segundos,
+            "servicios_por_seg": len(resultado) / segundos if segundos > 0 else float("inf"),
+            "origen": origen,
+        }
+        estadisticas.append(stats)
+        incrementar("coema_rutas_facturadas_total", origen=origen)
+        incrementar("coema_servicios_facturados_total", len(resultado), origen=origen)
+        if al_terminar_ruta:
+            al_terminar_ruta(stats)
+
+    # Rutas pendientes (las que tienen checkpoint vigente se leen de disco)
+    pendientes = []
+    checkpoints = {}
+    for ruta, padron_ruta in padron.groupby("ruta", sort=True, observed=True):
+        if directorio_checkpoints:
+            path = _ruta_checkpoint(directorio_checkpoints, ruta, huella_padron(padron_ruta))
+            checkpoints[ruta] = path
+            if reusar_checkpoints and os.path.exists(path):
+                t0 = time.perf_counter()
+                with span("facturacion_ruta", ruta=ruta, origen="checkpoint"):
+                    resultado = pd.read_pickle(path)
+                registrar(ruta, resultado, time.perf_counter() - t0, "checkpoint")
+                continue
+        pendientes.append((ruta, padron_ruta))
+
+    def terminar(ruta, resultado, segundos):
+        if directorio_checkpoints:
+            _guardar_checkpoint(checkpoints[ruta], resultado)
+        registrar(ruta, resultado, segundos, "calculada")
+
+    n_pendiente = sum(len(p) for _, p in pendientes)
+    usar_pool = (max_workers != 1 and len(pendientes) > 1
+                 and (max_workers is not None or n_pendiente >= MIN_SERVICIOS_POOL))
+    if usar_pool:
+        workers = min(max_workers or os.cpu_count() or 1, len(pendientes))
+        # spawn: el proceso de Streamlit tiene hilos vivos y fork no es seguro
+        with ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn"),
+                                 initializer=_init_worker, initargs=(tarifas, cuadros)) as pool:
+            futuros = [pool.submit(_tarea_ruta, ruta, p) for ruta, p in pendientes]
+            for futuro in as_completed(futuros):
+                ruta, resultado, segundos = futuro.result()
+                # Los spans de adentro de la ruta quedan en el worker
+                registrar_duracion("facturacion_ruta", segundos, ruta=ruta, origen="calculada")
+                terminar(ruta, resultado, segundos)
+    else:
+        for ruta, padron_ruta in pendientes:
+            t0 = time.perf_counter()
+            with span("facturacion_ruta", ruta=ruta, origen="calculada"):
+                resultado = _facturar_ruta(padron_ruta, tarifas, cuadros)
+            terminar(ruta, resultado, time.perf_counter() - t0)
+
+    if directorio_checkpoints:
+        try:
+            podar_checkpoints(os.path.dirname(directorio_checkpoints), huella, checkpoints.values())
+        except OSError:
+            pass  # la poda es de mantenimiento: no invalida una corrida ya terminada
+
+    if resultados:
+        df = pd.concat(resultados.values()).loc[padron.index]
+    else:
+        df = _facturar_ruta(padron.iloc[:0], tarifas, cuadros)
+    return df, pd.DataFrame(estadisticas)
+
+
+# ============================================
+# REFACTURACIÓN INCREMENTAL
+# ============================================
+
+def indice_dependencias(resultados: pd.DataFrame) -> Dict[Tuple[str, int], np.ndarray]:
+    """(tarifa, posición del escalón) -> posiciones en resultados de los servicios facturados ahí."""
+    grupos = resultados.groupby(["tarifa", "escalon"], observed=True, sort=False).indices
+    return {(str(tarifa), int(escalon)): filas.astype(np.int32) for (tarifa, escalon), filas in grupos.items()}
+
+
+def totales_facturacion(resultados: pd.DataFrame) -> Dict[str, int]:
+    """Totales de la corrida en centavos (suma entera, exacta)."""
+    return {c: int(resultados[c].sum()) for c in COLUMNAS_TOTALES}
+
+
+def agregados_facturacion(resultados: pd.DataFrame, tarifas: dict,
+                          clases: int = HISTOGRAMA_CLASES) -> Dict[str, pd.DataFrame]:
+    """
+    Resúmenes de la corrida para graficar, de tamaño fijo (no crecen con el padrón).
+
+    Devuelve:
+        histograma: desde/hasta (pesos) y servicios por clase del total por factura
+        por_ruta, por_tarifa: servicios, kwh y total (centavos) por grupo
+        por_escalon: igual, por (tarifa, escalón), con el nombre del escalón
+        composicion: suma en centavos de energía, leyes (inc. IVA) y alumbrado
+    """
+    total = resultados["total"].to_numpy()
+    servicios, bordes = np.histogram(total / CENTAVOS, bins=clases)
+    histograma = pd.DataFrame({"desde": bordes[:-1], "hasta": bordes[1:], "servicios": servicios})
+
+    def por(claves):
+        return (resultados.groupby(claves, observed=True, sort=True)
+                .agg(servicios=("total", "size"), kwh=("kwh", "sum"), total=("total", "sum"))
+                .reset_index())
+
+    por_escalon = por(["tarifa", "escalon"])
+    por_escalon.insert(2, "nombre", [tarifas[t]["escalones"][int(e)]["nombre"] if t in tarifas else "N/A"
+                                     for t, e in zip(por_escalon["tarifa"], por_escalon["escalon"])])
+    composicion = pd.DataFrame({
+        "concepto": ["Energía", "Leyes (inc. IVA)", "Alumbrado"],
+        "centavos": [int(resultados[c].sum()) for c in ("subtotal_energia", "subtotal_leyes", "alumbrado")],
+    })
+    return {
+        "histograma": histograma,
+        "por_ruta": por("ruta"),
+        "por_tarifa": por("tarifa"),
+        "por_escalon": por_escalon,
+        "composicion": composicion,
+    }
+
+
+def refacturar_escalones(
+    resultados: pd.DataFrame,
+    padron: pd.DataFrame,
+    tarifas: dict,
+    escalones: Iterable[Tuple[str, int]],
+    indice: Optional[Dict[Tuple[str, int], np.ndarray]] = None,
+    totales: Optional[Dict[str, int]] = None,
+) -> int:
+    """
+    Recalcula en el lugar los servicios facturados en los escalones indicados.
+
+    Sirve para correcciones de cargo_fijo / cargo_variable: el escalón de
+    cada servicio depende solo de los rangos, así que los demás servicios no
+    cambian. Si cambiaron los rangos (o el padrón), o la corrida se facturó
+    por segmento (cada segmento tiene su propio cuadro), hay que volver a
+    correr facturar_por_rutas.
+
+    Args:
+        resultados: salida de facturar_por_rutas (se modifica)
+        padron: DataFrame indexado por socio con COLUMNAS_PADRON
+        tarifas: cuadro tarifario ya corregido (con índices recompilados)
+        escalones: pares (tarifa, posición del escalón) editados
+        indice: indice_dependencias(resultados), para no recalcularlo
+        totales: totales_facturacion(resultados); se corrige con la diferencia
+
+    Returns:
+        Cantidad de servicios recalculados.
+    """
+    if "segmento" in resultados:
+        raise ValueError("La corrida se facturó por segmento: hay que refacturar todo el padrón")
+    indice = indice if indice is not None else indice_dependencias(resultados)
+    posiciones = [indice[clave] for clave in set(escalones) if clave in indice]
+    if not posiciones:
+        return 0
+    filas = np.sort(np.concatenate(posiciones))
+    anteriores = resultados.iloc[filas]
+    nuevos = _facturar_ruta(padron.loc[anteriores.index, COLUMNAS_PADRON], tarifas)
+    if not np.array_equal(nuevos["escalon"].to_numpy(), anteriores["escalon"].to_numpy()):
+        raise ValueError("Cambió el escalón de algún servicio: hay que refacturar todo el padrón")
+
+    if totales is not None:
+        for c in COLUMNAS_TOTALES:
+            totales[c] += int(nuevos[c].sum() - anteriores[c].sum())
+    for c in nuevos.columns.difference(_COLUMNAS_FIJAS, sort=False):
+        resultados.iloc[filas, resultados.columns.get_loc(c)] = nuevos[c].to_numpy()
+    return len(filas)
@@ -0,0 +1,275 @@
+"""
+COEMA - Facturación por línea de comandos
+Corrida completa del período sin Streamlit, para programarla de noche:
+carga el cuadro tarifario (PDF de OCEBA, vía cache de extracción, o JSON),
+lee el padrón de SgiMovil, factura con el mismo motor que la app
+(facturar_por_rutas) y escribe los resultados en Parquet o CSV y,
+opcionalmente, las facturas en PDF por ruta, el envío de cada factura por
+e-mail (SMTP configurado con las variables COEMA_SMTP_*) y los archivos de
+cobranza de los canales de pago. Los importes de los resultados van en
+centavos (enteros), como los devuelve facturar_lote. Con --segmentos se
+extraen además los Anexos de los otros niveles (en paralelo) y cada socio
+se factura con el cuadro de su segmentación.
+
+Uso:
+    python src/facturar_cli.py --pdf cuadro.pdf --padron lecturas.csv --salida facturas.parquet
+    python src/facturar_cli.py --tarifas tarifas.json --padron lecturas.txt --salida facturas.csv
+    python src/facturar_cli.py --pdf anexo6.pdf --segmentos anexo14.pdf anexo104.pdf --padron lecturas.csv --salida facturas.parquet
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import sys
+import time
+from typing import Dict, List, Optional
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from cobranza import EXPORTADORES, LayoutSinConfirmar, exportar_cobranza
+from facturacion import CENTAVOS, CuadroSegmento, cuadros_por_segmento, escalones_lote
+from envio_facturas import MENSAJES_POR_SEG, EnvioAbortado, enviar_facturas
+from facturacion_rutas import CHECKPOINTS_DIR, COLUMNA_SEGMENTO, COLUMNAS_PADRON, facturar_por_rutas
+from facturas_pdf import renderizar_facturas
+from padron import cargar_sgimovil
+from pdf_extractor import extract_tariffs_from_pdf, extract_tariffs_from_pdfs
+
+
+def cargar_cuadro(pdf: Optional[str], tarifas_json: Optional[str], use_cache: bool = True) -> dict:
+    """
+    Cuadro tarifario desde un PDF de OCEBA o desde un JSON, con la forma
+    del resultado de extract_tariffs ('tarifas' y, si se conoce, 'nivel').
+
+    El JSON puede ser el resultado completo de extract_tariffs (con clave
+    'tarifas') o directamente el dict de tarifas.
+    """
+    if pdf:
+        data = extract_tariffs_from_pdf(pdf, use_cache=use_cache)
+    else:
+        with open(tarifas_json, encoding="utf-8") as f:
+            data = json.load(f)
+    if "tarifas" not in data:
+        data = {"tarifas": data}
+    if not data["tarifas"]:
+        raise ValueError("El cuadro tarifario no tiene tarifas T1R/T1RE")
+    return data
+
+
+def cargar_segmentos(pdfs: List[str], cuadro: dict, use_cache: bool = True,
+                     max_workers: Optional[int] = None) -> Dict[str, CuadroSegmento]:
+    """
+    Extrae los Anexos de los otros niveles en paralelo y arma el cuadro de
+    cada segmento. El nivel del cuadro base (--pdf) usa ese cuadro, como en
+    la app, aunque también venga en pdfs.
+    """
+    segmentos = {}
+    for pdf, data in zip(pdfs, extract_tariffs_from_pdfs(pdfs, use_cache=use_cache,
+                                                          max_workers=max_workers)):
+        if isinstance(data, Exception):
+            raise ValueError(f"{pdf}: {data}")
+        if not data.get("tarifas") or not data.get("nivel"):
+            raise ValueError(f"{pdf}: no es un cuadro tarifario de OCEBA reconocido")
+        segmentos[data["nivel"]] = data
+    if cuadro.get("nivel"):
+        segmentos[cuadro["nivel"]] = cuadro
+    return cuadros_por_segmento(cuadro["tarifas"], segmentos)
+
+
+def escribir_resultados(resultados: pd.DataFrame, salida: str):
+    """Parquet si la extensión es .parquet (requiere pyarrow), si no CSV."""
+    os.makedirs(os.path.dirname(os.path.abspath(salida)), exist_ok=True)
+    if salida.lower().endswith(".parquet"):
+        try:
+            resultados.to_parquet(salida)
+        except ImportError as e:
+            raise SystemExit(f"Para escribir Parquet hace falta pyarrow: {e}")
+    else:
+        resultados.to_csv(salida)
+
+
+def cargar_emails(path: str) -> pd.Series:
+    """CSV con columnas socio,email (socio como texto, igual que en el padrón)."""
+    emails = pd.read_csv(path, dtype=str).dropna(subset=["socio", "email"])
+    return emails.set_index(emails["socio"].str.strip())["email"].str.strip()
+
+
+def cargar_adheridos(especificaciones: List[str]) -> Dict[str, pd.Index]:
+    """CANAL=ARCHIVO (CSV con columna socio) -> socios adheridos al débito del canal."""
+    adheridos = {}
+    for especificacion in especificaciones:
+        canal, sep, path = especificacion.partition("=")
+        if not sep or canal not in EXPORTADORES:
+            raise ValueError(f"--adheridos espera CANAL=ARCHIVO con CANAL en "
+                             f"{', '.join(EXPORTADORES)}: {especificacion}")
+        adheridos[canal] = pd.Index(pd.read_csv(path, dtype=str)["socio"].dropna().str.strip())
+    return adheridos
+
+
+def _ruta_estadisticas(salida: str) -> str:
+    base, _ext = os.path.splitext(salida)
+    return f"{base}_rutas.csv"
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Facturación del período sin interfaz.")
+    origen = parser.add_mutually_exclusive_group(required=True)
+    origen.add_argument("--pdf", help="cuadro tarifario de OCEBA (PDF)")
+    origen.add_argument("--tarifas", help="cuadro tarifario validado (JSON)")
+    parser.add_argument("--segmentos", nargs="+", metavar="PDF", default=[],
+                        help="Anexos de los otros niveles (N1/N2/N3): cada socio se factura "
+                             "con el de su segmentación")
+    parser.add_argument("--padron", required=True, help="exportación de lecturas de SgiMovil")
+    parser.add_argument("--formato", choices=["csv", "fwf"],
+                        help="formato del padrón (por defecto: fwf si es .txt, si no csv)")
+    parser.add_argument("--sep", default=",", help="separador del CSV")
+    parser.add_argument("--encoding", default="utf-8")
+    parser.add_argument("--periodo", help="período a facturar (AAAA-MM); por defecto el último")
+    parser.add_argument("--salida", required=True, help="resultados (.parquet o .csv)")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="procesos para facturar rutas (1 = sin pool)")
+    parser.add_argument("--checkpoints", default=CHECKPOINTS_DIR,
+                        help="directorio de checkpoints por ruta ('' para desactivar)")
+    parser.add_argument("--pdfs", metavar="DIRECTORIO",
+                        help="además, generar las facturas en PDF (un archivo por ruta)")
+    parser.add_argument("--emails", metavar="CSV",
+                        help="enviar cada factura por e-mail (CSV socio,email)")
+    parser.add_argument("--mensajes-por-seg", type=float, default=MENSAJES_POR_SEG,
+                        help="tope de envío de e-mails")
+    parser.add_argument("--cobranza", metavar="DIRECTORIO",
+                        help="escribir los archivos de cobranza de los canales de pago")
+    parser.add_argument("--canales", nargs="+", choices=list(EXPORTADORES),
+                        help="canales de cobranza (por defecto todos los que correspondan)")
+    parser.add_argument("--vencimiento", type=datetime.date.fromisoformat,
+                        help="primer vencimiento (AAAA-MM-DD), requerido con --cobranza")
+    parser.add_argument("--adheridos", metavar="CANAL=CSV", action="append", default=[],
+                        help="socios adheridos al débito automático de un canal (repetible)")
+    parser.add_argument("--layouts-preliminares", action="store_true",
+                        help="generar la cobranza aunque el layout del canal no esté confirmado "
+                             "(archivos marcados _preliminar)")
+    parser.add_argument("--sin-cache", action="store_true",
+                        help="no usar la cache de extracción de PDFs")
+    args = parser.parse_args(argv)
+    if args.cobranza and not args.vencimiento:
+        parser.error("--cobranza requiere --vencimiento")
+
+    tiempos = {}
+    try:
+        t0 = time.perf_counter()
+        cuadro = cargar_cuadro(args.pdf, args.tarifas, use_cache=not args.sin_cache)
+        tarifas = cuadro["tarifas"]
+        cuadros = (cargar_segmentos(args.segmentos, cuadro, use_cache=not args.sin_cache,
+                                    max_workers=args.workers) if args.segmentos else None)
+        tiempos["tarifas"] = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        formato = args.formato or ("fwf" if args.padron.lower().endswith(".txt") else "csv")
+        padron = cargar_sgimovil(args.padron, formato=formato, periodo=args.periodo,
+                                 sep=args.sep, encoding=args.encoding)
+        tiempos["padron"] = time.perf_counter() - t0
+        emails = cargar_emails(args.emails) if args.emails else None
+        adheridos = cargar_adheridos(args.adheridos)
+        if cuadros is not None and COLUMNA_SEGMENTO not in padron.servicios:
+            raise ValueError(f"--segmentos requiere la columna {COLUMNA_SEGMENTO} en el padrón")
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 2
+
+    servicios = padron.servicios
+    columnas = COLUMNAS_PADRON if cuadros is None else COLUMNAS_PADRON + [COLUMNA_SEGMENTO]
+    con_tarifa = servicios["tarifa"].isin(list(tarifas))
+    fuera_de_cuadro = servicios.index[~con_tarifa]
+    if len(fuera_de_cuadro):
+        print(f"Aviso: {len(fuera_de_cuadro)} servicios con tarifa fuera del cuadro "
+              f"(no se facturan)", file=sys.stderr)
+    if padron.sin_lectura:
+        print(f"Aviso: {len(padron.sin_lectura)} servicios sin lectura en {padron.periodo}",
+              file=sys.stderr)
+
+    t0 = time.perf_counter()
+    resultados, estadisticas = facturar_por_rutas(
+        servicios.loc[con_tarifa, columnas], tarifas,
+        directorio_checkpoints=args.checkpoints or None,
+        max_workers=args.workers,
+        cuadros=cuadros,
+    )
+    resultados.insert(resultados.columns.get_loc("escalon") + 1, "nombre_escalon",
+                      escalones_lote(resultados["tarifa"], resultados["kwh"], tarifas))
+    resultados.index.name = "socio"
+    tiempos["facturacion"] = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    escribir_resultados(resultados, args.salida)
+    estadisticas.to_csv(_ruta_estadisticas(args.salida), index=False)
+    tiempos["escritura"] = time.perf_counter() - t0
+
+    if args.pdfs:
+        t0 = time.perf_counter()
+        renderizar_facturas(resultados, servicios, tarifas, padron.periodo,
+                            directorio=args.pdfs, max_workers=args.workers, cuadros=cuadros)
+        tiempos["pdfs"] = time.perf_counter() - t0
+
+    cobranza = None
+    if args.cobranza:
+        t0 = time.perf_counter()
+        try:
+            archivos = exportar_cobranza(resultados, servicios, padron.periodo, args.vencimiento,
+                                         canales=args.canales, directorio=args.cobranza,
+                                         adheridos=adheridos, preliminares=args.layouts_preliminares)
+        except LayoutSinConfirmar as e:
+            print(f"Error: {e} (--layouts-preliminares)", file=sys.stderr)
+            return 2
+        except ValueError as e:
+            print(f"Error: {e}", file=sys.stderr)
+            return 2
+        cobranza = {r.canal: {"archivo": r.archivo, "registros": int(r.registros),
+                              "importe": round(float(r.importe), 2)}
+                    for r in archivos.itertuples()}
+        tiempos["cobranza"] = time.perf_counter() - t0
+
+    envio = None
+    if emails is not None:
+        t0 = time.perf_counter()
+        try:
+            envio = asyncio.run(enviar_facturas(resultados, servicios, emails, tarifas,
+                                                padron.periodo,
+                                                mensajes_por_seg=args.mensajes_por_seg,
+                                                cuadros=cuadros))
+        except EnvioAbortado as e:
+            print(f"Error: envío de facturas cortado, las pendientes siguen pendientes: {e}",
+                  file=sys.stderr)
+            return 2
+        envio["mensajes_por_seg"] = round(envio["mensajes_por_seg"], 1)
+        envio.pop("segundos")
+        tiempos["emails"] = time.perf_counter() - t0
+
+    resumen = {
+        "periodo": padron.periodo,
+        "servicios_facturados": len(resultados),
+        "servicios_fuera_de_cuadro": len(fuera_de_cuadro),
+        "servicios_sin_lectura": len(padron.sin_lectura),
+        "servicios_por_segmento": ({str(k): int(v) for k, v in
+                                    resultados["segmento"].value_counts(sort=False).items()}
+                                   if cuadros is not None else None),
+        "rutas": len(estadisticas),
+        "rutas_desde_checkpoint": int((estadisticas["origen"] == "checkpoint").sum())
+        if len(estadisticas) else 0,
+        "total": int(resultados["total"].sum()) / CENTAVOS,
+        "total_general": int(resultados["total_general"].sum()) / CENTAVOS,
+        "segundos": {k: round(v, 3) for k, v in tiempos.items()},
+        "servicios_por_seg": round(len(resultados) / tiempos["facturacion"], 1)
+        if tiempos["facturacion"] > 0 else None,
+        "salida": args.salida,
+        "estadisticas_rutas": _ruta_estadisticas(args.salida),
+        "pdfs": args.pdfs,
+        "cobranza": cobranza,
+        "emails": envio,
+    }
+    print(json.dumps(resumen, indent=2, ensure_ascii=False))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,348 @@
+"""
+COEMA - Impresión masiva de facturas en PDF
+Genera un PDF por ruta (una página por socio) con el desglose de cada
+factura. El PDF se escribe a mano, sin dependencias: la parte fija de la
+página (encabezado, rótulos, líneas) se compila una sola vez como Form
+XObject que todas las páginas reutilizan, y cada factura solo agrega sus
+valores. Las rutas se reparten en un pool de procesos y cada PDF se escribe
+en streaming, así la memoria no crece con el tamaño de la ruta.
+"""
+
+import io
+import os
+import tempfile
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
+from typing import BinaryIO, Callable, Dict, List, Mapping, Optional, Tuple
+
+import pandas as pd
+
+from facturacion import COLUMNAS_IMPORTES, CuadroSegmento, detalle_factura, fmt
+
+FACTURAS_DIR = os.environ.get(
+    "COEMA_FACTURAS_DIR",
+    os.path.join(tempfile.gettempdir(), "coema_facturas"),
+)
+
+# Atributos del servicio que se imprimen (además de los importes)
+COLUMNAS_SERVICIO_PDF = ["nombre", "direccion", "localidad", "medidor", "condicion_iva"]
+
+# Por debajo de esta cantidad de facturas no conviene levantar el pool
+MIN_FACTURAS_POOL = 2000
+
+EMPRESA = "COEMA - Cooperativa de Provisión de Energía Eléctrica y Otros Servicios de Madariaga Ltda."
+DOMICILIO_EMPRESA = "Zubiaurre 248 - CP 7163 - Gral. Madariaga | Tel: 02267-424347"
+
+# A4 en puntos
+ANCHO, ALTO = 595, 842
+MARGEN = 40
+
+# Fuentes estándar de PDF (no se embeben): nombre de recurso -> BaseFont
+FUENTES = {
+    "F1": "Helvetica",
+    "F2": "Helvetica-Bold",
+    "F3": "Courier",
+    "F4": "Courier-Bold",
+}
+
+# Números de objeto fijos de cada archivo
+_OBJ_CATALOGO, _OBJ_PAGINAS, _OBJ_RECURSOS, _OBJ_PLANTILLA = 1, 2, 3, 4
+_OBJ_PRIMERA_FUENTE = 5
+
+
+def _texto_pdf(texto: str) -> bytes:
+    """String literal de PDF en WinAnsiEncoding (cp1252)."""
+    data = str(texto).encode("cp1252", errors="replace")
+    return b"(" + data.replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)") + b")"
+
+
+def _texto(fuente: str, tamano: float, x: float, y: float, texto: str) -> bytes:
+    return b"BT /%s %g Tf %g %g Td %s Tj ET\n" % (
+        fuente.encode(), tamano, x, y, _texto_pdf(texto))
+
+
+def _importe(fuente: str, tamano: float, x_derecha: float, y: float, valor: float) -> bytes:
+    """Importe alineado a la derecha (Courier: todos los caracteres miden 0,6 em)."""
+    texto = fmt(valor)
+    return _texto(fuente, tamano, x_derecha - len(texto) * tamano * 0.6, y, texto)
+
+
+class PlantillaFactura:
+    """
+    Página de factura compilada.
+
+    contenido_fijo: stream (comprimido) del Form XObject con todo lo que no
+    cambia entre facturas. Los valores variables van en posiciones fijas
+    calculadas acá una sola vez.
+    """
+
+    FILA = 15  # alto de renglón de la tabla
+
+    def __init__(self):
+        self.x_valor = MARGEN + 80
+        self.x_valor_2 = ANCHO / 2 + 90
+        self.x_importe = ANCHO - MARGEN - 8
+        self.y_datos = ALTO - 150
+        self.y_tabla = ALTO - 270
+        self.y_otros = self.y_tabla - 13 * self.FILA - 40
+        self.contenido_fijo = zlib.compress(self._dibujar_fijo())
+
+    def _dibujar_fijo(self) -> bytes:
+        ops = [b"0.5 w\n"]
+        # Encabezado
+        ops.append(b"0.93 0.95 0.98 rg %g %g %g %g re f 0 g\n" % (MARGEN, ALTO - 100, ANCHO - 2 * MARGEN, 60))
+        ops.append(_texto("F2", 10, MARGEN + 10, ALTO - 62, EMPRESA))
+        ops.append(_texto("F1", 8, MARGEN + 10, ALTO - 78, DOMICILIO_EMPRESA))
+        ops.append(_texto("F2", 12, MARGEN, ALTO - 125, "LIQUIDACIÓN DE SERVICIOS PÚBLICOS - ENERGÍA ELÉCTRICA"))
+
+        # Datos del socio (dos columnas de rótulos)
+        rotulos_1 = ["Socio:", "Titular:", "Domicilio:", "Localidad:", "Medidor:"]
+        rotulos_2 = ["Período:", "Ruta:", "Tarifa:", "Condición IVA:", "Consumo:"]
+        for i, (r1, r2) in enumerate(zip(rotulos_1, rotulos_2)):
+            y = self.y_datos - i * self.FILA
+            ops.append(_texto("F2", 9, MARGEN, y, r1))
+            ops.append(_texto("F2", 9, ANCHO / 2 + 10, y, r2))
+        ops.append(b"%g %g m %g %g l S\n" % (MARGEN, self.y_datos - 5 * self.FILA, ANCHO - MARGEN, self.y_datos - 5 * self.FILA))
+
+        # Tabla de liquidación
+        y = self.y_tabla + self.FILA
+        ops.append(b"0.85 g %g %g %g %g re f 0 g\n" % (MARGEN, y - 4, ANCHO - 2 * MARGEN, self.FILA + 4))
+        ops.append(_texto("F2", 9, MARGEN + 6, y, "Concepto"))
+        ops.append(_texto("F2", 9, self.x_importe - 34, y, "Importe"))
+        # 12 renglones de desglose (11 + bonificación de Tarifa Social) y el total
+        ops.append(b"%g %g %g %g re S\n" % (MARGEN, self.y_tabla - 13 * self.FILA, ANCHO - 2 * MARGEN, 15 * self.FILA))
+
+        # Otros conceptos
+        y = self.y_otros + self.FILA
+        ops.append(_texto("F2", 9, MARGEN, y + 6, "Otros conceptos (punto de venta aparte)"))
+        ops.append(b"%g %g %g %g re S\n" % (MARGEN, self.y_otros - 3 * self.FILA, ANCHO - 2 * MARGEN, 4 * self.FILA - 6))
+
+        ops.append(_texto("F1", 7, MARGEN, MARGEN, "Documento generado por el Motor de Facturación COEMA."))
+        return b"".join(ops)
+
+    def pagina(self, socio: str, fila: Mapping, factura: dict, periodo: str) -> bytes:
+        """Contenido (comprimido) de la página de una factura."""
+        ops = [b"/Tpl Do\n"]
+        escalon = factura["escalon"]
+        izquierda = [socio, fila["nombre"], fila["direccion"], fila["localidad"], fila["medidor"]]
+        derecha = [
+            periodo,
+            fila["ruta"],
+            f"{fila['tarifa']} - Escalón {escalon['nombre']}",
+            f"{fila['condicion_iva']} ({fila['iva_rate'] * 100:.0f}%)",
+            f"{int(fila['kwh'])} kWh",
+        ]
+        for i, (v1, v2) in enumerate(zip(izquierda, derecha)):
+            y = self.y_datos - i * self.FILA
+            ops.append(_texto("F1", 9, self.x_valor, y, v1))
+            ops.append(_texto("F1", 9, self.x_valor_2, y, v2))
+
+        for i, item in enumerate(factura["desglose"]):
+            y = self.y_tabla - i * self.FILA
+            negrita = item["tipo"] == "subtotal"
+            ops.append(_texto("F2" if negrita else "F1", 9, MARGEN + 6, y, item["concepto"]))
+            ops.append(_importe("F4" if negrita else "F3", 9, self.x_importe, y, item["importe"]))
+
+        y = self.y_tabla - len(factura["desglose"]) * self.FILA - 4
+        ops.append(_texto("F2", 11, MARGEN + 6, y, "TOTAL LIQ. SERV. PÚB."))
+        ops.append(_importe("F4", 11, self.x_importe, y, factura["resumen"]["total"]))
+
+        for i, item in enumerate(factura["otros_conceptos"]):
+            y = self.y_otros - i * self.FILA
+            negrita = item["concepto"] == "TOTAL"
+            ops.append(_texto("F2" if negrita else "F1", 9, MARGEN + 6, y, item["concepto"]))
+            ops.append(_importe("F4" if negrita else "F3", 9, self.x_importe, y, item["importe"]))
+
+        y = self.y_otros - 3 * self.FILA - 30
+        ops.append(_texto("F2", 12, MARGEN, y, "TOTAL A PAGAR"))
+        ops.append(_importe("F4", 12, self.x_importe, y, factura["resumen"]["total_general"]))
+        return zlib.compress(b"".join(ops))
+
+
+class EscritorPDF:
+    """
+    Escribe un PDF de varias páginas en streaming.
+
+    Los objetos compartidos (fuentes, recursos, plantilla) se escriben al
+    abrir; cada página se escribe apenas se agrega, y de ella solo se guarda
+    el offset para la tabla xref del final.
+    """
+
+    def __init__(self, archivo: BinaryIO, plantilla: PlantillaFactura):
+        self.archivo = archivo
+        self.offsets: Dict[int, int] = {}
+        self.paginas: List[int] = []
+        self._proximo = _OBJ_PRIMERA_FUENTE + len(FUENTES)
+        archivo.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+        fuentes = []
+        for i, (recurso, base) in enumerate(FUENTES.items()):
+            num = _OBJ_PRIMERA_FUENTE + i
+            self._objeto(num, b"<< /Type /Font /Subtype /Type1 /BaseFont /%s "
+                              b"/Encoding /WinAnsiEncoding >>" % base.encode())
+            fuentes.append(b"/%s %d 0 R" % (recurso.encode(), num))
+        self._objeto(_OBJ_RECURSOS, b"<< /Font << %s >> /XObject << /Tpl %d 0 R >> >>"
+                     % (b" ".join(fuentes), _OBJ_PLANTILLA))
+        self._stream(_OBJ_PLANTILLA,
+                     b"/Type /XObject /Subtype /Form /BBox [0 0 %d %d] /Resources %d 0 R"
+                     % (ANCHO, ALTO, _OBJ_RECURSOS),
+                     plantilla.contenido_fijo)
+
+    def _objeto(self, num: int, cuerpo: bytes):
+        self.offsets[num] = self.archivo.tell()
+        self.archivo.write(b"%d 0 obj\n%s\nendobj\n" % (num, cuerpo))
+
+    def _stream(self, num: int, diccionario: bytes, datos: bytes):
+        self._objeto(num, b"<< %s /Filter /FlateDecode /Length %d >>\nstream\n%s\nendstream"
+                     % (diccionario, len(datos), datos))
+
+    def agregar_pagina(self, contenido: bytes):
+        contenido_num, pagina_num = self._proximo, self._proximo + 1
+        self._proximo += 2
+        self._stream(contenido_num, b"", contenido)
+        self._objeto(pagina_num, b"<< /Type /Page /Parent %d 0 R /MediaBox [0 0 %d %d] "
+                                 b"/Resources %d 0 R /Contents %d 0 R >>"
+                     % (_OBJ_PAGINAS, ANCHO, ALTO, _OBJ_RECURSOS, contenido_num))
+        self.paginas.append(pagina_num)
+
+    def cerrar(self):
+        kids = b" ".join(b"%d 0 R" % p for p in self.paginas)
+        self._objeto(_OBJ_PAGINAS, b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(self.paginas)))
+        self._objeto(_OBJ_CATALOGO, b"<< /Type /Catalog /Pages %d 0 R >>" % _OBJ_PAGINAS)
+
+        xref = self.archivo.tell()
+        total = self._proximo
+        lineas = [b"xref\n0 %d\n" % total, b"0000000000 65535 f \n"]
+        lineas += [b"%010d 00000 n \n" % self.offsets[n] for n in range(1, total)]
+        self.archivo.write(b"".join(lineas))
+        self.archivo.write(b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n"
+                           % (total, _OBJ_CATALOGO, xref))
+
+
+def datos_facturas(resultados: pd.DataFrame, servicios: pd.DataFrame) -> pd.DataFrame:
+    """Lo que se imprime de cada factura: importes de facturar_por_rutas + datos del servicio."""
+    columnas = ["ruta", "tarifa", "kwh", "iva_rate", "escalon"] + COLUMNAS_IMPORTES
+    if "segmento" in resultados:
+        columnas.insert(1, "segmento")
+    return resultados[columnas].join(servicios[COLUMNAS_SERVICIO_PDF])
+
+
+def factura_pdf(socio: str, fila: Mapping, tarifas: dict, periodo: str,
+                plantilla: Optional[PlantillaFactura] = None,
+                cuadros: Optional[Mapping[str, CuadroSegmento]] = None) -> bytes:
+    """PDF de una sola factura, en memoria (para adjuntar a un e-mail)."""
+    plantilla = plantilla or PlantillaFactura()
+    buffer = io.BytesIO()
+    escritor = EscritorPDF(buffer, plantilla)
+    escritor.agregar_pagina(plantilla.pagina(socio, fila, detalle_factura(fila, tarifas, cuadros), periodo))
+    escritor.cerrar()
+    return buffer.getvalue()
+
+
+def _ruta_pdf(directorio: str, periodo: str, ruta) -> str:
+    return os.path.join(directorio, f"facturas_{periodo}_ruta_{ruta}.pdf")
+
+
+def renderizar_ruta(ruta, facturas: pd.DataFrame, tarifas: dict, directorio: str,
+                    periodo: str, plantilla: Optional[PlantillaFactura] = None,
+                    cuadros: Optional[Mapping[str, CuadroSegmento]] = None) -> Tuple[object, str, int, float]:
+    """
+    Escribe el PDF de una ruta: una página por fila de facturas (resultados
+    de facturar_por_rutas + COLUMNAS_SERVICIO_PDF). Devuelve
+    (ruta, archivo, páginas, segundos).
+    """
+    t0 = time.perf_counter()
+    plantilla = plantilla or PlantillaFactura()
+    path = _ruta_pdf(directorio, periodo, ruta)
+    tmp = f"{path}.tmp{os.getpid()}"
+    with open(tmp, "wb") as f:
+        escritor = EscritorPDF(f, plantilla)
+        for socio, fila in zip(facturas.index, facturas.to_dict("records")):
+            escritor.agregar_pagina(
+                plantilla.pagina(socio, fila, detalle_factura(fila, tarifas, cuadros), periodo))
+        escritor.cerrar()
+    os.replace(tmp, path)
+    return ruta, path, len(facturas), time.perf_counter() - t0
+
+
+# Estado del worker (se carga una vez por proceso en _init_worker)
+_worker: Dict[str, object] = {}
+
+
+def _init_worker(tarifas: dict, directorio: str, periodo: str,
+                 cuadros: Optional[Mapping[str, CuadroSegmento]] = None):
+    _worker.update(tarifas=tarifas, directorio=directorio, periodo=periodo,
+                   plantilla=PlantillaFactura(), cuadros=cuadros)
+
+
+def _tarea_ruta(ruta, facturas: pd.DataFrame):
+    return renderizar_ruta(ruta, facturas, _worker["tarifas"], _worker["directorio"],
+                           _worker["periodo"], _worker["plantilla"], _worker["cuadros"])
+
+
+def renderizar_facturas(
+    resultados: pd.DataFrame,
+    servicios: pd.DataFrame,
+    tarifas: dict,
+    periodo: str,
+    directorio: str = FACTURAS_DIR,
+    max_workers: Optional[int] = None,
+    al_terminar_ruta: Optional[Callable[[Dict], None]] = None,
+    cuadros: Optional[Mapping[str, CuadroSegmento]] = None,
+) -> pd.DataFrame:
+    """
+    Genera los PDFs de todas las facturas, uno por ruta.
+
+    Args:
+        resultados: salida de facturar_por_rutas (indexada por socio)
+        servicios: Padron.servicios (nombre, domicilio, medidor, etc.)
+        tarifas: cuadro tarifario con el que se facturó
+        periodo: período facturado, va en la factura y en el nombre del archivo
+        directorio: carpeta de salida (se crea si no existe)
+        max_workers: procesos del pool; 1 genera en el mismo proceso
+        al_terminar_ruta: callback con las estadísticas de cada ruta
+        cuadros: cuadros por segmento, si se facturó con facturar_segmentos
+
+    Returns:
+        DataFrame con una fila por ruta: ruta, archivo, facturas, segundos,
+        facturas_por_seg.
+    """
+    os.makedirs(directorio, exist_ok=True)
+    facturas = datos_facturas(resultados, servicios)
+    rutas = list(facturas.groupby("ruta", sort=True, observed=True))
+
+    estadisticas = []
+
+    def registrar(ruta, path, paginas, segundos):
+        stats = {
+            "ruta": ruta,
+            "archivo": path,
+            "facturas": paginas,
+            "segundos": segundos,
+            "facturas_por_seg": paginas / segundos if segundos > 0 else float("inf"),
+        }
+        estadisticas.append(stats)
+        if al_terminar_ruta:
+            al_terminar_ruta(stats)
+
+    usar_pool = (max_workers != 1 and len(rutas) > 1
+                 and (max_workers is not None or len(facturas) >= MIN_FACTURAS_POOL))
+    if usar_pool:
+        workers = min(max_workers or os.cpu_count() or 1, len(rutas))
+        # spawn: el proceso de Streamlit tiene hilos vivos y fork no es seguro
+        with ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn"),
+                                 initializer=_init_worker,
+                                 initargs=(tarifas, directorio, periodo, cuadros)) as pool:
+            futuros = [pool.submit(_tarea_ruta, ruta, f) for ruta, f in rutas]
+            for futuro in as_completed(futuros):
+                registrar(*futuro.result())
+    else:
+        plantilla = PlantillaFactura()
+        for ruta, f in rutas:
+            registrar(*renderizar_ruta(ruta, f, tarifas, directorio, periodo, plantilla, cuadros))
+
+    return pd.DataFrame(
+        estadisticas, columns=["ruta", "archivo", "facturas", "segundos", "facturas_por_seg"],
+    ).sort_values("ruta", ignore_index=True)
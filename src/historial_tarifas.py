@@ -0,0 +1,209 @@
+"""
+COEMA - Historial de cuadros tarifarios
+Cada cuadro confirmado en Paso 2 se guarda en SQLite (modo WAL) con su fecha
+de vigencia, anexo y nivel, y una fila por tarifa indexada por
+(tarifa, anexo, vigencia). Así "la tarifa vigente al día X" y "la versión
+anterior" son consultas indexadas, y Paso 2 compara siempre contra la
+resolución anterior real de la misma serie de cuadros (mismo anexo).
+serie() devuelve todos los cargos por escalón a lo largo del tiempo en una
+tabla, y comparar_interanual les agrega la variación contra un año antes,
+sin volver a extraer ningún PDF.
+"""
+
+import datetime
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import Dict, Iterable, Optional, Tuple, Union
+
+import pandas as pd
+
+TARIFAS_DB = os.environ.get(
+    "COEMA_TARIFAS_DB",
+    os.path.join(tempfile.gettempdir(), "coema_tarifas.sqlite3"),
+)
+
+Fecha = Union[datetime.date, str]
+
+# Serie de tarifas: una fila por (vigencia, anexo, tarifa, escalón)
+COLUMNAS_SERIE = ["vigencia", "anexo", "nivel", "tarifa", "escalon", "nombre",
+                  "desde", "hasta", "cargo_fijo", "cargo_variable"]
+CARGOS_SERIE = ["cargo_fijo", "cargo_variable"]
+
+
+def _iso(fecha: Fecha) -> str:
+    return fecha.isoformat() if isinstance(fecha, datetime.date) else datetime.date.fromisoformat(fecha).isoformat()
+
+
+def serie_tarifas(tarifas: Iterable[Tuple[Fecha, int, Optional[str], str, dict]]) -> pd.DataFrame:
+    """
+    Arma la serie (COLUMNAS_SERIE) a partir de (vigencia, anexo, nivel,
+    código, tarifa), ordenada por anexo, tarifa, escalón y vigencia.
+    """
+    filas = [(vigencia, anexo, nivel, cod, e["num"], e["nombre"], e["desde"], e["hasta"],
+              e["cargo_fijo"], e["cargo_variable"])
+             for vigencia, anexo, nivel, cod, tarifa in tarifas for e in tarifa["escalones"]]
+    serie = pd.DataFrame(filas, columns=COLUMNAS_SERIE)
+    serie["vigencia"] = pd.to_datetime(serie["vigencia"])
+    return serie.sort_values(["anexo", "tarifa", "escalon", "vigencia"], ignore_index=True)
+
+
+def comparar_interanual(serie: pd.DataFrame, dias: int = 365) -> pd.DataFrame:
+    """
+    Agrega a la serie, por cargo, el valor vigente 'dias' antes de cada
+    vigencia (mismo anexo, tarifa y escalón) y la variación porcentual.
+    Sin versión tan vieja, los dos quedan en NaN.
+    """
+    claves = ["anexo", "tarifa", "escalon"]
+    serie = serie.sort_values("vigencia", ignore_index=True)
+    atras = serie[claves + ["vigencia"] + CARGOS_SERIE].rename(
+        columns={c: f"{c}_anterior" for c in CARGOS_SERIE + ["vigencia"]})
+    serie["_hace"] = (serie["vigencia"] - pd.Timedelta(days=dias)).astype(serie["vigencia"].dtype)
+    serie = pd.merge_asof(serie, atras, left_on="_hace", right_on="vigencia_anterior",
+                          by=claves, direction="backward").drop(columns="_hace")
+    for c in CARGOS_SERIE:
+        serie[f"{c}_variacion"] = (serie[c] / serie[f"{c}_anterior"] - 1) * 100
+    return serie.sort_values(["anexo", "tarifa", "escalon", "vigencia"], ignore_index=True)
+
+
+class HistorialTarifas:
+    """
+    Versiones de cuadros tarifarios por fecha de vigencia.
+
+    Un cuadro se identifica por (anexo, vigencia): volver a confirmar el
+    mismo anexo con la misma vigencia reemplaza la versión guardada.
+    """
+
+    def __init__(self, path: str = TARIFAS_DB):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # La usan todas las sesiones de la app: una sola conexión, serializada
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA foreign_keys=ON")
+        with self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS cuadros (
+                    id INTEGER PRIMARY KEY,
+                    anexo INTEGER NOT NULL,
+                    nivel TEXT,
+                    vigencia TEXT NOT NULL,
+                    descripcion TEXT,
+                    origen TEXT,
+                    datos TEXT NOT NULL,
+                    registrado_en REAL NOT NULL,
+                    UNIQUE (anexo, vigencia)
+                )
+            """)
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS tarifas (
+                    cuadro_id INTEGER NOT NULL REFERENCES cuadros (id) ON DELETE CASCADE,
+                    tarifa TEXT NOT NULL,
+                    anexo INTEGER NOT NULL,
+                    nivel TEXT,
+                    vigencia TEXT NOT NULL,
+                    datos TEXT NOT NULL,
+                    PRIMARY KEY (tarifa, anexo, vigencia)
+                )
+            """)
+
+    def guardar(self, data: dict, vigencia: Fecha, origen: Optional[str] = None) -> int:
+        """Guarda un resultado de extract_tariffs (ya validado) vigente desde vigencia."""
+        vigencia = _iso(vigencia)
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM cuadros WHERE anexo = ? AND vigencia = ?",
+                              (data["anexo"], vigencia))
+            cur = self.conn.execute(
+                """INSERT INTO cuadros (anexo, nivel, vigencia, descripcion, origen, datos, registrado_en)
+                   VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                (data["anexo"], data.get("nivel"), vigencia, data.get("descripcion"), origen,
+                 json.dumps(data, default=float), time.time()),
+            )
+            cuadro_id = cur.lastrowid
+            self.conn.executemany(
+                "INSERT INTO tarifas (cuadro_id, tarifa, anexo, nivel, vigencia, datos) VALUES (?, ?, ?, ?, ?, ?)",
+                [(cuadro_id, cod, data["anexo"], data.get("nivel"), vigencia, json.dumps(tarifa, default=float))
+                 for cod, tarifa in data["tarifas"].items()],
+            )
+        return cuadro_id
+
+    def _tarifa(self, sql: str, args: tuple) -> Optional[dict]:
+        with self._lock:
+            fila = self.conn.execute(sql, args).fetchone()
+        if fila is None:
+            return None
+        tarifa = json.loads(fila[1])
+        tarifa["vigencia"] = fila[0]
+        return tarifa
+
+    def vigente(self, tarifa: str, anexo: int, fecha: Fecha) -> Optional[dict]:
+        """La tarifa del anexo vigente en fecha (con su 'vigencia'), o None."""
+        return self._tarifa(
+            """SELECT vigencia, datos FROM tarifas WHERE tarifa = ? AND anexo = ? AND vigencia <= ?
+               ORDER BY vigencia DESC LIMIT 1""",
+            (tarifa, anexo, _iso(fecha)),
+        )
+
+    def anterior(self, tarifa: str, anexo: int, vigencia: Fecha) -> Optional[dict]:
+        """La versión de la tarifa inmediatamente anterior a la que rige desde vigencia."""
+        return self._tarifa(
+            """SELECT vigencia, datos FROM tarifas WHERE tarifa = ? AND anexo = ? AND vigencia < ?
+               ORDER BY vigencia DESC LIMIT 1""",
+            (tarifa, anexo, _iso(vigencia)),
+        )
+
+    def cuadro(self, anexo: int, vigencia: Fecha) -> Optional[dict]:
+        """El resultado completo de extract_tariffs guardado para (anexo, vigencia)."""
+        with self._lock:
+            fila = self.conn.execute("SELECT datos FROM cuadros WHERE anexo = ? AND vigencia = ?",
+                                     (anexo, _iso(vigencia))).fetchone()
+        if fila is None:
+            return None
+        data = json.loads(fila[0])
+        if "bonificaciones_t1r" in data:  # JSON no tiene claves enteras
+            data["bonificaciones_t1r"] = {int(k): v for k, v in data["bonificaciones_t1r"].items()}
+        return data
+
+    def serie(self, anexo: Optional[int] = None, tarifa: Optional[str] = None) -> pd.DataFrame:
+        """Cargos por escalón de todas las versiones guardadas (ver serie_tarifas)."""
+        condiciones, args = [], []
+        if anexo is not None:
+            condiciones.append("anexo = ?")
+            args.append(anexo)
+        if tarifa is not None:
+            condiciones.append("tarifa = ?")
+            args.append(tarifa)
+        sql = "SELECT vigencia, anexo, nivel, tarifa, datos FROM tarifas"
+        if condiciones:
+            sql += " WHERE " + " AND ".join(condiciones)
+        with self._lock:
+            filas = self.conn.execute(sql, args).fetchall()
+        return serie_tarifas((v, a, n, t, json.loads(d)) for v, a, n, t, d in filas)
+
+    def versiones(self, anexo: Optional[int] = None) -> pd.DataFrame:
+        """Cuadros guardados (sin los datos), del más nuevo al más viejo."""
+        sql = "SELECT anexo, nivel, vigencia, descripcion, origen, registrado_en FROM cuadros"
+        args: tuple = ()
+        if anexo is not None:
+            sql += " WHERE anexo = ?"
+            args = (anexo,)
+        with self._lock:
+            return pd.read_sql_query(sql + " ORDER BY vigencia DESC, anexo", self.conn, params=args)
+
+    def close(self):
+        self.conn.close()
+
+
+_historiales: Dict[str, HistorialTarifas] = {}
+_historiales_lock = threading.Lock()
+
+
+def historial_tarifas(path: str = TARIFAS_DB) -> HistorialTarifas:
+    """El historial del proceso para path (se abre una sola vez)."""
+    with _historiales_lock:
+        if path not in _historiales:
+            _historiales[path] = HistorialTarifas(path)
+        return _historiales[path]
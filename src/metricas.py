@@ -0,0 +1,247 @@
+"""
+COEMA - Métricas de rendimiento
+Instrumentación liviana, en memoria del proceso: span() cronometra un bloque
+y lo acumula en un histograma por nombre y etiquetas; incrementar() lleva
+contadores. El registro se exporta en formato texto de Prometheus o en JSON,
+y servir_metricas lo publica por HTTP (/metrics y /metrics.json).
+
+Además, los spans de una ejecución se juntan en una Traza (por hilo, con
+contextvars): la app arma una por cada corrida del script y la barra lateral
+muestra el desglose. Lo que corre dentro de un pool de procesos queda en el
+registro del worker; de esas tareas se registra la duración que informan
+al terminar (registrar_duracion).
+"""
+
+import json
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+# Límites superiores (segundos) de los buckets de duración de los spans
+BUCKETS_SEGUNDOS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Histograma donde se acumulan todos los spans (etiqueta 'span' = nombre)
+METRICA_SPANS = "coema_span_segundos"
+
+Etiquetas = Tuple[Tuple[str, str], ...]
+
+
+def _etiquetas(etiquetas: Dict[str, object]) -> Etiquetas:
+    return tuple(sorted((k, str(v)) for k, v in etiquetas.items()))
+
+
+def _formato_etiquetas(etiquetas: Etiquetas) -> str:
+    if not etiquetas:
+        return ""
+    pares = ",".join('{}="{}"'.format(k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                     for k, v in etiquetas)
+    return "{" + pares + "}"
+
+
+class Histograma:
+    """Histograma acumulativo con buckets fijos (como los de Prometheus)."""
+
+    def __init__(self, buckets: Tuple[float, ...] = BUCKETS_SEGUNDOS):
+        self.buckets = buckets
+        self.conteos = [0] * len(buckets)
+        self.suma = 0.0
+        self.cantidad = 0
+
+    def observar(self, valor: float):
+        for i, limite in enumerate(self.buckets):
+            if valor <= limite:
+                self.conteos[i] += 1
+        self.suma += valor
+        self.cantidad += 1
+
+
+class Registro:
+    """Contadores e histogramas del proceso, protegidos por lock."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.contadores: Dict[Tuple[str, Etiquetas], float] = {}
+        self.histogramas: Dict[Tuple[str, Etiquetas], Histograma] = {}
+
+    def incrementar(self, nombre: str, valor: float = 1, **etiquetas):
+        clave = (nombre, _etiquetas(etiquetas))
+        with self._lock:
+            self.contadores[clave] = self.contadores.get(clave, 0) + valor
+
+    def observar(self, nombre: str, valor: float, **etiquetas):
+        clave = (nombre, _etiquetas(etiquetas))
+        with self._lock:
+            histograma = self.histogramas.get(clave)
+            if histograma is None:
+                histograma = self.histogramas[clave] = Histograma()
+            histograma.observar(valor)
+
+    def vaciar(self):
+        with self._lock:
+            self.contadores.clear()
+            self.histogramas.clear()
+
+    def prometheus(self) -> str:
+        """Formato de exposición de texto de Prometheus (version 0.0.4)."""
+        lineas = []
+        with self._lock:
+            contadores = sorted(self.contadores.items())
+            histogramas = sorted(self.histogramas.items(), key=lambda item: item[0])
+            tipos = set()
+            for (nombre, etiquetas), valor in contadores:
+                if nombre not in tipos:
+                    tipos.add(nombre)
+                    lineas.append(f"# TYPE {nombre} counter")
+                lineas.append(f"{nombre}{_formato_etiquetas(etiquetas)} {valor:g}")
+            for (nombre, etiquetas), h in histogramas:
+                if nombre not in tipos:
+                    tipos.add(nombre)
+                    lineas.append(f"# TYPE {nombre} histogram")
+                for limite, conteo in zip(h.buckets, h.conteos):
+                    lineas.append(f"{nombre}_bucket{_formato_etiquetas(etiquetas + (('le', f'{limite:g}'),))} {conteo}")
+                lineas.append(f"{nombre}_bucket{_formato_etiquetas(etiquetas + (('le', '+Inf'),))} {h.cantidad}")
+                lineas.append(f"{nombre}_sum{_formato_etiquetas(etiquetas)} {h.suma:.6f}")
+                lineas.append(f"{nombre}_count{_formato_etiquetas(etiquetas)} {h.cantidad}")
+        return "\n".join(lineas) + "\n"
+
+    def json(self) -> Dict[str, list]:
+        """
+        Las mismas series como dicts. Los buckets son acumulados, como en
+        Prometheus: buckets[le] cuenta las observaciones <= le ('+Inf' = todas).
+        """
+        with self._lock:
+            return {
+                "contadores": [{"nombre": n, "etiquetas": dict(e), "valor": v}
+                               for (n, e), v in sorted(self.contadores.items())],
+                "histogramas": [{"nombre": n, "etiquetas": dict(e), "cantidad": h.cantidad, "suma": h.suma,
+                                 "buckets": {**{f"{le:g}": c for le, c in zip(h.buckets, h.conteos)},
+                                             "+Inf": h.cantidad}}
+                                for (n, e), h in sorted(self.histogramas.items(), key=lambda item: item[0])],
+            }
+
+
+REGISTRO = Registro()
+
+
+# ============================================
+# SPANS Y TRAZAS
+# ============================================
+
+class SpanRegistrado(NamedTuple):
+    nombre: str
+    etiquetas: Dict[str, str]
+    inicio: float     # time.perf_counter() al empezar
+    segundos: float
+    nivel: int        # profundidad de anidamiento dentro de la traza
+
+
+class Traza:
+    """Spans de una ejecución, en el orden en que empezaron."""
+
+    def __init__(self, nombre: str = ""):
+        self.nombre = nombre
+        self.creada = time.time()
+        self.spans: List[SpanRegistrado] = []
+        self._lock = threading.Lock()
+
+    def agregar(self, span: SpanRegistrado):
+        with self._lock:
+            self.spans.append(span)
+
+    def desglose(self) -> List[SpanRegistrado]:
+        with self._lock:
+            return sorted(self.spans, key=lambda s: (s.inicio, s.nivel))
+
+    def segundos(self) -> float:
+        """Duración total: suma de los spans de primer nivel."""
+        with self._lock:
+            return sum(s.segundos for s in self.spans if s.nivel == 0)
+
+
+_traza: ContextVar[Optional[Traza]] = ContextVar("coema_traza", default=None)
+_nivel: ContextVar[int] = ContextVar("coema_nivel", default=0)
+
+
+@contextmanager
+def traza(destino: Traza) -> Iterator[Traza]:
+    """Junta en destino los spans del bloque (en este hilo / contexto)."""
+    token_traza = _traza.set(destino)
+    token_nivel = _nivel.set(0)
+    try:
+        yield destino
+    finally:
+        _nivel.reset(token_nivel)
+        _traza.reset(token_traza)
+
+
+@contextmanager
+def span(nombre: str, **etiquetas):
+    """Cronometra el bloque: lo observa en METRICA_SPANS y lo agrega a la traza activa."""
+    nivel = _nivel.get()
+    token = _nivel.set(nivel + 1)
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        segundos = time.perf_counter() - inicio
+        _nivel.reset(token)
+        _registrar(nombre, etiquetas, inicio, segundos, nivel)
+
+
+def registrar_duracion(nombre: str, segundos: float, **etiquetas):
+    """Como span, para una duración medida en otro lado (p. ej. por un worker del pool)."""
+    _registrar(nombre, etiquetas, time.perf_counter() - segundos, segundos, _nivel.get())
+
+
+def _registrar(nombre: str, etiquetas: Dict[str, object], inicio: float, segundos: float, nivel: int):
+    REGISTRO.observar(METRICA_SPANS, segundos, span=nombre, **etiquetas)
+    destino = _traza.get()
+    if destino is not None:
+        destino.agregar(SpanRegistrado(nombre, {k: str(v) for k, v in etiquetas.items()},
+                                       inicio, segundos, nivel))
+
+
+def incrementar(nombre: str, valor: float = 1, **etiquetas):
+    """Suma valor al contador nombre (con esas etiquetas) del registro del proceso."""
+    REGISTRO.incrementar(nombre, valor, **etiquetas)
+
+
+# ============================================
+# ENDPOINT HTTP
+# ============================================
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        ruta = self.path.split("?", 1)[0]
+        if ruta == "/metrics":
+            cuerpo, tipo = REGISTRO.prometheus().encode(), "text/plain; version=0.0.4; charset=utf-8"
+        elif ruta == "/metrics.json":
+            cuerpo, tipo = json.dumps(REGISTRO.json()).encode(), "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", tipo)
+        self.send_header("Content-Length", str(len(cuerpo)))
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+    def log_message(self, *args):
+        pass  # sin una línea de log por cada scrape
+
+
+_servidor: Optional[ThreadingHTTPServer] = None
+_servidor_lock = threading.Lock()
+
+
+def servir_metricas(puerto: int, host: str = "0.0.0.0") -> ThreadingHTTPServer:
+    """Publica el registro en /metrics y /metrics.json (un solo servidor por proceso)."""
+    global _servidor
+    with _servidor_lock:
+        if _servidor is None:
+            _servidor = ThreadingHTTPServer((host, puerto), _Handler)
+            threading.Thread(target=_servidor.serve_forever, name="metricas", daemon=True).start()
+        return _servidor
@@ -0,0 +1,182 @@
+"""
+COEMA - Padrón de servicios
+Ingesta por bloques de la exportación de lecturas de SgiMovil (CSV o ancho
+fijo) a un almacén columnar tipado: una tabla de servicios y una tabla larga
+de lecturas (historial) en lugar de dicts anidados por socio.
+"""
+
+import hashlib
+from typing import IO, Dict, Iterator, List, Optional, Union
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+# Layout de la exportación de lecturas: una fila por servicio y período, con
+# los atributos del servicio repetidos en cada fila.
+COLUMNAS_SGIMOVIL = [
+    "socio", "ruta", "nombre", "direccion", "localidad", "tarifa",
+    "condicion_iva", "segmentacion", "zona_alumbrado", "medidor", "servicio",
+    "periodo", "kwh",
+]
+
+# Ancho de cada campo en la variante de ancho fijo (mismo orden)
+ANCHOS_SGIMOVIL = [10, 4, 30, 30, 20, 6, 20, 3, 2, 12, 12, 7, 8]
+
+COLUMNAS_SERVICIO = [c for c in COLUMNAS_SGIMOVIL if c not in ("periodo", "kwh")]
+
+IVA_POR_CONDICION = {
+    "Monotributista": 0.27,
+    "Responsable Inscripto": 0.27,
+    "Consumidor Final": 0.21,
+}
+
+TAMANO_BLOQUE = 50_000
+
+_DTYPES_LECTURA = {c: str for c in COLUMNAS_SGIMOVIL}
+
+
+class Padron:
+    """
+    Padrón columnar de un período de facturación.
+
+    servicios: DataFrame indexado por socio con los atributos del servicio,
+        la tasa de IVA y el consumo del período (consumo_kwh). tarifa,
+        condicion_iva y segmentacion son categóricas.
+    lecturas: DataFrame largo (socio, periodo, kwh) ordenado por socio y
+        período; socio es categórica, así el historial de un socio es un
+        slice contiguo.
+    periodo: período facturado ('AAAA-MM').
+    sin_lectura: socios presentes en la exportación sin lectura en el período.
+    """
+
+    def __init__(self, servicios: pd.DataFrame, lecturas: pd.DataFrame, periodo: str,
+                 sin_lectura: Optional[List[str]] = None):
+        self.servicios = servicios
+        self.lecturas = lecturas
+        self.periodo = periodo
+        self.sin_lectura = sin_lectura or []
+        self._codigos = lecturas["socio"].cat.codes.to_numpy()
+        self._version: Optional[str] = None
+
+    def __len__(self) -> int:
+        return len(self.servicios)
+
+    @property
+    def version(self) -> str:
+        """Hash del contenido facturable (servicios + consumos del período)."""
+        if self._version is None:
+            h = pd.util.hash_pandas_object(self.servicios, index=True)
+            self._version = hashlib.sha256(h.to_numpy().tobytes()).hexdigest()[:16]
+        return self._version
+
+    def historial(self, socio: str) -> pd.DataFrame:
+        """Lecturas (periodo, kwh) de un socio, en orden de período."""
+        categorias = self.lecturas["socio"].cat.categories
+        if socio not in categorias:
+            return self.lecturas.iloc[:0][["periodo", "kwh"]]
+        codigo = categorias.get_loc(socio)
+        desde, hasta = np.searchsorted(self._codigos, [codigo, codigo + 1])
+        return self.lecturas.iloc[desde:hasta][["periodo", "kwh"]].reset_index(drop=True)
+
+
+def _tipar_servicios(servicios: pd.DataFrame) -> pd.DataFrame:
+    servicios = servicios.copy()
+    servicios["ruta"] = pd.to_numeric(servicios["ruta"]).astype("int16")
+    servicios["zona_alumbrado"] = pd.to_numeric(servicios["zona_alumbrado"]).astype("int8")
+    for col in ("tarifa", "condicion_iva", "segmentacion"):
+        servicios[col] = servicios[col].astype("category")
+    iva = servicios["condicion_iva"].map(IVA_POR_CONDICION)
+    desconocidas = sorted(set(servicios.loc[iva.isna(), "condicion_iva"].astype(str)))
+    if desconocidas:
+        raise ValueError(f"Condición de IVA desconocida: {', '.join(desconocidas)}")
+    servicios["iva"] = iva.astype("float64")
+    return servicios
+
+
+def _armar_padron(servicios: pd.DataFrame, lecturas: pd.DataFrame,
+                  periodo: Optional[str]) -> Padron:
+    """Tipa servicios/lecturas y toma el consumo del período a facturar."""
+    lecturas = lecturas.copy()
+    lecturas["socio"] = lecturas["socio"].astype("category")
+    lecturas["periodo"] = lecturas["periodo"].astype("category")
+    lecturas = lecturas.sort_values(["socio", "periodo"], kind="stable").reset_index(drop=True)
+    if periodo is None:
+        periodo = str(max(lecturas["periodo"].cat.categories)) if len(lecturas) else ""
+
+    del_periodo = lecturas[lecturas["periodo"] == periodo]
+    consumo = del_periodo.drop_duplicates("socio", keep="last").set_index("socio")["kwh"]
+    consumo.index = consumo.index.astype(str)
+
+    servicios = _tipar_servicios(servicios)
+    sin_lectura = [s for s in servicios.index if s not in consumo.index]
+    servicios = servicios.loc[servicios.index.isin(consumo.index)]
+    servicios["consumo_kwh"] = consumo.reindex(servicios.index).astype("int32")
+    return Padron(servicios, lecturas, periodo, sin_lectura)
+
+
+def _leer_bloques(fuente: Union[str, IO], formato: str, tamano_bloque: int,
+                  sep: str, encoding: str) -> Iterator[pd.DataFrame]:
+    if formato == "csv":
+        return pd.read_csv(fuente, sep=sep, encoding=encoding, dtype=_DTYPES_LECTURA,
+                           usecols=COLUMNAS_SGIMOVIL, chunksize=tamano_bloque)
+    if formato == "fwf":
+        return pd.read_fwf(fuente, widths=ANCHOS_SGIMOVIL, names=COLUMNAS_SGIMOVIL,
+                           encoding=encoding, dtype=_DTYPES_LECTURA, header=None,
+                           chunksize=tamano_bloque)
+    raise ValueError(f"Formato de exportación no soportado: {formato}")
+
+
+def cargar_sgimovil(fuente: Union[str, IO], formato: str = "csv",
+                    periodo: Optional[str] = None, tamano_bloque: int = TAMANO_BLOQUE,
+                    sep: str = ",", encoding: str = "utf-8") -> Padron:
+    """
+    Carga la exportación de lecturas de SgiMovil leyendo de a bloques.
+
+    Cada bloque de tamano_bloque filas se reduce enseguida a columnas tipadas
+    (lecturas) y a la última versión de cada servicio, así la memoria pico
+    depende del tamaño del bloque y no del archivo.
+
+    Args:
+        fuente: ruta o archivo abierto (CSV con encabezado o ancho fijo sin él)
+        formato: 'csv' o 'fwf' (ancho fijo, ver ANCHOS_SGIMOVIL)
+        periodo: período a facturar ('AAAA-MM'); por defecto el último leído
+    """
+    socios: List[pd.Categorical] = []
+    periodos: List[pd.Categorical] = []
+    kwh: List[np.ndarray] = []
+    servicios: List[pd.DataFrame] = []
+    for bloque in _leer_bloques(fuente, formato, tamano_bloque, sep, encoding):
+        bloque["socio"] = bloque["socio"].str.strip()
+        socios.append(pd.Categorical(bloque["socio"].to_numpy(dtype=object)))
+        periodos.append(pd.Categorical(bloque["periodo"].str.strip().to_numpy(dtype=object)))
+        kwh.append(pd.to_numeric(bloque["kwh"]).astype("int32").to_numpy())
+        servicios.append(
+            bloque[COLUMNAS_SERVICIO].drop_duplicates("socio", keep="last")
+        )
+
+    if not kwh:
+        raise ValueError("La exportación de SgiMovil no tiene lecturas")
+    serv = (pd.concat(servicios, ignore_index=True)
+            .drop_duplicates("socio", keep="last")
+            .set_index("socio"))
+    for col in serv.columns:
+        serv[col] = serv[col].str.strip()
+    lecturas = pd.DataFrame({
+        "socio": union_categoricals(socios, sort_categories=True),
+        "periodo": union_categoricals(periodos, sort_categories=True),
+        "kwh": np.concatenate(kwh),
+    })
+    return _armar_padron(serv, lecturas, periodo)
+
+
+def padron_desde_clientes(clientes: Dict[str, dict]) -> Padron:
+    """Arma el Padron a partir del dict de clientes demo (formato CLIENTES)."""
+    servicios = pd.DataFrame.from_dict(clientes, orient="index")
+    servicios.index.name = "socio"
+    lecturas = pd.DataFrame(
+        [(cid, h["periodo"], h["kwh"]) for cid, c in clientes.items() for h in c.get("historial", [])],
+        columns=["socio", "periodo", "kwh"],
+    )
+    lecturas["kwh"] = lecturas["kwh"].astype("int32")
+    return _armar_padron(servicios[COLUMNAS_SERVICIO[1:]], lecturas, None)
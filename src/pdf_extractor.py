@@ -6,8 +6,56 @@ for Area Atlantica (EDEA - includes COEMA General Madariaga)
 
 import re
 import io
+import os
+import copy
+import json
+import time
+import signal
+import hashlib
+import inspect
+import importlib.metadata
+import asyncio
+import tempfile
+import zipfile
+import datetime
+import threading
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager, nullcontext
+from multiprocessing import get_context
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
+from typing import BinaryIO, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
+
+from metricas import incrementar, span
+
+# Raw PDF content or a seekable binary file holding it
+PdfSource = Union[bytes, BinaryIO]
+
+
+# Extraction results cache (content-addressed by PDF SHA-256 + EXTRACTOR_VERSION)
+CACHE_DIR = os.environ.get(
+    'COEMA_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'coema_cache', 'tarifas'),
+)
+CACHE_MAX_BYTES = int(os.environ.get('COEMA_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+
+# Downloads: bodies are streamed to a spooled temp file (in memory up to
+# DOWNLOAD_SPOOL_BYTES, on disk beyond) and rejected past DOWNLOAD_MAX_BYTES.
+DOWNLOAD_MAX_BYTES = int(os.environ.get('COEMA_DOWNLOAD_MAX_BYTES', 50 * 1024 * 1024))
+DOWNLOAD_SPOOL_BYTES = 4 * 1024 * 1024
+DOWNLOAD_CHUNK_BYTES = 64 * 1024
+DOWNLOAD_CONCURRENCY = 4
+DOWNLOAD_TIMEOUT = 30
+
+# Memory ceiling for one extraction, in bytes of Python allocations (see
+# MemoryBudget). Unset: not measured; 0: measured, no ceiling.
+_memory_limit = os.environ.get('COEMA_EXTRACT_MEMORY_LIMIT')
+EXTRACT_MEMORY_LIMIT = int(_memory_limit) if _memory_limit else None
+
+# Bulk extraction: seconds allowed per PDF before it is abandoned
+BULK_TIMEOUT = float(os.environ.get('COEMA_BULK_TIMEOUT', 120))
+# ...and how often the alarm fires again until the block is left
+_TIMEOUT_REFIRE = 0.05
 
 
 def parse_number(s: str) -> float:
@@ -19,9 +67,7 @@ def parse_number(s: str) -> float:
     return float(s.replace('.', '').replace(',', '.'))
 
 
-def detect_anexo(text: str) -> Tuple[Optional[int], Optional[str], Optional[str]]:
-    """Detect Anexo type from PDF text. Returns (anexo_num, nivel, descripcion)."""
-    t = text.upper()
+def _anexo_from_upper(t: str) -> Tuple[Optional[int], Optional[str], Optional[str]]:
     if 'ANEXO 104' in t or 'TARIFA SOCIAL' in t:
         return 104, 'N3', 'Tarifa Social'
     elif 'ANEXO 14' in t:
@@ -31,6 +77,11 @@ def detect_anexo(text: str) -> Tuple[Optional[int], Optional[str], Optional[str]
     return None, None, None
 
 
+def detect_anexo(text: str) -> Tuple[Optional[int], Optional[str], Optional[str]]:
+    """Detect Anexo type from PDF text. Returns (anexo_num, nivel, descripcion)."""
+    return _anexo_from_upper(text.upper())
+
+
 # Known ranges per tariff type (stable across resolutions, only values change)
 RANGOS_T1R = {
     1: (0, 100), 2: (100, 200), 3: (200, 400),
@@ -40,44 +91,102 @@ RANGOS_T1RE = {
     1: (0, 500), 2: (500, 700), 3: (700, 1400), 4: (1400, 99999),
 }
 
+# Tariff sections: code -> (escalon prefix, ranges, nombre, start token, end token).
+# A section runs from its start marker up to the first end marker after it.
+SECCIONES = {
+    'T1R': ('R', RANGOS_T1R, 'Tarifa 1 Residencial', 'T1R', 'T1RE'),
+    'T1RE': ('RE', RANGOS_T1RE, 'Tarifa 1 Residencial Estacional', 'T1RE', 'FIN'),
+}
 
-def _section_between(text: str, start_re: str, end_re: str) -> str:
-    """Extract text between two regex patterns."""
-    start = re.search(start_re, text, re.IGNORECASE)
-    if not start:
-        return ''
-    rest = text[start.start():]
-    end = re.search(end_re, rest[len(start.group()):], re.IGNORECASE)
-    if end:
-        return rest[:len(start.group()) + end.start()]
-    return rest
 
+def _num(name: str) -> str:
+    # Numbers may contain internal spaces from PDF extraction,
+    # e.g. "3 .441,98" or "1 60,2894" or "3.441,98" (no spaces)
+    return rf'(?P<{name}>\d[\d .,]*\d)\s+\$'
+
+
+# Every token the extractor needs in one alternation, matched against the
+# upper-cased text: the text is scanned once instead of once per section,
+# per cargo type and for bonificaciones. The lookahead rejects positions that
+# cannot start a token before trying the branches.
+_TOKENS = re.compile('(?=[TCGB])(?:' + '|'.join([
+    r'(?P<T1RE>T1RE\s*[-–]?\s*RESIDENCIAL\s+ESTACIONAL)',
+    r'(?P<T1R>T1R\s*[-–]?\s*RESIDENCIAL\b(?!\s*ESTACIONAL))',
+    r'(?P<FIN>T1G\s*[-–]|T2\s*[-–]|T3\s*[-–]|GRANDES\s+DEMANDAS)',
+    rf'(?P<cargo_fijo>CARGO\s+FIJO\s+(?P<pf>RE?)(?P<nf>\d+)\b.*?{_num("vf")}(?:/MES|FACTURA))',
+    rf'(?P<cargo_variable>CARGO\s+VARIABLE\s+(?P<pv>RE?)(?P<nv>\d+)\b.*?{_num("vv")}/KWH)',
+    rf'(?P<bonificacion>BONIFICACI[OÓ]N\s+R(?P<nb>\d+)\s+(?P<rb>.*?){_num("vb")}/MES)',
+]) + ')')
+
+# token -> (prefix group, escalon group, valor group)
+_GRUPOS = {
+    'cargo_fijo': ('pf', 'nf', 'vf'),
+    'cargo_variable': ('pv', 'nv', 'vv'),
+    'bonificacion': (None, 'nb', 'vb'),
+}
 
-def _extract_cargos(section: str, prefix: str, ranges: dict) -> List[Dict]:
-    """Extract cargo fijo and cargo variable per escalon from a tariff section.
 
-    Handles pdfplumber artifacts where numbers have internal spaces,
-    e.g. '3 .441,98' instead of '3.441,98' or '1 60,2894' instead of '160,2894'.
-    """
-    # Pattern captures numbers that may contain internal spaces from PDF extraction
-    # e.g. "3 .441,98" or "1 60,2894" or "3.441,98" (no spaces)
-    num_pattern = r'(\d[\d .,]*\d)\s+\$'
+# Upper bound of a bonificación range: "(100 < CONSUMO EN KWH-MES ≤ 150)",
+# "(CONSUMO EN KWH-MES HASTA 100)"; open ranges ("> 1400") have none.
+_HASTA = re.compile(r'(?:≤|<=|HASTA|PRIMEROS)\s*(\d+)')
 
-    fijos = re.findall(
-        rf'CARGO\s+FIJO\s+{prefix}(\d+)\b.*?{num_pattern}(?:/mes|factura)',
-        section, re.IGNORECASE
-    )
-    variables = re.findall(
-        rf'CARGO\s+VARIABLE\s+{prefix}(\d+)\b.*?{num_pattern}/kWh',
-        section, re.IGNORECASE
-    )
 
-    fijo_map = {int(n): parse_number(v) for n, v in fijos}
-    var_map = {int(n): parse_number(v) for n, v in variables}
-    all_nums = sorted(set(list(fijo_map.keys()) + list(var_map.keys())))
+class TariffRecord(NamedTuple):
+    """One tariff value found by the tokenizer."""
+    tarifa: str       # 'T1R' | 'T1RE'
+    concepto: str     # 'cargo_fijo' | 'cargo_variable' | 'bonificacion'
+    escalon: int
+    valor: float
+    hasta: Optional[int] = None  # bonificaciones: upper kWh bound of the range
 
+
+def tokenize_tariffs(text: str, bonificaciones: bool = True) -> List[TariffRecord]:
+    """
+    Single pass over the PDF text.
+
+    Returns the T1R/T1RE cargos found inside their sections and the T1R
+    bonificaciones (anywhere in the text), in document order. With
+    bonificaciones=False the scan stops as soon as both sections are closed.
+    """
+    return _tokenize_upper(text.upper(), bonificaciones)
+
+
+def _tokenize_upper(t: str, bonificaciones: bool) -> List[TariffRecord]:
+    # section code -> 'pending' | 'active' | 'done'
+    estado = {codigo: 'pending' for codigo in SECCIONES}
+    records: List[TariffRecord] = []
+
+    for m in _TOKENS.finditer(t):
+        kind = m.lastgroup
+        if kind == 'bonificacion':
+            if not bonificaciones:
+                continue
+            _p, n, v = _GRUPOS[kind]
+            hasta = _HASTA.search(m.group('rb'))
+            records.append(TariffRecord('T1R', kind, int(m.group(n)), parse_number(m.group(v)),
+                                        int(hasta.group(1)) if hasta else None))
+        elif kind in _GRUPOS:
+            p, n, v = _GRUPOS[kind]
+            for codigo, (prefix, *_rest) in SECCIONES.items():
+                if estado[codigo] == 'active' and m.group(p) == prefix:
+                    records.append(TariffRecord(
+                        codigo, kind, int(m.group(n)), parse_number(m.group(v))))
+        else:
+            for codigo, (_p, _r, _n, start, end) in SECCIONES.items():
+                if estado[codigo] == 'active' and kind == end:
+                    estado[codigo] = 'done'
+                elif estado[codigo] == 'pending' and kind == start:
+                    estado[codigo] = 'active'
+            if not bonificaciones and all(e == 'done' for e in estado.values()):
+                break
+
+    return records
+
+
+def _build_escalones(prefix: str, ranges: dict, fijo_map: Dict[int, float],
+                     var_map: Dict[int, float]) -> List[Dict]:
     escalones = []
-    for num in all_nums:
+    for num in sorted(set(fijo_map) | set(var_map)):
         desde, hasta = ranges.get(num, (0, 99999))
         escalones.append({
             'num': num,
@@ -97,9 +206,12 @@ def extract_tariffs(text: str) -> Dict:
 
     Returns:
         dict with keys: anexo, nivel, descripcion, tarifas
-        tarifas is a dict keyed by tariff code (T1R, T1RE) with escalones list
+        tarifas is a dict keyed by tariff code (T1R, T1RE) with escalones list.
+        Anexo 104 adds bonificaciones_t1r and bonificaciones_t1r_tramos.
     """
-    anexo, nivel, descripcion = detect_anexo(text)
+    upper = text.upper()
+    anexo, nivel, descripcion = _anexo_from_upper(upper)
+    records = _tokenize_upper(upper, bonificaciones=anexo == 104)
 
     result = {
         'anexo': anexo,
@@ -108,89 +220,701 @@ def extract_tariffs(text: str) -> Dict:
         'tarifas': {},
     }
 
-    # --- T1R - Residencial ---
-    t1r_section = _section_between(
-        text,
-        r'T1R\s*[-–]?\s*RESIDENCIAL\b(?!\s*ESTACIONAL)',
-        r'T1RE\s*[-–]?\s*RESIDENCIAL\s+ESTACIONAL',
-    )
-    if t1r_section:
-        esc = _extract_cargos(t1r_section, 'R', RANGOS_T1R)
+    # --- T1R - Residencial / T1RE - Residencial Estacional ---
+    for codigo, (prefix, ranges, nombre, _start, _end) in SECCIONES.items():
+        fijo_map, var_map = {}, {}
+        for r in records:
+            if r.tarifa == codigo and r.concepto == 'cargo_fijo':
+                fijo_map[r.escalon] = r.valor
+            elif r.tarifa == codigo and r.concepto == 'cargo_variable':
+                var_map[r.escalon] = r.valor
+        esc = _build_escalones(prefix, ranges, fijo_map, var_map)
         if esc:
-            result['tarifas']['T1R'] = {
-                'nombre': 'Tarifa 1 Residencial',
-                'codigo': 'T1R',
-                'escalones': esc,
-            }
-
-    # --- T1RE - Residencial Estacional ---
-    t1re_section = _section_between(
-        text,
-        r'T1RE\s*[-–]?\s*RESIDENCIAL\s+ESTACIONAL',
-        r'T1G\s*[-–]|T2\s*[-–]|T3\s*[-–]|GRANDES\s+DEMANDAS',
-    )
-    if t1re_section:
-        esc = _extract_cargos(t1re_section, 'RE', RANGOS_T1RE)
-        if esc:
-            result['tarifas']['T1RE'] = {
-                'nombre': 'Tarifa 1 Residencial Estacional',
-                'codigo': 'T1RE',
+            result['tarifas'][codigo] = {
+                'nombre': nombre,
+                'codigo': codigo,
                 'escalones': esc,
             }
 
     # --- N3 Bonificaciones (Anexo 104 only) ---
+    # Some escalones have more than one range (R2 up to 150 and up to 200
+    # kWh): bonificaciones_t1r keeps one value per escalón, the ranges keep
+    # them all as [hasta kWh, $/mes] (the last one open, hasta 99999).
     if anexo == 104:
-        bonif = {}
-        matches = re.findall(
-            r'Bonificaci[oó]n\s+R(\d+)\s+.*?(\d[\d .,]*\d)\s+\$/mes',
-            text, re.IGNORECASE,
-        )
-        for num, val in matches:
-            bonif[int(num)] = parse_number(val)
+        bonif = [r for r in records if r.concepto == 'bonificacion']
         if bonif:
-            result['bonificaciones_t1r'] = bonif
+            result['bonificaciones_t1r'] = {r.escalon: r.valor for r in bonif}
+            result['bonificaciones_t1r_tramos'] = sorted(
+                [r.hasta if r.hasta is not None else 99999, r.valor] for r in bonif)
 
     return result
 
 
-def extract_tariffs_from_pdf(pdf_path: str) -> Dict:
-    """Extract tariffs from a PDF file on disk."""
+# Pre-scan keywords: a page is worth a full layout extraction only if one of
+# these matches. Together they cover everything extract_tariffs looks at:
+# anexo detection, T1R/T1RE section boundaries, escalon charges and the
+# Anexo 104 bonificaciones.
+PAGE_KEYWORDS = {
+    'ANEXO': re.compile(r'ANEXO\s*\d+|TARIFA\s+SOCIAL', re.IGNORECASE),
+    'T1R RESIDENCIAL': re.compile(r'T1R\s*[-–]?\s*RESIDENCIAL', re.IGNORECASE),
+    'T1RE': re.compile(r'T1RE', re.IGNORECASE),
+    'FIN T1RE': re.compile(r'T1G\s*[-–]|T2\s*[-–]|T3\s*[-–]|GRANDES\s+DEMANDAS', re.IGNORECASE),
+    'CARGO R': re.compile(r'CARGO\s+(?:FIJO|VARIABLE)\s+RE?\d', re.IGNORECASE),
+    'Bonificación': re.compile(r'Bonificaci[oó]n', re.IGNORECASE),
+}
+
+
+def build_keyword_index(pdf: PdfSource) -> Tuple[Dict[str, List[int]], int]:
+    """Cheap pre-scan: map each PAGE_KEYWORDS entry to the pages where it appears.
+
+    Uses pdfium's plain text extraction (a pdfplumber dependency), which
+    skips pdfminer's layout analysis and is orders of magnitude faster.
+    Returns (index, page_count).
+    """
+    import pypdfium2 as pdfium
+
+    index: Dict[str, List[int]] = {k: [] for k in PAGE_KEYWORDS}
+    doc = pdfium.PdfDocument(pdf)
+    try:
+        n_pages = len(doc)
+        for i in range(n_pages):
+            page = doc[i]
+            textpage = page.get_textpage()
+            text = textpage.get_text_range()
+            textpage.close()
+            page.close()
+            for key, pattern in PAGE_KEYWORDS.items():
+                if pattern.search(text):
+                    index[key].append(i)
+    finally:
+        doc.close()
+    return index, n_pages
+
+
+def _pages_from_index(index: Optional[Dict[str, List[int]]], n_pages: int) -> List[int]:
+    if index is None:
+        return list(range(n_pages))
+    pages = sorted({p for hits in index.values() for p in hits if p < n_pages})
+    return pages or list(range(n_pages))
+
+
+def _scan_keywords(pdf: PdfSource) -> Optional[Dict[str, List[int]]]:
+    try:
+        index, _ = build_keyword_index(pdf)
+    except Exception:
+        return None
+    finally:
+        if not isinstance(pdf, (bytes, bytearray)):
+            pdf.seek(0)
+    return index
+
+
+def select_pages(pdf: PdfSource, n_pages: int) -> List[int]:
+    """Pages that need full layout extraction (all of them if the pre-scan finds nothing)."""
+    return _pages_from_index(_scan_keywords(pdf), n_pages)
+
+
+class TariffCache:
+    """Persistent disk cache of extract_tariffs results.
+
+    Entries are JSON files named '<sha256 of the PDF>_<EXTRACTOR_VERSION>.json'.
+    A hit touches the file's mtime, and writes evict the least recently used
+    entries until the directory fits in max_bytes. Entries from older
+    extractor versions are never read again and age out the same way.
+    """
+
+    def __init__(self, directory: str = CACHE_DIR, max_bytes: int = CACHE_MAX_BYTES,
+                 version: Optional[str] = None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.version = version or EXTRACTOR_VERSION
+
+    @staticmethod
+    def key(pdf_bytes: bytes) -> str:
+        return hashlib.sha256(pdf_bytes).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f'{key}_{self.version}.json')
+
+    def get(self, key: str) -> Optional[Dict]:
+        path = self._path(key)
+        try:
+            with open(path, encoding='utf-8') as f:
+                entry = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        result = entry['result']
+        # JSON object keys are always strings
+        if 'bonificaciones_t1r' in result:
+            result['bonificaciones_t1r'] = {
+                int(k): v for k, v in result['bonificaciones_t1r'].items()
+            }
+        return result
+
+    def put(self, key: str, result: Dict):
+        self._write(self._path(key), {'version': self.version, 'result': result})
+
+    def _write(self, path: str, entry: Dict):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(tmp, path)
+        self.evict()
+
+    def _url_path(self, url: str) -> str:
+        return os.path.join(self.directory, f'url_{hashlib.sha256(url.encode()).hexdigest()}.json')
+
+    def get_validators(self, url: str) -> Optional[Dict]:
+        """HTTP validators of the last download of url: {'etag', 'last_modified', 'key'}."""
+        try:
+            with open(self._url_path(url), encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def put_validators(self, url: str, etag: Optional[str], last_modified: Optional[str],
+                       key: str):
+        self._write(self._url_path(url),
+                    {'url': url, 'etag': etag, 'last_modified': last_modified, 'key': key})
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits in max_bytes."""
+        entries = []
+        with os.scandir(self.directory) as it:
+            for e in it:
+                if e.is_file() and e.name.endswith('.json'):
+                    st = e.stat()
+                    entries.append((st.st_mtime, st.st_size, e.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        if os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                if name.endswith('.json'):
+                    os.remove(os.path.join(self.directory, name))
+
+
+def _stream_key(f: BinaryIO) -> str:
+    """TariffCache.key of a file's content, read in chunks (leaves f at the start)."""
+    h = hashlib.sha256()
+    for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_BYTES), b''):
+        h.update(chunk)
+    f.seek(0)
+    return h.hexdigest()
+
+
+class ExtractionMemoryError(MemoryError):
+    """An extraction went over its memory ceiling."""
+
+
+# tracemalloc is process-wide: measured extractions run one at a time
+_memory_lock = threading.Lock()
+
+
+class MemoryBudget:
+    """Peak Python memory of one extraction, with an optional ceiling.
+
+    Measured with tracemalloc relative to the allocations alive on entry
+    (tracing is started for the block if it was off). The ceiling is checked
+    after each page, so a page being laid out can overshoot it by its own
+    size before the extraction is stopped.
+    """
+
+    def __init__(self, limit: int = 0):
+        self.limit = limit
+        self.peak = 0
+        self._started = False
+        self._baseline = 0
+
+    def __enter__(self) -> 'MemoryBudget':
+        locked = False
+        try:
+            locked = _memory_lock.acquire()
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started = True
+            self._baseline = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        except BaseException:
+            # __exit__ does not run when __enter__ fails (a timeout landing
+            # here, or tracemalloc.start() without memory): undo it here so
+            # the lock is not held for good by this worker
+            if self._started:
+                tracemalloc.stop()
+                self._started = False
+            if locked:
+                _memory_lock.release()
+            raise
+        return self
+
+    def check(self):
+        self.peak = max(self.peak, tracemalloc.get_traced_memory()[1] - self._baseline)
+        if self.limit and self.peak > self.limit:
+            raise ExtractionMemoryError(
+                f'extraction used {self.peak / 2**20:.1f} MiB, over the {self.limit / 2**20:.1f} MiB ceiling')
+
+    def __exit__(self, *exc):
+        try:
+            self.peak = max(self.peak, tracemalloc.get_traced_memory()[1] - self._baseline)
+            if self._started:
+                tracemalloc.stop()
+        finally:
+            _memory_lock.release()
+
+
+def iter_page_texts(doc, pages: Iterable[int],
+                    budget: Optional[MemoryBudget] = None) -> Iterator[str]:
+    """Text of the given pages of an open pdfplumber document, one page at a time.
+
+    Each page's layout objects (chars, lines, the text map) are released as
+    soon as its text is read, so memory does not grow with the page count.
+    """
+    for i in pages:
+        page = doc.pages[i]
+        try:
+            yield page.extract_text() or ''
+        finally:
+            page.close()
+        if budget is not None:
+            budget.check()
+
+
+_PDF_DATE = re.compile(r'(?:D:)?(\d{4})(\d{2})(\d{2})')
+
+
+def pdf_date(metadata: Dict) -> Optional[str]:
+    """ISO date the document was signed (GDEBA stamps it as CreationDate), or None.
+
+    The cuadros carry no vigencia in their text; this is the closest date
+    available to place a PDF in a time series.
+    """
+    for key in ('CreationDate', 'ModDate'):
+        m = _PDF_DATE.match(str(metadata.get(key) or ''))
+        if m:
+            try:
+                return datetime.date(*map(int, m.groups())).isoformat()
+            except ValueError:
+                continue
+    return None
+
+
+def _extract_cached(pdf: PdfSource, use_cache: bool, key: Optional[str] = None,
+                    memory_limit: Optional[int] = None) -> Dict:
+    """Run pdfplumber + extract_tariffs on a PDF, going through the cache.
+
+    pdf is the raw bytes or a seekable binary file (key, the SHA-256 of its
+    content, is then required). The returned dict always carries 'paginas'
+    and is a fresh copy, so callers may edit it freely.
+
+    With memory_limit (bytes, 0 for no ceiling) the extraction runs under a
+    MemoryBudget: a fresh result also carries 'memoria_pico' (bytes) and
+    ExtractionMemoryError is raised past the ceiling.
+    """
+    if key is None:
+        key = TariffCache.key(pdf)
+    if use_cache:
+        cached = _cache.get(key)
+        if cached is not None:
+            incrementar('coema_extracciones_total', origen='cache')
+            return cached
+
     import pdfplumber
 
-    with pdfplumber.open(pdf_path) as pdf:
-        pages_text = [p.extract_text() or '' for p in pdf.pages]
+    incrementar('coema_extracciones_total', origen='pdf')
+    budget = MemoryBudget(memory_limit) if memory_limit is not None else None
+    with budget or nullcontext():
+        # pdfium and pdfminer must not read the same file object concurrently:
+        # the pre-scan runs to completion before pdfplumber opens it.
+        with span('pdf_preescaneo'):
+            index = _scan_keywords(pdf)
+        source = io.BytesIO(pdf) if isinstance(pdf, (bytes, bytearray)) else pdf
+        with span('pdf_apertura'):
+            doc = pdfplumber.open(source)
+        with doc:
+            n_pages = len(doc.pages)
+            pages = _pages_from_index(index, n_pages)
+            with span('pdf_texto_paginas'):
+                text = '\n'.join(iter_page_texts(doc, pages, budget))
+            incrementar('coema_paginas_extraidas_total', len(pages))
+            fecha = pdf_date(doc.metadata)
+
+        with span('pdf_parseo'):
+            result = extract_tariffs(text)
+        result['paginas'] = n_pages
+        result['fecha'] = fecha
+    if use_cache:
+        try:
+            _cache.put(key, result)
+        except OSError:
+            pass  # a read-only or full disk only costs us the cache
+    if budget is not None:
+        result['memoria_pico'] = budget.peak
+    return result
+
 
-    result = extract_tariffs('\n'.join(pages_text))
+# Everything that shapes a cached result: the code and patterns that turn a
+# PDF into the tariffs dict, and the libraries that lay out the page text.
+# Changes elsewhere in this module (downloads, bulk runs, the cache itself)
+# keep the cached results valid.
+_PARSER_CODE = (parse_number, _anexo_from_upper, _num, _tokenize_upper, _build_escalones,
+                extract_tariffs, build_keyword_index, _pages_from_index, iter_page_texts,
+                pdf_date, _extract_cached)
+_PARSER_DATA = (RANGOS_T1R, RANGOS_T1RE, SECCIONES, _TOKENS.pattern, _GRUPOS, _HASTA.pattern,
+                {k: p.pattern for k, p in PAGE_KEYWORDS.items()}, _PDF_DATE.pattern)
+_PDF_LIBRARIES = ('pdfplumber', 'pdfminer.six', 'pypdfium2')
+
+
+def _extractor_version() -> str:
+    """Hash of the parsing code and patterns plus the installed PDF library versions."""
+    h = hashlib.sha256()
+    for func in _PARSER_CODE:
+        h.update(inspect.getsource(func).encode())
+    h.update(repr(_PARSER_DATA).encode())
+    for name in _PDF_LIBRARIES:
+        try:
+            version = importlib.metadata.version(name)
+        except importlib.metadata.PackageNotFoundError:
+            version = None
+        h.update(f'{name}={version}'.encode())
+    return h.hexdigest()[:12]
+
+
+EXTRACTOR_VERSION = _extractor_version()
+_cache = TariffCache()
+
+
+def extract_tariffs_from_pdf(pdf_path: str, use_cache: bool = True,
+                             memory_limit: Optional[int] = EXTRACT_MEMORY_LIMIT) -> Dict:
+    """Extract tariffs from a PDF file on disk (read from the file, not loaded whole)."""
+    with open(pdf_path, 'rb') as f:
+        result = _extract_cached(f, use_cache, key=_stream_key(f), memory_limit=memory_limit)
     result['archivo'] = Path(pdf_path).name
-    result['paginas'] = len(pages_text)
     return result
 
 
-def extract_tariffs_from_bytes(pdf_bytes: bytes) -> Dict:
-    """Extract tariffs from raw PDF bytes (for Streamlit file_uploader)."""
-    import pdfplumber
+def extract_tariffs_from_pdfs(pdf_paths: Iterable[str], use_cache: bool = True,
+                              max_workers: Optional[int] = None) -> List[Union[Dict, Exception]]:
+    """Extract several PDF files in one call (e.g. Anexos 6, 14 and 104).
+
+    Cache hits are served in this process; the PDFs that need pdfplumber run
+    concurrently in a spawn process pool (layout extraction is pure Python,
+    threads would serialize on the GIL). Returns one entry per path in the
+    same order: the result dict, or the exception it raised.
+    """
+    pdf_paths = list(pdf_paths)
+    results: List[Union[Dict, Exception, None]] = [None] * len(pdf_paths)
+    pending = []
+    for i, path in enumerate(pdf_paths):
+        try:
+            if use_cache:
+                with open(path, 'rb') as f:
+                    cached = _cache.get(_stream_key(f))
+            else:
+                cached = None
+        except OSError as e:
+            results[i] = e
+            continue
+        if cached is not None:
+            cached['archivo'] = Path(path).name
+            results[i] = cached
+        else:
+            pending.append(i)
+
+    workers = min(max_workers or os.cpu_count() or 1, len(pending))
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn')) as pool:
+            futures = {i: pool.submit(extract_tariffs_from_pdf, pdf_paths[i], use_cache) for i in pending}
+            for i, future in futures.items():
+                try:
+                    results[i] = future.result()
+                except Exception as e:
+                    results[i] = e
+    else:
+        for i in pending:
+            try:
+                results[i] = extract_tariffs_from_pdf(pdf_paths[i], use_cache)
+            except Exception as e:
+                results[i] = e
+    return results
+
+
+class ExtractionTimeout(BaseException):
+    """A PDF took longer than the bulk extraction timeout.
+
+    Not an Exception (nor a TimeoutError, which is an OSError): the alarm
+    fires anywhere inside pdfplumber or our own code, and the broad
+    handlers there (the keyword pre-scan fallback, the best-effort cache
+    write) must not swallow it, since the one-shot timer does not fire again.
+    """
 
-    with pdfplumber.open(io.BytesIO(pdf_bytes)) as pdf:
-        pages_text = [p.extract_text() or '' for p in pdf.pages]
 
-    return extract_tariffs('\n'.join(pages_text))
+class BulkResult(NamedTuple):
+    """Outcome of one PDF in extract_tariffs_bulk."""
+    archivo: str             # path relative to the directory, or name inside the zip
+    data: Optional[Dict]     # extract_tariffs result (with 'fecha'), None on error
+    error: Optional[str]
+    segundos: float
 
 
-def extract_tariffs_from_url(url: str) -> Dict:
-    """Download a PDF from a URL and extract tariffs."""
-    import requests
+# (path, zip member or None): where a PDF is, cheap to send to a worker
+_Location = Tuple[str, Optional[str]]
 
-    response = requests.get(url, timeout=30, headers={
-        'User-Agent': 'COEMA-Facturacion/1.0',
-    })
-    response.raise_for_status()
 
-    content_type = response.headers.get('Content-Type', '')
-    if 'pdf' not in content_type and not url.lower().endswith('.pdf'):
-        raise ValueError(
-            f"La URL no parece ser un PDF (Content-Type: {content_type})"
-        )
+def _bulk_sources(source: str) -> List[Tuple[str, _Location]]:
+    """(name, location) of every PDF in a directory tree or a zip archive."""
+    root = Path(source)
+    if root.is_dir():
+        return [(p.relative_to(root).as_posix(), (str(p), None))
+                for p in sorted(root.rglob('*')) if p.suffix.lower() == '.pdf' and p.is_file()]
+    if zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as zf:
+            return [(m, (source, m)) for m in sorted(zf.namelist()) if m.lower().endswith('.pdf')]
+    raise ValueError(f'{source} is neither a directory nor a zip archive')
 
-    result = extract_tariffs_from_bytes(response.content)
+
+def _read_location(location: _Location) -> bytes:
+    path, member = location
+    if member is None:
+        return Path(path).read_bytes()
+    with zipfile.ZipFile(path) as zf:
+        return zf.read(member)
+
+
+@contextmanager
+def _time_limit(seconds: Optional[float]):
+    """Raise ExtractionTimeout in the block after seconds.
+
+    Uses SIGALRM, so it is only enforced on Unix and in the main thread
+    (always the case in the pool workers); elsewhere it is a no-op.
+    """
+    if (not seconds or not hasattr(signal, 'SIGALRM')
+            or threading.current_thread() is not threading.main_thread()):
+        yield
+        return
+
+    def expire(_signum, _frame):
+        # If the alarm lands in a destructor or weakref callback, Python
+        # prints the exception and drops it: re-arm so it fires again
+        # (the finally below disarms it once the block is left)
+        signal.setitimer(signal.ITIMER_REAL, _TIMEOUT_REFIRE)
+        raise ExtractionTimeout(f'extraction took longer than {seconds:g} s')
+
+    previous = signal.signal(signal.SIGALRM, expire)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def _bulk_extract(name: str, location: _Location, use_cache: bool,
+                  timeout: Optional[float]) -> BulkResult:
+    """Pool task: one PDF, any failure (including the timeout) reported instead of raised."""
+    t0 = time.perf_counter()
+    try:
+        with _time_limit(timeout):
+            data = _extract_cached(_read_location(location), use_cache,
+                                   memory_limit=EXTRACT_MEMORY_LIMIT)
+    except (Exception, ExtractionTimeout) as e:
+        return BulkResult(name, None, f'{type(e).__name__}: {e}', time.perf_counter() - t0)
+    data['archivo'] = name
+    return BulkResult(name, data, None, time.perf_counter() - t0)
+
+
+def _run_bulk(tasks: List[Tuple[str, _Location]], use_cache: bool, timeout: Optional[float],
+              max_workers: Optional[int]) -> List[BulkResult]:
+    workers = min(max_workers or os.cpu_count() or 1, len(tasks))
+    if workers <= 1:
+        return [_bulk_extract(name, loc, use_cache, timeout) for name, loc in tasks]
+
+    done: Dict[int, BulkResult] = {}
+    crashed = []
+    spawn = get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=spawn) as pool:
+        futures = {pool.submit(_bulk_extract, name, loc, use_cache, timeout): i
+                   for i, (name, loc) in enumerate(tasks)}
+        for future in as_completed(futures):
+            try:
+                done[futures[future]] = future.result()
+            except BrokenProcessPool:
+                crashed.append(futures[future])
+    # A worker that dies (segfault, OOM kill) breaks every task still in the
+    # pool: retry those one process each, so only the culprit fails.
+    for i in sorted(crashed):
+        name, loc = tasks[i]
+        with ProcessPoolExecutor(max_workers=1, mp_context=spawn) as pool:
+            try:
+                done[i] = pool.submit(_bulk_extract, name, loc, use_cache, timeout).result()
+            except BrokenProcessPool:
+                done[i] = BulkResult(name, None, 'BrokenProcessPool: worker process died', 0.0)
+    return [done[i] for i in range(len(tasks))]
+
+
+def extract_tariffs_bulk(source: str, use_cache: bool = True, max_workers: Optional[int] = None,
+                         timeout: Optional[float] = BULK_TIMEOUT) -> List[BulkResult]:
+    """Extract every PDF in a directory (recursively) or a zip archive.
+
+    Meant for loading years of past cuadros at once. Cache hits are served
+    here; the rest run in a spawn process pool, each with its own timeout,
+    and a PDF that fails, hangs or kills its worker is reported in its
+    BulkResult without affecting the others. Identical files are extracted
+    once. Results come back in name order.
+    """
+    sources = _bulk_sources(source)
+    results: List[Optional[BulkResult]] = [None] * len(sources)
+    pending: Dict[str, List[int]] = {}  # content hash -> positions with that content
+    for i, (name, location) in enumerate(sources):
+        try:
+            key = TariffCache.key(_read_location(location))
+        except (OSError, zipfile.BadZipFile) as e:
+            results[i] = BulkResult(name, None, f'{type(e).__name__}: {e}', 0.0)
+            continue
+        cached = _cache.get(key) if use_cache else None
+        if cached is not None:
+            cached['archivo'] = name
+            results[i] = BulkResult(name, cached, None, 0.0)
+        else:
+            pending.setdefault(key, []).append(i)
+
+    extracted = _run_bulk([sources[positions[0]] for positions in pending.values()],
+                          use_cache, timeout, max_workers)
+    for positions, result in zip(pending.values(), extracted):
+        for i in positions:
+            name = sources[i][0]
+            data = None
+            if result.data is not None:
+                data = copy.deepcopy(result.data) if i != positions[0] else result.data
+                data['archivo'] = name
+            results[i] = result._replace(archivo=name, data=data)
+    return results
+
+
+def extract_tariffs_from_bytes(pdf_bytes: bytes, use_cache: bool = True,
+                               memory_limit: Optional[int] = EXTRACT_MEMORY_LIMIT) -> Dict:
+    """Extract tariffs from raw PDF bytes (for Streamlit file_uploader)."""
+    result = _extract_cached(pdf_bytes, use_cache, memory_limit=memory_limit)
+    result.pop('paginas', None)
+    return result
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def http_session():
+    """Shared requests.Session: keep-alive connections pooled across downloads."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+
+            session = requests.Session()
+            session.headers['User-Agent'] = 'COEMA-Facturacion/1.0'
+            retry = Retry(total=3, backoff_factor=0.5, status_forcelist=(502, 503, 504),
+                          allowed_methods=('GET',))
+            adapter = HTTPAdapter(pool_connections=DOWNLOAD_CONCURRENCY,
+                                  pool_maxsize=DOWNLOAD_CONCURRENCY, max_retries=retry)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+        return _session
+
+
+def _download(response, max_bytes: int) -> Tuple[BinaryIO, str]:
+    """Stream a response body into a spooled temp file. Returns (file, sha256)."""
+    length = response.headers.get('Content-Length')
+    if length and length.isdigit() and int(length) > max_bytes:
+        raise ValueError(f"El PDF supera el tamaño máximo ({int(length)} > {max_bytes} bytes)")
+
+    spool = tempfile.SpooledTemporaryFile(max_size=DOWNLOAD_SPOOL_BYTES)
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        for chunk in response.iter_content(DOWNLOAD_CHUNK_BYTES):
+            size += len(chunk)
+            if size > max_bytes:
+                raise ValueError(f"El PDF supera el tamaño máximo ({max_bytes} bytes)")
+            digest.update(chunk)
+            spool.write(chunk)
+    except BaseException:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool, digest.hexdigest()
+
+
+def extract_tariffs_from_url(url: str, use_cache: bool = True,
+                             max_bytes: int = DOWNLOAD_MAX_BYTES,
+                             memory_limit: Optional[int] = EXTRACT_MEMORY_LIMIT) -> Dict:
+    """Download a PDF from a URL and extract tariffs.
+
+    Uses the shared HTTP session. With use_cache, a URL downloaded before is
+    revalidated with If-None-Match / If-Modified-Since and a 304 answer is
+    served from the extraction cache without transferring the body.
+    """
+    validators = _cache.get_validators(url) if use_cache else None
+    cached = _cache.get(validators['key']) if validators else None
+    headers = {}
+    if cached is not None:
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+
+    with http_session().get(url, headers=headers, stream=True,
+                            timeout=DOWNLOAD_TIMEOUT) as response:
+        if response.status_code == 304 and cached is not None:
+            result = cached
+        else:
+            response.raise_for_status()
+
+            content_type = response.headers.get('Content-Type', '')
+            if 'pdf' not in content_type and not url.lower().endswith('.pdf'):
+                raise ValueError(
+                    f"La URL no parece ser un PDF (Content-Type: {content_type})"
+                )
+
+            spool, key = _download(response, max_bytes)
+            with spool:
+                result = _extract_cached(spool, use_cache, key=key, memory_limit=memory_limit)
+            if use_cache:
+                try:
+                    _cache.put_validators(url, response.headers.get('ETag'),
+                                          response.headers.get('Last-Modified'), key)
+                except OSError:
+                    pass
+
+    result.pop('paginas', None)
     result['url'] = url
     return result
+
+
+async def extract_tariffs_from_urls_async(urls: Iterable[str], use_cache: bool = True,
+                                          max_concurrency: int = DOWNLOAD_CONCURRENCY
+                                          ) -> List[Union[Dict, Exception]]:
+    """Fetch and extract several PDFs concurrently (e.g. Anexos 6, 14 and 104).
+
+    Each download runs extract_tariffs_from_url in a worker thread, at most
+    max_concurrency at a time, sharing the pooled session. Returns one entry
+    per URL in the same order: the result dict, or the exception it raised.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def fetch(url: str) -> Dict:
+        async with semaphore:
+            return await asyncio.to_thread(extract_tariffs_from_url, url, use_cache)
+
+    return await asyncio.gather(*(fetch(u) for u in urls), return_exceptions=True)
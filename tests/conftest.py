@@ -0,0 +1,47 @@
+"""
+COEMA - Fixtures compartidas de los tests
+Los módulos de src/ se importan planos, como los importa la app.
+"""
+
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+from facturacion_rutas import facturar_por_rutas  # noqa: E402
+
+
+@pytest.fixture
+def tarifas():
+    """Cuadro chico con la forma de extract_tariffs()['tarifas']."""
+    return {
+        "T1R": {"nombre": "Tarifa 1 Residencial", "codigo": "T1R", "escalones": [
+            {"num": 1, "nombre": "R1", "desde": 0, "hasta": 150, "cargo_fijo": 3441.98, "cargo_variable": 160.2894},
+            {"num": 2, "nombre": "R2", "desde": 150, "hasta": 99999, "cargo_fijo": 5289.07, "cargo_variable": 167.5662},
+        ]},
+    }
+
+
+@pytest.fixture
+def facturas(tarifas):
+    """(resultados, servicios) de cuatro socios facturados en dos rutas."""
+    socios = ["1001", "1002", "1003", "1004"]
+    padron = pd.DataFrame({
+        "ruta": [1, 1, 2, 2],
+        "tarifa": "T1R",
+        "consumo_kwh": [120, 180, 90, 300],
+        "iva": 0.21,
+        "zona_alumbrado": 1,
+    }, index=pd.Index(socios, name="socio"))
+    servicios = pd.DataFrame({
+        "nombre": ["Ana Pérez", "Juan Gómez", "Rosa Díaz", "Luis Sosa"],
+        "direccion": "Zubiaurre 248",
+        "localidad": "Gral. Madariaga",
+        "medidor": ["M1", "M2", "M3", "M4"],
+        "condicion_iva": "Consumidor Final",
+    }, index=pd.Index(socios, name="socio"))
+    resultados, _ = facturar_por_rutas(padron, tarifas, max_workers=1)
+    return resultados, servicios
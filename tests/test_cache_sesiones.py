@@ -0,0 +1,46 @@
+"""Cache compartida entre sesiones: un solo cálculo por clave."""
+
+import threading
+import time
+
+import pytest
+
+from cache_sesiones import CacheCompartida
+
+
+def test_sesiones_concurrentes_calculan_una_sola_vez():
+    cache = CacheCompartida("prueba", 4)
+    calculos = []
+
+    def calcular():
+        calculos.append(1)
+        time.sleep(0.05)
+        return object()
+
+    valores = []
+    inicio = threading.Barrier(8)
+
+    def sesion():
+        inicio.wait()
+        for _ in range(50):
+            valores.append(cache.obtener_o_calcular("corrida", calcular))
+
+    hilos = [threading.Thread(target=sesion) for _ in range(8)]
+    for h in hilos:
+        h.start()
+    for h in hilos:
+        h.join()
+    assert len(calculos) == 1
+    assert len({id(v) for v in valores}) == 1
+
+
+def test_si_el_calculo_falla_no_se_guarda_y_se_puede_reintentar():
+    cache = CacheCompartida("prueba", 4)
+
+    def falla():
+        raise RuntimeError("padrón inválido")
+
+    with pytest.raises(RuntimeError):
+        cache.obtener_o_calcular("corrida", falla)
+    assert "corrida" not in cache
+    assert cache.obtener_o_calcular("corrida", lambda: 42) == 42
@@ -0,0 +1,137 @@
+"""Envío de facturas contra un servidor SMTP local (aiosmtpd)."""
+
+import asyncio
+import email
+import socket
+
+import pytest
+
+pytest.importorskip("aiosmtpd")
+from aiosmtpd.controller import Controller  # noqa: E402
+
+import envio_facturas  # noqa: E402
+from envio_facturas import (  # noqa: E402
+    ENVIADO, ERROR, PENDIENTE, RECHAZADO, ConfigSMTP, EnvioAbortado, EstadoEnvios, enviar_facturas,
+)
+
+EMAILS = {"1001": "ana@ejemplo.com", "1002": "juan@ejemplo.com",
+          "1003": "rosa@ejemplo.com", "1004": "luis@ejemplo.com"}
+
+
+class Servidor:
+    """Handler de aiosmtpd: guarda lo recibido y rechaza lo que se le indique."""
+
+    def __init__(self):
+        self.recibidos = []
+        self.rechazar_rcpt = set()   # direcciones que reciben 550
+        self.fallas_data = 0         # cuántos DATA responder con 451 antes de aceptar
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        if address in self.rechazar_rcpt:
+            return "550 5.1.1 Casilla inexistente"
+        envelope.rcpt_tos.append(address)
+        return "250 OK"
+
+    async def handle_DATA(self, server, session, envelope):
+        if self.fallas_data:
+            self.fallas_data -= 1
+            return "451 4.3.0 Intente mas tarde"
+        self.recibidos.append(email.message_from_bytes(envelope.content))
+        return "250 OK"
+
+
+def puerto_libre() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture
+def servidor():
+    handler = Servidor()
+    controller = Controller(handler, hostname="127.0.0.1", port=puerto_libre())
+    controller.start()
+    handler.config = ConfigSMTP(host="127.0.0.1", port=controller.port,
+                                usuario=None, clave=None, starttls=False,
+                                remitente="facturacion@coema.test")
+    yield handler
+    controller.stop()
+
+
+def enviar(facturas, tarifas, servidor, db, emails=EMAILS, **kwargs):
+    resultados, servicios = facturas
+    return asyncio.run(enviar_facturas(
+        resultados, servicios, emails, tarifas, "2026-01", config=kwargs.pop("config", servidor.config),
+        db=str(db), conexiones=2, mensajes_por_seg=0, backoff=0.01, **kwargs))
+
+
+def estados(db):
+    estado = EstadoEnvios(str(db))
+    try:
+        return dict(estado.conn.execute("SELECT socio, estado FROM envios").fetchall())
+    finally:
+        estado.close()
+
+
+def test_envia_cada_factura_una_vez(facturas, tarifas, servidor, tmp_path):
+    db = tmp_path / "envios.sqlite3"
+    r = enviar(facturas, tarifas, servidor, db)
+    assert r["enviados"] == 4 and r["errores"] == r["rechazados"] == 0
+    assert sorted(m["To"] for m in servidor.recibidos) == sorted(EMAILS.values())
+    adjunto = next(p for p in servidor.recibidos[0].walk() if p.get_content_type() == "application/pdf")
+    assert adjunto.get_payload(decode=True).startswith(b"%PDF")
+
+    # Una segunda corrida no reenvía nada
+    r = enviar(facturas, tarifas, servidor, db)
+    assert r["enviados"] == 0 and r["ya_enviados"] == 4
+    assert len(servidor.recibidos) == 4
+
+
+def test_rcpt_5xx_rechaza_solo_esa_factura(facturas, tarifas, servidor, tmp_path):
+    db = tmp_path / "envios.sqlite3"
+    servidor.rechazar_rcpt.add("rosa@ejemplo.com")
+    r = enviar(facturas, tarifas, servidor, db)
+    assert (r["enviados"], r["rechazados"]) == (3, 1)
+    assert estados(db)["1003"] == RECHAZADO
+
+    # Con la misma dirección sigue rechazada; con una nueva vuelve a pendiente y sale
+    r = enviar(facturas, tarifas, servidor, db)
+    assert r["enviados"] == 0 and estados(db)["1003"] == RECHAZADO
+    r = enviar(facturas, tarifas, servidor, db, emails={**EMAILS, "1003": "rosa.diaz@ejemplo.com"})
+    assert r["enviados"] == 1 and estados(db)["1003"] == ENVIADO
+
+
+def test_data_4xx_se_reintenta(facturas, tarifas, servidor, tmp_path):
+    servidor.fallas_data = 2
+    r = enviar(facturas, tarifas, servidor, tmp_path / "envios.sqlite3")
+    assert r["enviados"] == 4 and r["errores"] == 0
+    assert len(servidor.recibidos) == 4
+
+
+def test_falla_de_autenticacion_corta_sin_rechazar(facturas, tarifas, servidor, tmp_path):
+    db = tmp_path / "envios.sqlite3"
+    # El servidor local no ofrece AUTH: el login falla igual para todas las facturas
+    config = servidor.config._replace(usuario="coema", clave="mala")
+    with pytest.raises(EnvioAbortado):
+        enviar(facturas, tarifas, servidor, db, config=config)
+    assert set(estados(db).values()) == {PENDIENTE}
+    assert servidor.recibidos == []
+
+    # Corregida la configuración, salen todas
+    assert enviar(facturas, tarifas, servidor, db)["enviados"] == 4
+
+
+def test_factura_que_no_se_puede_armar_no_corta_el_envio(facturas, tarifas, servidor, tmp_path,
+                                                         monkeypatch):
+    db = tmp_path / "envios.sqlite3"
+    factura_pdf = envio_facturas.factura_pdf
+
+    def falla_1002(socio, *args, **kwargs):
+        if socio == "1002":
+            raise ValueError("plantilla rota")
+        return factura_pdf(socio, *args, **kwargs)
+
+    monkeypatch.setattr(envio_facturas, "factura_pdf", falla_1002)
+    r = enviar(facturas, tarifas, servidor, db)
+    assert (r["enviados"], r["errores"]) == (3, 1)
+    assert estados(db)["1002"] == ERROR
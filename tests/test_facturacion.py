@@ -0,0 +1,21 @@
+"""Motor de facturación: la curva del Simulador y el formato de facturar_lote."""
+
+import numpy as np
+
+from facturacion import TIPOS_RESULTADO, calcular_factura, curva_factura, facturar_lote
+
+
+def test_curva_coincide_al_centavo_con_calcular_factura(tarifas):
+    consumos = np.arange(0, 400)
+    for iva_rate in (0.21, 0.27):
+        curva = curva_factura("T1R", iva_rate, tarifas)
+        for campo in ("subtotal_energia", "total", "total_general"):
+            esperado = [calcular_factura("T1R", int(kwh), iva_rate, tarifas)["resumen"][campo]
+                        for kwh in consumos]
+            assert getattr(curva, campo)(consumos).tolist() == esperado
+
+
+def test_facturar_lote_devuelve_los_tipos_declarados(tarifas):
+    # Los checkpoints por ruta se versionan con TIPOS_RESULTADO
+    resultado = facturar_lote(["T1R", "T1R"], [120, 300], [0.21, 0.27], tarifas)
+    assert {col: str(dtype) for col, dtype in resultado.dtypes.items()} == TIPOS_RESULTADO
@@ -0,0 +1,123 @@
+"""Extracción de cuadros tarifarios: límites de la carga masiva y descarga por URL."""
+
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+import pdf_extractor
+from pdf_extractor import (ExtractionTimeout, MemoryBudget, TariffCache, _time_limit,
+                           extract_tariffs_bulk, extract_tariffs_from_url)
+
+# PDF mínimo válido: lo que importa es que el extractor llegue a procesarlo
+PDF_VACIO = (b"%PDF-1.4\n1 0 obj<</Type/Catalog/Pages 2 0 R>>endobj\n"
+             b"2 0 obj<</Type/Pages/Kids[]/Count 0>>endobj\n"
+             b"trailer<</Root 1 0 R>>\n%%EOF\n")
+
+
+def test_timeout_no_se_pierde_en_los_except_amplios(tmp_path, monkeypatch):
+    (tmp_path / "lento.pdf").write_bytes(PDF_VACIO)
+
+    def prescaneo_lento(pdf):
+        time.sleep(5)  # el pre-escaneo atrapa Exception y sigue sin índice
+
+    monkeypatch.setattr(pdf_extractor, "build_keyword_index", prescaneo_lento)
+    t0 = time.perf_counter()
+    [r] = extract_tariffs_bulk(str(tmp_path), use_cache=False, max_workers=1, timeout=0.2)
+    assert r.error and r.error.startswith("ExtractionTimeout")
+    assert time.perf_counter() - t0 < 2
+
+
+@pytest.mark.filterwarnings('ignore::pytest.PytestUnraisableExceptionWarning')
+def test_timeout_se_repite_si_un_destructor_lo_traga():
+    class Lento:
+        def __del__(self):
+            time.sleep(0.3)  # la primera alarma cae acá y Python la descarta
+
+    t0 = time.perf_counter()
+    with pytest.raises(ExtractionTimeout):
+        with _time_limit(0.1):
+            Lento()
+            time.sleep(3)
+    assert time.perf_counter() - t0 < 1
+
+
+def test_memory_budget_libera_el_lock_si_falla_al_entrar(monkeypatch):
+    def sin_memoria(*args):
+        raise MemoryError
+
+    monkeypatch.setattr(pdf_extractor.tracemalloc, "is_tracing", lambda: False)
+    monkeypatch.setattr(pdf_extractor.tracemalloc, "start", sin_memoria)
+    with pytest.raises(MemoryError):
+        with MemoryBudget():
+            pass
+    assert not pdf_extractor._memory_lock.locked()
+
+
+def test_version_del_extractor_cambia_con_las_librerias_pdf(monkeypatch):
+    assert pdf_extractor._extractor_version() == pdf_extractor.EXTRACTOR_VERSION
+    version = pdf_extractor.importlib.metadata.version
+    monkeypatch.setattr(pdf_extractor.importlib.metadata, "version",
+                        lambda name: "0.0" if name == "pdfminer.six" else version(name))
+    assert pdf_extractor._extractor_version() != pdf_extractor.EXTRACTOR_VERSION
+
+
+class _Publicador(BaseHTTPRequestHandler):
+    """Sirve PDF_VACIO con ETag; /cortado corta el cuerpo, /html no es un PDF."""
+
+    pedidos: list = []
+
+    def do_GET(self):
+        type(self).pedidos.append((self.path, self.headers.get("If-None-Match")))
+        if self.path == "/cuadro" and self.headers.get("If-None-Match") == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+            return
+        cuerpo = b"<html></html>" if self.path == "/html" else PDF_VACIO
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html" if self.path == "/html" else "application/pdf")
+        self.send_header("Content-Length", str(len(cuerpo)))
+        self.send_header("ETag", '"v1"')
+        self.end_headers()
+        self.wfile.write(cuerpo[:20] if self.path == "/cortado" else cuerpo)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def publicador(tmp_path, monkeypatch):
+    """URL base de un servidor HTTP local y cache de extracción vacía."""
+    monkeypatch.setattr(pdf_extractor, "_cache", TariffCache(str(tmp_path / "cache")))
+    _Publicador.pedidos = []
+    servidor = ThreadingHTTPServer(("127.0.0.1", 0), _Publicador)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{servidor.server_address[1]}"
+    servidor.shutdown()
+    servidor.server_close()
+
+
+def test_descarga_y_revalidacion_con_etag(publicador):
+    primero = extract_tariffs_from_url(publicador + "/cuadro")
+    assert primero["url"] == publicador + "/cuadro" and "tarifas" in primero
+    segundo = extract_tariffs_from_url(publicador + "/cuadro")
+    assert segundo == primero
+    # La segunda vez pregunta con el ETag y el 304 se sirve desde la cache
+    assert _Publicador.pedidos == [("/cuadro", None), ("/cuadro", '"v1"')]
+
+
+def test_descarga_cortada_no_queda_en_cache(publicador):
+    with pytest.raises(requests.RequestException):
+        extract_tariffs_from_url(publicador + "/cortado")
+    assert pdf_extractor._cache.get_validators(publicador + "/cortado") is None
+    with pytest.raises(requests.RequestException):
+        extract_tariffs_from_url(publicador + "/cortado")
+    assert _Publicador.pedidos == [("/cortado", None), ("/cortado", None)]
+
+
+def test_url_que_no_es_pdf(publicador):
+    with pytest.raises(ValueError, match="no parece ser un PDF"):
+        extract_tariffs_from_url(publicador + "/html")
+    assert pdf_extractor._cache.get_validators(publicador + "/html") is None